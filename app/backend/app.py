@@ -1,17 +1,30 @@
 import os
+import json
 import mimetypes
-import time
 import logging
 import openai
-from flask import Flask, request, jsonify
-from azure.identity import DefaultAzureCredential
+import aiohttp
+import tempfile
+import metrics
+from quart import Quart, Response, request, jsonify, send_file
+from azure.identity.aio import DefaultAzureCredential
 from azure.core.credentials import AzureKeyCredential, AzureNamedKeyCredential
-from azure.search.documents import SearchClient
+from azure.core.exceptions import ResourceNotFoundError
+from azure.search.documents.aio import SearchClient
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.readretrieveread import ReadRetrieveReadApproach
 from approaches.readdecomposeask import ReadDecomposeAsk
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
-from azure.storage.blob import BlobServiceClient
+from cache import create_cache
+from responsecache import ResponseCache
+from retrieval import IndexVersion, Retriever
+from localsearch import LocalSearchClient
+from contextbuilder import configure_deployment
+from sessions import ChatSessions
+from contentcache import BlobFileCache
+from tokenrefresher import TokenRefresher
+from langchainadapters import set_api_key
+from azure.storage.blob.aio import BlobServiceClient
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.environ.get("AZURE_STORAGE_ACCOUNT") or "mystorageaccount"
@@ -26,10 +39,72 @@ AZURE_OPENAI_GPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_DEPLOYMENT") or "
 AZURE_OPENAI_CHATGPT_DEPLOYMENT = (
     os.environ.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT") or "chat"
 )
+# Models behind the deployments, prompts are sized to fit their context windows. Set the *_CONTEXT_TOKENS variables
+# to use less than the whole window
+AZURE_OPENAI_GPT_MODEL = os.environ.get("AZURE_OPENAI_GPT_MODEL") or "text-davinci-003"
+AZURE_OPENAI_CHATGPT_MODEL = os.environ.get("AZURE_OPENAI_CHATGPT_MODEL") or "gpt-35-turbo"
+AZURE_OPENAI_GPT_CONTEXT_TOKENS = int(os.environ.get("AZURE_OPENAI_GPT_CONTEXT_TOKENS") or 0) or None
+AZURE_OPENAI_CHATGPT_CONTEXT_TOKENS = int(os.environ.get("AZURE_OPENAI_CHATGPT_CONTEXT_TOKENS") or 0) or None
+
+# Endpoints default to the public Azure ones for the services above. Point them elsewhere (e.g. at the stand-ins in
+# scripts/benchmarks/mock_services.py) with these, keys are then needed since tokens are only sent over https
+AZURE_SEARCH_ENDPOINT = os.environ.get("AZURE_SEARCH_ENDPOINT") or f"https://{AZURE_SEARCH_SERVICE}.search.windows.net"
+AZURE_STORAGE_ENDPOINT = os.environ.get("AZURE_STORAGE_ENDPOINT") or f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net"
+AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT") or f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY")
 
 KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
 KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
+KB_FIELDS_EMBEDDING = os.environ.get("KB_FIELDS_EMBEDDING") or "embedding"
+
+# Search a local index built with scripts/prepdocs.py --localindex instead of Azure Cognitive Search, e.g. for load
+# tests, offline development or small tenants
+LOCAL_SEARCH_INDEX = os.environ.get("LOCAL_SEARCH_INDEX")
+
+# Answers to repeated questions are cached in-process unless RESPONSE_CACHE_URL points to a Redis-compatible server
+# (e.g. rediss://:<key>@myredis.redis.cache.windows.net:6380/0). Similar questions are also matched when an embeddings
+# deployment is set in AZURE_OPENAI_EMB_DEPLOYMENT, which also enables the vector and hybrid retrieval modes.
+RESPONSE_CACHE_URL = os.environ.get("RESPONSE_CACHE_URL")
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL") or 3600)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES") or 1000)
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY") or 0.95)
+AZURE_OPENAI_EMB_DEPLOYMENT = os.environ.get("AZURE_OPENAI_EMB_DEPLOYMENT")
+
+# Search results are cached for a shorter time, and are dropped as soon as the indexing pipeline updates the index
+RETRIEVAL_CACHE_URL = os.environ.get("RETRIEVAL_CACHE_URL") or RESPONSE_CACHE_URL
+RETRIEVAL_CACHE_TTL = int(os.environ.get("RETRIEVAL_CACHE_TTL") or 300)
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.environ.get("RETRIEVAL_CACHE_MAX_ENTRIES") or 5000)
+
+# Chat sessions let the client send a session id and its new message instead of the whole history. Kept in-process
+# unless CHAT_SESSION_CACHE_URL (or RESPONSE_CACHE_URL) points to a Redis-compatible server shared by all instances
+CHAT_SESSION_CACHE_URL = os.environ.get("CHAT_SESSION_CACHE_URL") or RESPONSE_CACHE_URL
+CHAT_SESSION_TTL = int(os.environ.get("CHAT_SESSION_TTL") or 86400)
+CHAT_SESSION_MAX_ENTRIES = int(os.environ.get("CHAT_SESSION_MAX_ENTRIES") or 10000)
+
+# Source documents opened from citations are cached on local disk, up to CONTENT_CACHE_MAX_BYTES. Cached files are
+# served without contacting storage for CONTENT_CACHE_REVALIDATE seconds, and browsers may reuse them for
+# CONTENT_MAX_AGE seconds before checking their ETag
+CONTENT_CACHE_DIR = os.environ.get("CONTENT_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "gptkb-content")
+CONTENT_CACHE_MAX_BYTES = int(os.environ.get("CONTENT_CACHE_MAX_BYTES") or 1024 * 1024 * 1024)
+CONTENT_CACHE_REVALIDATE = int(os.environ.get("CONTENT_CACHE_REVALIDATE") or 300)
+CONTENT_MAX_AGE = int(os.environ.get("CONTENT_MAX_AGE") or 300)
+
+# Search for the user's question while the chat approach rewrites it into a search query, and use those results when
+# the rewrite didn't change the query much. Set to "false" to always wait for the rewrite
+CHAT_SPECULATIVE_RETRIEVAL = (os.environ.get("CHAT_SPECULATIVE_RETRIEVAL") or "true").lower() == "true"
+
+# Have the rda approach plan all its searches up front and run them concurrently, answering in 2 completions. Set to
+# "false" to always search step by step with the ReAct agent
+RDA_PLANNER = (os.environ.get("RDA_PLANNER") or "true").lower() == "true"
+
+# Latency, token and cache metrics are served in the Prometheus format on /metrics. Traces are also exported with
+# OpenTelemetry when an OTLP endpoint is configured (OTEL_EXPORTER_OTLP_ENDPOINT or OTEL_EXPORTER_OTLP_TRACES_ENDPOINT)
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT") or os.environ.get("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+OTEL_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME") or "gptkb-backend"
+
+# Calls to Azure OpenAI share one pool of keep-alive connections, of at most OPENAI_MAX_CONNECTIONS connections
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS") or 100)
 
 # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
 # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
@@ -49,135 +124,333 @@ storage_credential = (
     else azure_credential
 )
 
+configure_deployment(AZURE_OPENAI_GPT_DEPLOYMENT, AZURE_OPENAI_GPT_MODEL, AZURE_OPENAI_GPT_CONTEXT_TOKENS)
+configure_deployment(AZURE_OPENAI_CHATGPT_DEPLOYMENT, AZURE_OPENAI_CHATGPT_MODEL, AZURE_OPENAI_CHATGPT_CONTEXT_TOKENS)
+
 # Used by the OpenAI SDK
 openai.api_type = "azure"
-openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+openai.api_base = AZURE_OPENAI_ENDPOINT
 openai.api_version = "2022-12-01"
 
-# Comment these two lines out if using keys, set your API key in the OPENAI_API_KEY environment variable instead
-openai.api_type = "azure_ad"
-openai_token = azure_credential.get_token(
-    "https://cognitiveservices.azure.com/.default"
+# Without a key in AZURE_OPENAI_KEY, use tokens for the current identity. The first token is acquired in
+# setup_clients, once the event loop is running, and later ones in the background before the current one expires
+if AZURE_OPENAI_KEY:
+    openai.api_key = AZURE_OPENAI_KEY
+else:
+    openai.api_type = "azure_ad"
+openai_tokens = (
+    None
+    if AZURE_OPENAI_KEY
+    else TokenRefresher(
+        azure_credential,
+        "https://cognitiveservices.azure.com/.default",
+        on_token=set_api_key,
+    )
 )
-openai.api_key = openai_token.token
+openai_session = None
 
 # Set up clients for Cognitive Search and Storage
-search_client = SearchClient(
-    endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-    index_name=AZURE_SEARCH_INDEX,
-    credential=search_credential,
+search_client = (
+    LocalSearchClient(LOCAL_SEARCH_INDEX)
+    if LOCAL_SEARCH_INDEX
+    else SearchClient(
+        endpoint=AZURE_SEARCH_ENDPOINT,
+        index_name=AZURE_SEARCH_INDEX,
+        credential=search_credential,
+    )
 )
+# Blobs are downloaded in chunks of this size, so /content starts streaming a cache miss after the first chunk instead
+# of after the SDK's default of 32MB
+CONTENT_DOWNLOAD_CHUNK_BYTES = 4 * 1024 * 1024
 blob_client = BlobServiceClient(
-    account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+    account_url=AZURE_STORAGE_ENDPOINT,
     credential=storage_credential,
+    max_single_get_size=CONTENT_DOWNLOAD_CHUNK_BYTES,
+    max_chunk_get_size=CONTENT_DOWNLOAD_CHUNK_BYTES,
 )
 content_blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
 source_blob_container = blob_client.get_container_client(AZURE_SOURCE_STORAGE_CONTAINER)
+content_cache = BlobFileCache(source_blob_container, CONTENT_CACHE_DIR, max_bytes=CONTENT_CACHE_MAX_BYTES, revalidate_after=CONTENT_CACHE_REVALIDATE)
+
+async def get_index_version():
+    if LOCAL_SEARCH_INDEX:
+        return await search_client.get_version()
+    properties = await content_blob_container.get_container_properties()
+    return properties.metadata.get("indexversion", "")
+
+async def embed_query(q: str) -> list[float]:
+    r = await openai.Embedding.acreate(engine=AZURE_OPENAI_EMB_DEPLOYMENT, input=q)
+    return r["data"][0]["embedding"]
+
+index_version = IndexVersion(get_index_version)
+retriever = Retriever(
+    search_client,
+    create_cache(RETRIEVAL_CACHE_URL, max_entries=RETRIEVAL_CACHE_MAX_ENTRIES, ttl=RETRIEVAL_CACHE_TTL) if RETRIEVAL_CACHE_TTL > 0 else None,
+    index_version,
+    embed=embed_query if AZURE_OPENAI_EMB_DEPLOYMENT else None,
+    vector_field=KB_FIELDS_EMBEDDING,
+    content_field=KB_FIELDS_CONTENT,
+    sourcepage_field=KB_FIELDS_SOURCEPAGE,
+)
+response_cache = ResponseCache(
+    create_cache(RESPONSE_CACHE_URL, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL),
+    embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
+    similarity_threshold=RESPONSE_CACHE_SIMILARITY,
+    index_version=index_version,
+)
+
+chat_sessions = ChatSessions(
+    create_cache(CHAT_SESSION_CACHE_URL, max_entries=CHAT_SESSION_MAX_ENTRIES, ttl=CHAT_SESSION_TTL)
+)
 
 # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
 # or some derivative, here we include several for exploration purposes
 ask_approaches = {
     "rtr": RetrieveThenReadApproach(
-        search_client,
+        retriever,
         AZURE_OPENAI_GPT_DEPLOYMENT,
         KB_FIELDS_SOURCEPAGE,
         KB_FIELDS_CONTENT,
+        response_cache if RESPONSE_CACHE_TTL > 0 else None,
     ),
     "rrr": ReadRetrieveReadApproach(
-        search_client,
+        retriever,
         AZURE_OPENAI_GPT_DEPLOYMENT,
         KB_FIELDS_SOURCEPAGE,
         KB_FIELDS_CONTENT,
     ),
     "rda": ReadDecomposeAsk(
-        search_client,
+        retriever,
         AZURE_OPENAI_GPT_DEPLOYMENT,
         KB_FIELDS_SOURCEPAGE,
         KB_FIELDS_CONTENT,
+        planner=RDA_PLANNER,
     ),
 }
 
 chat_approaches = {
     "rrr": ChatReadRetrieveReadApproach(
-        search_client,
+        retriever,
         AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         AZURE_OPENAI_GPT_DEPLOYMENT,
         KB_FIELDS_SOURCEPAGE,
         KB_FIELDS_CONTENT,
+        speculative=CHAT_SPECULATIVE_RETRIEVAL,
     )
 }
 
-app = Flask(__name__)
+if OTEL_EXPORTER_OTLP_ENDPOINT:
+    metrics.enable_opentelemetry(OTEL_SERVICE_NAME)
+
+app = Quart(__name__)
+
+
+@app.before_serving
+async def setup_clients():
+    global openai_session
+    openai_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=OPENAI_MAX_CONNECTIONS, keepalive_timeout=120))
+    if openai_tokens:
+        await openai_tokens.start()
+
+
+# The OpenAI SDK opens a new session (and connection) for every call unless one is set for the current context
+@app.before_request
+async def use_openai_session():
+    openai.aiosession.set(openai_session)
+
+
+@app.after_serving
+async def close_clients():
+    if openai_tokens:
+        await openai_tokens.stop()
+    await openai_session.close()
+    await search_client.close()
+    await blob_client.close()
+    await azure_credential.close()
+
+
+@app.route("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
-def static_file(path):
-    return app.send_static_file(path)
+async def static_file(path):
+    return await app.send_static_file(path)
 
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Files come from the local content cache when possible (see contentcache.py), with
+# support for range requests and ETags, and are otherwise streamed from storage while they are being cached.
 @app.route("/content/<path>")
-def content_file(path):
+async def content_file(path):
     content_filename, extension = os.path.splitext(path)
     filename_splits = content_filename.split("-")
     page_num = filename_splits[-1]
     source_filename = "-".join(filename_splits[:-1]) + extension
-    print(source_filename)
-    blob = source_blob_container.get_blob_client(source_filename).download_blob()
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
-        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    return (
-        blob.readall(),
-        200,
-        {
-            "Content-Type": mime_type,
-            "Content-Disposition": f"inline; filename={path}",
-            "Page-Number": page_num,
-        },
-    )
+    headers = {
+        "Content-Disposition": f"inline; filename={path}",
+        "Page-Number": page_num,
+    }
+    try:
+        entry, download = await content_cache.open(source_filename)
+        if entry is None:
+            etag = download.etag.strip('"')
+            if etag in request.if_none_match:
+                download.close()
+                return "", 304, dict(headers, ETag=f'"{etag}"')
+            if request.range is None or download.size > CONTENT_CACHE_MAX_BYTES:
+                response = Response(download.chunks, mimetype=content_mime_type(download.content_type, path), headers=headers)
+                response.content_length = download.size
+                # Large blobs can take longer than Quart's default RESPONSE_TIMEOUT of 60s to send
+                response.timeout = None
+                response.set_etag(etag)
+                response.cache_control.public = True
+                response.cache_control.max_age = CONTENT_MAX_AGE
+                return response
+            # Range requests are answered from the cached file, so the whole blob is cached first
+            async for _ in download.chunks:
+                pass
+            entry, download = await content_cache.open(source_filename)
+            if entry is None:
+                download.close()
+                return jsonify({"error": "content is being updated, please retry"}), 503
+    except ResourceNotFoundError:
+        return jsonify({"error": f"{source_filename} not found"}), 404
+
+    response = await send_file(entry.path, mimetype=content_mime_type(entry.content_type, path), add_etags=False, cache_timeout=CONTENT_MAX_AGE)
+    response.headers.update(headers)
+    response.set_etag(entry.etag.strip('"'))
+    response.timeout = None
+    await response.make_conditional(request, accept_ranges=True, complete_length=entry.size)
+    if response.status_code == 304:
+        response.set_data(b"")
+    return response
+
+
+def content_mime_type(content_type, path):
+    if content_type == "application/octet-stream":
+        return mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return content_type
 
 
 @app.route("/ask", methods=["POST"])
-def ask():
-    ensure_openai_token()
-    approach = request.json["approach"]
+async def ask():
+    await ensure_openai_token()
+    request_json = await request.get_json()
+    approach = request_json["approach"]
+    timings = None
     try:
         impl = ask_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["question"], request.json.get("overrides") or {})
-        return jsonify(r)
+        timings = metrics.start_request("/ask", approach)
+        if request_json.get("stream"):
+            return stream_response(impl.run_stream(request_json["question"], request_json.get("overrides") or {}), timings)
+        r = await impl.run(request_json["question"], request_json.get("overrides") or {})
+        return jsonify(dict(r, timings=timings.finish()))
     except Exception as e:
         logging.exception("Exception in /ask")
+        if timings:
+            timings.finish(500)
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/chat", methods=["POST"])
-def chat():
-    ensure_openai_token()
-    approach = request.json["approach"]
+async def chat():
+    await ensure_openai_token()
+    request_json = await request.get_json()
+    approach = request_json["approach"]
+    timings = None
     try:
         impl = chat_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["history"], request.json.get("overrides") or {})
-        return jsonify(r)
+        timings = metrics.start_request("/chat", approach)
+        history = request_json.get("history")
+        session_id = None
+        if history is not None:
+            # The rendered text and token counts cached on turns are only trusted when they come from a stored session,
+            # a client could otherwise put any text in the prompt or get around the history's token budget
+            history = [{k: v for k, v in h.items() if k not in ("text", "tokens")} for h in history]
+        else:
+            # Session mode: the client sends its new message, and from the second turn on, the session id it got back
+            # with the first answer
+            session_id = request_json.get("session_id")
+            history = await chat_sessions.get(session_id) if session_id else []
+            if history is None:
+                timings.finish(404)
+                return jsonify({"error": "Unknown or expired chat session, please start a new chat"}), 404
+            session_id = session_id or chat_sessions.new_id()
+            history.append({"user": request_json["message"]})
+        if request_json.get("stream"):
+            frames = impl.run_stream(history, request_json.get("overrides") or {})
+            return stream_response(session_frames(session_id, history, frames) if session_id else frames, timings)
+        r = await impl.run(history, request_json.get("overrides") or {})
+        if session_id:
+            history[-1]["bot"] = r["answer"]
+            await chat_sessions.save(session_id, history)
+            r = dict(r, session_id=session_id)
+        return jsonify(dict(r, timings=timings.finish()))
     except Exception as e:
         logging.exception("Exception in /chat")
+        if timings:
+            timings.finish(500)
         return jsonify({"error": str(e)}), 500
 
 
-def ensure_openai_token():
-    global openai_token
-    if openai_token.expires_on < int(time.time()) - 60:
-        openai_token = azure_credential.get_token(
-            "https://cognitiveservices.azure.com/.default"
-        )
-        openai.api_key = openai_token.token
+@app.route("/chat/<session_id>", methods=["DELETE"])
+async def delete_chat_session(session_id):
+    await chat_sessions.delete(session_id)
+    return "", 204
+
+
+# Streams a chat answer in session mode: the session id goes out first, and the turn is only added to the session once
+# the whole answer has been streamed
+async def session_frames(session_id, history, frames):
+    yield {"session_id": session_id}
+    answer = ""
+    async for frame in frames:
+        answer += frame.get("answer") or ""
+        yield frame
+    history[-1]["bot"] = answer
+    await chat_sessions.save(session_id, history)
+
+
+# Streamed responses are newline-delimited JSON: a "data_points" frame once retrieval is done, one "answer" frame
+# per completion chunk, then a "thoughts" frame and a final "timings" frame. Errors after the response has started go
+# out as an "error" frame.
+def stream_response(frames, timings=None):
+    async def generate():
+        if timings:
+            metrics.bind(timings)
+        status = 200
+        try:
+            async for frame in frames:
+                yield json.dumps(frame) + "\n"
+        except Exception as e:
+            status = 500
+            logging.exception("Exception while streaming response")
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            if timings:
+                timings.finish(status)
+        if timings:
+            yield json.dumps({"timings": timings.to_dict()}) + "\n"
+
+    # Agents and long answers can stream for more than Quart's default RESPONSE_TIMEOUT of 60s, which would cut the response
+    # off without an error frame
+    response = Response(generate(), mimetype="application/x-ndjson")
+    response.timeout = None
+    return response
+
+
+async def ensure_openai_token():
+    # Only waits for a token if refreshing it in the background has been failing until it expired
+    if openai_tokens:
+        await openai_tokens.get()
 
 
 if __name__ == "__main__":
@@ -1,3 +1,59 @@
+import asyncio
+import contextvars
+import functools
+import time
+import openai
+import metrics
+from contextbuilder import for_deployment
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable
+
+# What a request gathers while it's being answered, e.g. the sources found by an agent's searches. Approaches are shared
+# by all the requests being answered concurrently, so they keep this in a context per request rather than on themselves
+class RequestContext:
+    def __init__(self, overrides: dict):
+        self.overrides = overrides
+        self.data_points: list[str] = []
+
+# LangChain agents are synchronous and block a thread while they wait for their searches, which run on the event loop.
+# They get threads of their own: in the loop's default executor they could take every thread, and leave none for the
+# work the searches themselves hand off to it (e.g. aiohttp's DNS lookups), which would then never finish.
+AGENT_THREADS = 32
+agent_executor = ThreadPoolExecutor(max_workers=AGENT_THREADS, thread_name_prefix="agent")
+
 class Approach:
-    def run(self, q: str, use_summaries: bool) -> any:
+    async def run(self, q: str, use_summaries: bool) -> any:
         raise NotImplementedError
+
+    async def run_stream(self, q: str, overrides: dict) -> AsyncIterator[dict]:
+        # Approaches that can't stream their completion send the whole result as a single set of frames
+        r = await self.run(q, overrides)
+        yield {"data_points": r["data_points"]}
+        yield {"answer": r["answer"]}
+        yield {"thoughts": r["thoughts"]}
+
+    async def run_agent(self, func: Callable, *args) -> any:
+        # Like asyncio.to_thread, the agent sees the request's context variables (e.g. its timings)
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(agent_executor, functools.partial(context.run, func, *args))
+
+    async def complete(self, args: dict):
+        # Completion with the arguments of openai.Completion.acreate, timed and with its tokens counted
+        with metrics.stage("completion"):
+            completion = await openai.Completion.acreate(**args)
+        metrics.count_usage(args["engine"], completion)
+        return completion
+
+    async def stream_completion(self, args: dict) -> AsyncIterator[str]:
+        # Text of a streamed completion as it's produced. Streamed completions don't report their usage, so the prompt is
+        # counted here and each chunk is counted as one token
+        tokens = 0
+        start = time.perf_counter()
+        with metrics.stage("completion"):
+            async for chunk in await openai.Completion.acreate(**args, stream=True):
+                if chunk.choices and chunk.choices[0].text:
+                    if tokens == 0:
+                        metrics.record_stage("completion_first_token", time.perf_counter() - start)
+                    tokens += 1
+                    yield chunk.choices[0].text
+        metrics.count_tokens(args["engine"], for_deployment(args["engine"]).count(args["prompt"]), tokens)
@@ -1,12 +1,28 @@
+import asyncio
+import re
 import openai
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
+import metrics
 from approaches.approach import Approach
+from retrieval import Retriever
+from contextbuilder import ContextBuilder, for_deployment
 from text import nonewlines
+from typing import AsyncIterator, Optional
+
+# Words that don't change what a search finds, ignored when comparing the question with the rewritten query
+STOP_WORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in", "is", "it",
+              "me", "my", "of", "on", "or", "the", "to", "was", "what", "when", "where", "which", "who", "why", "will", "with"}
+
+def query_terms(q: str) -> set[str]:
+    return {w for w in re.findall(r"\w+", q.lower()) if w not in STOP_WORDS}
 
 # Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
 # top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion 
 # (answer) with that prompt.
+#
+# In speculative mode, the search for the question as the user asked it runs at the same time as the completion that
+# rewrites it into a search query. If most of the rewritten query's words are in the question, its results are used
+# and the search for the rewritten query is skipped. On the first turn there's no history to resolve, so the question
+# is searched directly without a rewrite.
 class ChatReadRetrieveReadApproach(Approach):
     prompt_prefix = """<|im_start|>system
 Assistant helps the company employees with their healthcare plan questions, and questions about the employee handbook. Be brief in your answers.
@@ -41,74 +57,135 @@ Question:
 Search query:
 """
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, gpt_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    # Tokens reserved for the answer, and the most tokens of chat history sent with a prompt. The sources fill the
+    # rest of the model's context window
+    max_tokens = 1024
+    max_history_tokens = 1000
+
+    def __init__(self, retriever: Retriever, chatgpt_deployment: str, gpt_deployment: str, sourcepage_field: str, content_field: str,
+                 speculative: bool = False, speculative_min_overlap: float = 0.75):
+        self.retriever = retriever
         self.chatgpt_deployment = chatgpt_deployment
         self.gpt_deployment = gpt_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.speculative = speculative
+        self.speculative_min_overlap = speculative_min_overlap
 
-    def run(self, history: list[dict], overrides: dict) -> any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+    async def run(self, history: list[dict], overrides: dict) -> any:
+        q, sources = await self.search(history, overrides)
+        with metrics.stage("prompt"):
+            prompt, results = self.build_prompt(history, sources, overrides)
+
+        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
+        completion = await self.complete(self.completion_args(prompt, overrides))
+
+        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": self.thoughts(q, prompt)}
+
+    async def run_stream(self, history: list[dict], overrides: dict) -> AsyncIterator[dict]:
+        q, sources = await self.search(history, overrides)
+        with metrics.stage("prompt"):
+            prompt, results = self.build_prompt(history, sources, overrides)
+        yield {"data_points": results}
+
+        # STEP 3: Same as run, but forward the answer as the completion produces it
+        async for text in self.stream_completion(self.completion_args(prompt, overrides)):
+            yield {"answer": text}
+        yield {"thoughts": self.thoughts(q, prompt)}
 
+    async def search(self, history: list[dict], overrides: dict) -> tuple[str, list[tuple[str, str]]]:
+        # STEPS 1 and 2, returns the query that was searched for and its results
+        if not self.speculative:
+            q = await self.get_search_query(history)
+            return q, await self.retrieve(q, overrides)
+
+        question = history[-1]["user"]
+        if len(history) == 1:
+            return question, await self.retrieve(question, overrides)
+
+        speculative = asyncio.ensure_future(self.retrieve(question, overrides))
+        try:
+            q = await self.get_search_query(history)
+        except BaseException:
+            speculative.cancel()
+            raise
+        terms = query_terms(q)
+        if not terms or len(terms & query_terms(question)) / len(terms) >= self.speculative_min_overlap:
+            metrics.cache_lookup("speculative_search", "hit")
+            return question, await speculative
+        # The rewrite brought in context from the history, search again with it. The speculative search isn't waited
+        # for but still completes (and is cached) in the Retriever
+        metrics.cache_lookup("speculative_search", "miss")
+        speculative.cancel()
+        return q, await self.retrieve(q, overrides)
+
+    async def get_search_query(self, history: list[dict]) -> str:
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        prompt = self.query_prompt_template.format(chat_history=self.get_chat_history_as_text(history, include_last_turn=False), question=history[-1]["user"])
-        completion = openai.Completion.create(
-            engine=self.gpt_deployment, 
-            prompt=prompt, 
-            temperature=0.0, 
-            max_tokens=32, 
-            n=1, 
-            stop=["\n"])
-        q = completion.choices[0].text
+        chat_history = self.get_chat_history_as_text(history, include_last_turn=False, context=for_deployment(self.gpt_deployment))
+        prompt = self.query_prompt_template.format(chat_history=chat_history, question=history[-1]["user"])
+        with metrics.stage("rewrite"):
+            completion = await openai.Completion.acreate(
+                engine=self.gpt_deployment, 
+                prompt=prompt, 
+                temperature=0.0, 
+                max_tokens=32, 
+                n=1, 
+                stop=["\n"])
+        metrics.count_usage(self.gpt_deployment, completion)
+        return completion.choices[0].text
 
+    async def retrieve(self, q: str, overrides: dict) -> list[tuple[str, str]]:
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
-        content = "\n".join(results)
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        docs = await self.retriever.retrieve(q, overrides)
+        # Captions only come with the semantic ranker, sections without any are sent whole
+        return [(doc[self.sourcepage_field], nonewlines(" . ".join(doc['@search.captions']) if use_semantic_captions and doc['@search.captions'] else doc[self.content_field])) for doc in docs]
 
+    def build_prompt(self, history: list[dict], sources: list[tuple[str, str]], overrides: dict) -> tuple[str, list[str]]:
+        # Returns the prompt and the sources that fit in it, in rank order
+        context = for_deployment(self.chatgpt_deployment)
+        chat_history = self.get_chat_history_as_text(history, max_tokens=self.max_history_tokens, context=context)
         follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
         
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
         prompt_override = overrides.get("prompt_template")
-        if prompt_override is None:
-            prompt = self.prompt_prefix.format(injected_prompt="", sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
-        elif prompt_override.startswith(">>>"):
-            prompt = self.prompt_prefix.format(injected_prompt=prompt_override[3:] + "\n", sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
-        else:
-            prompt = prompt_override.format(sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
+        def format_prompt(content: str) -> str:
+            if prompt_override is None:
+                return self.prompt_prefix.format(injected_prompt="", sources=content, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
+            elif prompt_override.startswith(">>>"):
+                return self.prompt_prefix.format(injected_prompt=prompt_override[3:] + "\n", sources=content, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
+            else:
+                return prompt_override.format(sources=content, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
 
-        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-        completion = openai.Completion.create(
+        results = context.fit_sources(sources, context.budget(format_prompt(""), self.max_tokens))
+        return format_prompt("\n".join(results)), results
+
+    def completion_args(self, prompt: str, overrides: dict) -> dict:
+        return dict(
             engine=self.chatgpt_deployment, 
             prompt=prompt, 
             temperature=overrides.get("temperature") or 0.7, 
-            max_tokens=1024, 
+            max_tokens=self.max_tokens, 
             n=1, 
             stop=["<|im_end|>", "<|im_start|>"])
 
-        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+    def thoughts(self, q: str, prompt: str) -> str:
+        return f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')
     
-    def get_chat_history_as_text(self, history, include_last_turn=True, approx_max_tokens=1000) -> str:
-        history_text = ""
-        for h in reversed(history if include_last_turn else history[:-1]):
-            history_text = """<|im_start|>user""" +"\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot") + """<|im_end|>""" if h.get("bot") else "") + "\n" + history_text
-            if len(history_text) > approx_max_tokens*4:
-                break    
-        return history_text
\ No newline at end of file
+    def get_chat_history_as_text(self, history, include_last_turn=True, max_tokens=1000, context: Optional[ContextBuilder] = None) -> str:
+        # Most recent turns that fit in max_tokens, the question being answered is always included. Answered turns keep
+        # their rendered text and token counts, so turns from a stored chat session are only rendered and counted once
+        context = context or for_deployment(self.chatgpt_deployment)
+        turns = history if include_last_turn else history[:-1]
+        for h in turns:
+            if h.get("bot") and "text" not in h:
+                h["text"] = self.render_turn(h)
+        counts = [(h.get("tokens") or {}).get(context.model) for h in turns]
+        kept = context.fit_history([h.get("text") or self.render_turn(h) for h in turns], max_tokens, keep_last=include_last_turn, counts=counts)
+        for h, count in zip(turns, counts):
+            if "text" in h and count is not None:
+                h.setdefault("tokens", {})[context.model] = count
+        return "".join(kept)
+
+    def render_turn(self, h: dict) -> str:
+        return """<|im_start|>user""" +"\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot") + """<|im_end|>""" if h.get("bot") else "") + "\n"
\ No newline at end of file
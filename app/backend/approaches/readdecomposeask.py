@@ -1,97 +1,195 @@
+import asyncio
+import re
 import openai
-from approaches.approach import Approach
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
+import metrics
+from approaches.approach import Approach, RequestContext
+from retrieval import Retriever
+from contextbuilder import for_deployment
+from langchain.llms.base import BaseLLM
 from langchain.prompts import PromptTemplate, BasePromptTemplate
 from langchain.callbacks.base import CallbackManager
+from langchain.chains import LLMChain
 from langchain.agents import Tool, AgentExecutor
 from langchain.agents.react.base import ReActDocstoreAgent
-from langchainadapters import HtmlCallbackHandler
+from langchainadapters import HtmlCallbackHandler, shared_llm
 from text import nonewlines
 from typing import List
 
+# What the answer completion says when its sources can't answer the question
+INSUFFICIENT = "NOT ENOUGH INFORMATION"
+
+# Decomposes the question into searches and answers from their results. In planner mode (the default, or the "planner"
+# override), one completion lists all the searches the question needs, they run concurrently, and one more completion
+# answers from their combined results: 2 round trips to the model instead of one per search plus one to finish. Only
+# when the searches depend on each other's results, or their results turn out not to be enough, does it fall back to
+# the iterative ReAct agent, which decides on each search after seeing the results of the previous one.
 class ReadDecomposeAsk(Approach):
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    # Most tokens of sources returned by one search, the agent prompt grows with every observation
+    observation_tokens = 600
+
+    plan_prompt_template = """Below is a question that needs to be answered by searching in a knowledge base about employee healthcare plans and the employee handbook.
+List the searches needed to find all the facts the answer depends on, one per line starting with "Search: ". The searches run at the same time, so a question about several things (e.g. comparing them) needs one search for each.
+Use at most {max_searches} searches. If a search can only be written once the results of another one are known, answer only "Step by step" instead.
+
+Question: Compare the deductibles of Northwind Health Plus and Northwind Standard
+Searches:
+Search: Northwind Health Plus deductible
+Search: Northwind Standard deductible
+
+Question: Who is the manager of the employee that leads the onboarding training?
+Searches:
+Step by step
+
+Question: {q}
+Searches:
+"""
+
+    answer_prompt_template = \
+"You are an intelligent assistant helping Contoso Inc employees with their healthcare plan questions and employee handbook questions. " + \
+"Use 'you' to refer to the individual asking the questions even if they ask with 'I'. " + \
+"Answer the following question using only the data provided in the sources below, which were found by the searches listed with it. " + \
+"Each source has a name followed by colon and the actual information, always include the source name for each fact you use in the response, in square brackets, e.g. [info1.txt]. " + \
+"If the sources below are not enough to answer, answer only " + INSUFFICIENT + "." + \
+"""
+
+Question: '{q}'?
+
+Searches:
+{searches}
+
+Sources:
+{sources}
+
+Answer:
+"""
+
+    # Most searches a plan can run, and the tokens reserved for the answer
+    max_searches = 4
+    max_tokens = 1024
+
+    def __init__(self, retriever: Retriever, openai_deployment: str, sourcepage_field: str, content_field: str, planner: bool = True):
+        self.retriever = retriever
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.planner = planner
 
-    def search(self, q: str, overrides: dict) -> str:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) for doc in r]
-        else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) for doc in r]
-        return "\n".join(self.results)
-
-    def lookup(self, q: str) -> str:
-        r = self.search_client.search(q,
-                                      top = 1,
-                                      include_total_count=True,
-                                      query_type=QueryType.SEMANTIC, 
-                                      query_language="en-us", 
-                                      query_speller="lexicon", 
-                                      semantic_configuration_name="default",
-                                      query_answer="extractive|count-1",
-                                      query_caption="extractive|highlight-false")
-        
-        answers = r.get_answers()
-        if answers and len(answers) > 0:
-            return answers[0].text
-        if r.get_count() > 0:
-            return "\n".join(d['content'] for d in r)
+    async def search(self, q: str, context: RequestContext) -> str:
+        use_semantic_captions = True if context.overrides.get("semantic_captions") else False
+        docs = await self.retriever.retrieve(q, context.overrides)
+        # Captions only come with the semantic ranker, sections without any are sent whole
+        sources = [(doc[self.sourcepage_field], nonewlines(" . ".join(doc['@search.captions']) if use_semantic_captions and doc['@search.captions'] else doc[self.content_field])) for doc in docs]
+        context.data_points = for_deployment(self.openai_deployment).fit_sources(sources, self.observation_tokens, name_separator=":")
+        return "\n".join(context.data_points)
+
+    async def lookup(self, q: str) -> str:
+        r = await self.retriever.search(q, top=1, semantic_ranker=True, semantic_captions=True, answers=True)
+        if r["answers"]:
+            return r["answers"][0]
+        if r["docs"]:
+            return "\n".join(d['content'] for d in r["docs"])
         return None        
 
-    def run(self, q: str, overrides: dict) -> any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+    async def run(self, q: str, overrides: dict) -> any:
+        planner = overrides.get("planner")
+        if not (self.planner if planner is None else planner):
+            return await self.run_iterative(q, overrides)
+
+        searches = await self.plan(q)
+        if not searches:
+            r = await self.run_iterative(q, overrides)
+            return dict(r, thoughts="The searches depend on each other, searching step by step.<br><br>" + r["thoughts"])
+
+        r = await self.run_planned(q, searches, overrides)
+        if r["answer"].strip().strip(".").upper() != INSUFFICIENT:
+            return r
+        fallback = await self.run_iterative(q, overrides)
+        return dict(fallback, thoughts=r["thoughts"] + "<br><br>The planned searches were not enough, searching step by step.<br><br>" + fallback["thoughts"])
+
+    async def plan(self, q: str) -> list[str]:
+        # The searches for the question, or none if they have to be found one at a time
+        with metrics.stage("plan"):
+            completion = await openai.Completion.acreate(
+                engine=self.openai_deployment,
+                prompt=self.plan_prompt_template.format(q=q, max_searches=self.max_searches),
+                temperature=0.0,
+                max_tokens=200,
+                n=1,
+                stop=["\n\n", "\nQuestion:"])
+        metrics.count_usage(self.openai_deployment, completion)
+        searches = []
+        for line in completion.choices[0].text.splitlines():
+            m = re.match(r"\s*Search:\s*(.+)", line)
+            if m and m.group(1).strip() not in searches:
+                searches.append(m.group(1).strip())
+        return searches[:self.max_searches]
+
+    async def run_planned(self, q: str, searches: list[str], overrides: dict) -> dict:
+        results = await asyncio.gather(*(self.retriever.retrieve(s, overrides) for s in searches))
+        # Interleave the results so each search keeps its best sources if they don't all fit, and drop repeats
+        docs, seen = [], set()
+        for rank in range(max(len(r) for r in results)):
+            for r in results:
+                key = (r[rank][self.sourcepage_field], r[rank][self.content_field]) if rank < len(r) else None
+                if key and key not in seen:
+                    seen.add(key)
+                    docs.append(r[rank])
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        # Captions only come with the semantic ranker, sections without any are sent whole
+        sources = [(doc[self.sourcepage_field], nonewlines(" . ".join(doc['@search.captions']) if use_semantic_captions and doc['@search.captions'] else doc[self.content_field])) for doc in docs]
+
+        context = for_deployment(self.openai_deployment)
+        with metrics.stage("prompt"):
+            data_points = context.fit_sources(sources, context.budget(self.build_answer_prompt(q, searches, []), self.max_tokens))
+        prompt = self.build_answer_prompt(q, searches, data_points)
+        completion = await self.complete(dict(
+            engine=self.openai_deployment,
+            prompt=prompt,
+            temperature=overrides.get("temperature") or 0.3,
+            max_tokens=self.max_tokens,
+            n=1,
+            stop=["\n"]))
+        thoughts = f"Question:<br>{q}<br><br>Searches:<br>" + "<br>".join(searches) + "<br><br>Prompt:<br>" + prompt.replace("\n", "<br>")
+        return {"data_points": data_points, "answer": completion.choices[0].text, "thoughts": thoughts}
+
+    def build_answer_prompt(self, q: str, searches: list[str], data_points: list[str]) -> str:
+        return self.answer_prompt_template.format(q=q, searches="\n".join(searches), sources="\n".join(data_points))
+
+    async def run_iterative(self, q: str, overrides: dict) -> dict:
+        context = RequestContext(overrides)
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
         cb_manager = CallbackManager(handlers=[cb_handler])
 
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
+        llm = shared_llm(self.openai_deployment, overrides.get("temperature") or 0.3)
+        # LangChain agents are synchronous, so the agent runs on a worker thread and hands searches back to the event loop
+        loop = asyncio.get_running_loop()
         tools = [
-            Tool(name="Search", func=lambda q: self.search(q, overrides)),
-            Tool(name="Lookup", func=self.lookup)
+            Tool(name="Search", func=lambda q: asyncio.run_coroutine_threadsafe(self.search(q, context), loop).result()),
+            Tool(name="Lookup", func=lambda q: asyncio.run_coroutine_threadsafe(self.lookup(q), loop).result())
         ]
 
-        # Like results above, not great to keep this as a global, will interfere with interleaving
-        global prompt
         prompt_prefix = overrides.get("prompt_template")
         prompt = PromptTemplate.from_examples(
             EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
 
-        agent = ReAct.from_llm_and_tools(llm, tools)
+        agent = ReAct.from_llm_tools_and_prompt(llm, tools, prompt)
         chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = chain.run(q)
+        with metrics.stage("agent"):
+            result = await self.run_agent(chain.run, q)
 
         # Fix up references to they look like what the frontend expects ([] instead of ()), need a better citation format since parentheses are so common
         result = result.replace("(", "[").replace(")", "]")
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": context.data_points, "answer": result, "thoughts": cb_handler.get_and_reset_log()}
     
 class ReAct(ReActDocstoreAgent):
+    # The prompt depends on the request's overrides, so each agent gets its own instead of the one from create_prompt
     @classmethod
-    def create_prompt(cls, tools: List[Tool]) -> BasePromptTemplate:
-        return prompt
+    def from_llm_tools_and_prompt(cls, llm: BaseLLM, tools: List[Tool], prompt: BasePromptTemplate) -> "ReAct":
+        cls._validate_tools(tools)
+        return cls(llm_chain=LLMChain(llm=llm, prompt=prompt), allowed_tools=[tool.name for tool in tools])
     
 # Modified version of langchain's ReAct prompt that includes instructions and examples for how to cite information sources
 EXAMPLES = [
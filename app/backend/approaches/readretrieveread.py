@@ -1,13 +1,12 @@
-import openai
-from approaches.approach import Approach
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
+import asyncio
+import metrics
+from approaches.approach import Approach, RequestContext
+from retrieval import Retriever
+from contextbuilder import for_deployment
 from langchain.callbacks.base import CallbackManager
 from langchain.chains import LLMChain
 from langchain.agents import Tool, ZeroShotAgent, AgentExecutor
-from langchain.llms.openai import AzureOpenAI
-from langchainadapters import HtmlCallbackHandler
+from langchainadapters import HtmlCallbackHandler, shared_llm
 from text import nonewlines
 from lookuptool import CsvLookupTool
 
@@ -39,45 +38,34 @@ Thought: {agent_scratchpad}"""
 
     CognitiveSearchToolDescription = "useful for searching the Microsoft employee benefits information such as healthcare plans, retirement plans, etc."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    # Most tokens of sources returned by one search, the agent prompt grows with every observation
+    observation_tokens = 400
+
+    def __init__(self, retriever: Retriever, openai_deployment: str, sourcepage_field: str, content_field: str):
+        self.retriever = retriever
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
 
-    def retrieve(self, q: str, overrides: dict) -> any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter, 
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) for doc in r]
-        content = "\n".join(self.results)
+    async def retrieve(self, q: str, context: RequestContext) -> any:
+        use_semantic_captions = True if context.overrides.get("semantic_captions") else False
+        docs = await self.retriever.retrieve(q, context.overrides)
+        # Captions only come with the semantic ranker, sections without any are sent whole
+        sources = [(doc[self.sourcepage_field], nonewlines(" -.- ".join(doc['@search.captions']) if use_semantic_captions and doc['@search.captions'] else doc[self.content_field])) for doc in docs]
+        context.data_points = for_deployment(self.openai_deployment).fit_sources(sources, self.observation_tokens, name_separator=":")
+        content = "\n".join(context.data_points)
         return content
         
-    def run(self, q: str, overrides: dict) -> any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+    async def run(self, q: str, overrides: dict) -> any:
+        context = RequestContext(overrides)
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
         cb_manager = CallbackManager(handlers=[cb_handler])
         
-        acs_tool = Tool(name = "CognitiveSearch", func = lambda q: self.retrieve(q, overrides), description = self.CognitiveSearchToolDescription)
+        # LangChain agents are synchronous, so the agent runs on a worker thread and hands searches back to the event loop
+        loop = asyncio.get_running_loop()
+        acs_tool = Tool(name = "CognitiveSearch", func = lambda q: asyncio.run_coroutine_threadsafe(self.retrieve(q, context), loop).result(), description = self.CognitiveSearchToolDescription)
         employee_tool = EmployeeInfoTool("Employee1")
         tools = [acs_tool, employee_tool]
 
@@ -86,19 +74,20 @@ Thought: {agent_scratchpad}"""
             prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
             suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
             input_variables = ["input", "agent_scratchpad"])
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
+        llm = shared_llm(self.openai_deployment, overrides.get("temperature") or 0.3)
         chain = LLMChain(llm = llm, prompt = prompt)
         agent_exec = AgentExecutor.from_agent_and_tools(
             agent = ZeroShotAgent(llm_chain = chain, tools = tools),
             tools = tools, 
             verbose = True, 
             callback_manager = cb_manager)
-        result = agent_exec.run(q)
+        with metrics.stage("agent"):
+            result = await self.run_agent(agent_exec.run, q)
                 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "")
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": context.data_points, "answer": result, "thoughts": cb_handler.get_and_reset_log()}
 
 class EmployeeInfoTool(CsvLookupTool):
     employee_name: str = ""
@@ -1,8 +1,10 @@
-import openai
+import metrics
 from approaches.approach import Approach
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
+from retrieval import Retriever
+from contextbuilder import for_deployment
 from text import nonewlines
+from responsecache import ResponseCache
+from typing import AsyncIterator, Optional
 
 # Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
 # top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion 
@@ -39,42 +41,80 @@ Sources:
 Answer:
 """
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    # Tokens reserved for the answer, the sources fill the rest of the model's context window
+    max_tokens = 1024
+
+    def __init__(self, retriever: Retriever, openai_deployment: str, sourcepage_field: str, content_field: str, response_cache: ResponseCache = None):
+        self.retriever = retriever
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.response_cache = response_cache
+
+    async def run(self, q: str, overrides: dict) -> any:
+        cached = await self.get_cached(q, overrides)
+        if cached:
+            return cached
+
+        results = await self.retrieve(q, overrides)
+        prompt = self.build_prompt(q, results, overrides)
+        completion = await self.complete(self.completion_args(prompt, overrides))
+
+        r = {"data_points": results, "answer": completion.choices[0].text, "thoughts": self.thoughts(q, prompt)}
+        if self.response_cache:
+            await self.response_cache.set(q, overrides, r)
+        return r
+
+    async def run_stream(self, q: str, overrides: dict) -> AsyncIterator[dict]:
+        cached = await self.get_cached(q, overrides)
+        if cached:
+            yield {"data_points": cached["data_points"]}
+            yield {"answer": cached["answer"]}
+            yield {"thoughts": cached["thoughts"]}
+            return
 
-    def run(self, q: str, overrides: dict) -> any:
+        # Send the sources as soon as we have them, then the answer as the completion produces it
+        results = await self.retrieve(q, overrides)
+        prompt = self.build_prompt(q, results, overrides)
+        yield {"data_points": results}
+        answer = ""
+        async for text in self.stream_completion(self.completion_args(prompt, overrides)):
+            answer += text
+            yield {"answer": text}
+        yield {"thoughts": self.thoughts(q, prompt)}
+
+        if self.response_cache:
+            await self.response_cache.set(q, overrides, {"data_points": results, "answer": answer, "thoughts": self.thoughts(q, prompt)})
+
+    async def get_cached(self, q: str, overrides: dict) -> Optional[dict]:
+        if not self.response_cache:
+            return None
+        r = await self.response_cache.get(q, overrides)
+        if r:
+            r = dict(r, thoughts="Answer served from the response cache.<br><br>" + r["thoughts"])
+        return r
+
+    async def retrieve(self, q: str, overrides: dict) -> list[str]:
         use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
+        docs = await self.retriever.retrieve(q, overrides)
+        # Captions only come with the semantic ranker, sections without any are sent whole
+        sources = [(doc[self.sourcepage_field], nonewlines(" . ".join(doc['@search.captions']) if use_semantic_captions and doc['@search.captions'] else doc[self.content_field])) for doc in docs]
+        context = for_deployment(self.openai_deployment)
+        with metrics.stage("prompt"):
+            return context.fit_sources(sources, context.budget(self.build_prompt(q, [], overrides), self.max_tokens))
+
+    def build_prompt(self, q: str, results: list[str], overrides: dict) -> str:
         content = "\n".join(results)
+        return (overrides.get("prompt_template") or self.template).format(q=q, retrieved=content)
 
-        prompt = (overrides.get("prompt_template") or self.template).format(q=q, retrieved=content)
-        completion = openai.Completion.create(
+    def completion_args(self, prompt: str, overrides: dict) -> dict:
+        return dict(
             engine=self.openai_deployment, 
             prompt=prompt, 
             temperature=overrides.get("temperature") or 0.3, 
-            max_tokens=1024, 
+            max_tokens=self.max_tokens, 
             n=1, 
             stop=["\n"])
 
-        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+    def thoughts(self, q: str, prompt: str) -> str:
+        return f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')
@@ -0,0 +1,67 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+# Small async key/value caches used by the backend. Values must be JSON serializable so the same code works
+# against the in-process cache and a shared Redis-compatible server.
+
+class InMemoryCache:
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self.entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def delete(self, key: str) -> None:
+        self.entries.pop(key, None)
+
+    async def clear(self) -> None:
+        self.entries.clear()
+
+# Shares entries between all the app instances pointing at the same server. Expiration is handled by Redis, and
+# LRU eviction by the server's maxmemory-policy (use allkeys-lru or volatile-lru).
+class RedisCache:
+    def __init__(self, url: str, ttl: float = 3600, prefix: str = "gptkb:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("The redis package is required to use a Redis cache, install it with 'pip install redis'")
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await self.client.set(self.prefix + key, json.dumps(value), ex=int(ttl or self.ttl))
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(self.prefix + key)
+
+    async def clear(self) -> None:
+        async for key in self.client.scan_iter(match=self.prefix + "*"):
+            await self.client.delete(key)
+
+def create_cache(url: Optional[str], max_entries: int = 1000, ttl: float = 3600, prefix: str = "gptkb:"):
+    if url and (url.startswith("redis://") or url.startswith("rediss://")):
+        return RedisCache(url, ttl=ttl, prefix=prefix)
+    return InMemoryCache(max_entries=max_entries, ttl=ttl)
@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Optional, Tuple
+from azure.storage.blob.aio import ContainerClient
+import metrics
+
+# Blobs served by /content, kept in a local directory of at most max_bytes with the least recently used ones evicted
+# first. A cached blob is served straight from disk without asking storage for revalidate_after seconds, after that its
+# ETag is checked (one small properties request) and it's downloaded again only if it changed. A blob that isn't cached
+# is streamed to the client in chunks as it downloads, and written to the cache at the same time. Requests for a blob
+# that is being downloaded wait for that download instead of starting another one.
+#
+# Each blob is stored as <sha256 of its name> with a .json file next to it holding its name, ETag, content type and
+# size, so the cache survives restarts.
+class CachedBlob:
+    def __init__(self, name: str, path: str, etag: str, content_type: str, size: int, checked: float = 0):
+        self.name = name
+        self.path = path
+        self.etag = etag
+        self.content_type = content_type
+        self.size = size
+        self.checked = checked
+
+class BlobDownload:
+    def __init__(self, etag: str, content_type: str, size: int, chunks: AsyncIterator[bytes], close: Optional[Callable[[], None]] = None):
+        self.etag = etag
+        self.content_type = content_type
+        self.size = size
+        self.chunks = chunks
+        self.close = close or (lambda: None)
+
+class BlobFileCache:
+    def __init__(self, container: ContainerClient, directory: str, max_bytes: int = 1024 * 1024 * 1024, revalidate_after: float = 300, fill_timeout: float = 120):
+        self.container = container
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.fill_timeout = fill_timeout
+        self.entries: OrderedDict[str, CachedBlob] = OrderedDict()
+        self.total = 0
+        self.filling: dict[str, asyncio.Future] = {}
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp") or name.endswith(".tmp.json"):
+                # Left behind by a download that was interrupted by a restart
+                self.remove_files(os.path.join(self.directory, name))
+                continue
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name[:-5])
+            try:
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    meta = json.load(f)
+                found.append((os.stat(path).st_mtime, CachedBlob(meta["name"], path, meta["etag"], meta["content_type"], meta["size"])))
+            except (OSError, ValueError, KeyError):
+                self.remove_files(path)
+        for _, entry in sorted(found, key=lambda f: f[0]):
+            self.entries[entry.name] = entry
+            self.total += entry.size
+        self.evict()
+
+    def path_for(self, name: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(name.encode("utf-8")).hexdigest())
+
+    async def open(self, name: str) -> Tuple[Optional[CachedBlob], Optional[BlobDownload]]:
+        # Returns either the cached blob, or a download of it that caches it once all its chunks have been read
+        filling = self.filling.get(name)
+        if filling:
+            try:
+                await asyncio.wait_for(asyncio.shield(filling), self.fill_timeout)
+            except asyncio.TimeoutError:
+                # The request filling the cache went away before it started reading the blob
+                if self.filling.get(name) is filling:
+                    self.release(name, filling, False)
+        entry = self.entries.get(name)
+        if entry and time.monotonic() - entry.checked > self.revalidate_after:
+            properties = await self.container.get_blob_client(name).get_blob_properties()
+            if properties.etag == entry.etag:
+                entry.checked = time.monotonic()
+            else:
+                self.remove(name)
+                entry = None
+        if entry:
+            self.entries.move_to_end(name)
+            os.utime(entry.path)
+            metrics.cache_lookup("content", "hit")
+            return entry, None
+        metrics.cache_lookup("content", "miss")
+
+        future = None
+        if name not in self.filling:
+            future = self.filling[name] = asyncio.get_running_loop().create_future()
+        try:
+            downloader = await self.container.get_blob_client(name).download_blob()
+        except BaseException:
+            self.release(name, future, False)
+            raise
+        properties = downloader.properties
+        content_type = properties.content_settings.content_type or "application/octet-stream"
+        if future is None or properties.size > self.max_bytes:
+            # Too large to cache, or another request is already caching it
+            self.release(name, future, False)
+            return None, BlobDownload(properties.etag, content_type, properties.size, downloader.chunks())
+        return None, BlobDownload(properties.etag, content_type, properties.size, self.fill(name, future, downloader, properties.etag, content_type, properties.size),
+                                  close=lambda: self.release(name, future, False))
+
+    async def fill(self, name: str, future: asyncio.Future, downloader, etag: str, content_type: str, size: int) -> AsyncIterator[bytes]:
+        path = self.path_for(name)
+        temp = f"{path}.{uuid.uuid4().hex}.tmp"
+        done = False
+        try:
+            with open(temp, "wb") as f:
+                async for chunk in downloader.chunks():
+                    await asyncio.to_thread(f.write, chunk)
+                    yield chunk
+            with open(temp + ".json", "w", encoding="utf-8") as f:
+                json.dump({"name": name, "etag": etag, "content_type": content_type, "size": size}, f)
+            self.remove(name)
+            os.replace(temp, path)
+            os.replace(temp + ".json", path + ".json")
+            self.entries[name] = CachedBlob(name, path, etag, content_type, size, checked=time.monotonic())
+            self.total += size
+            self.evict()
+            done = True
+        finally:
+            # Also runs when the client goes away mid-download, the partial file is dropped and waiting requests
+            # download the blob themselves
+            if not done:
+                self.remove_files(temp)
+            self.release(name, future, done)
+
+    def release(self, name: str, future: Optional[asyncio.Future], done: bool):
+        if future is None:
+            return
+        if self.filling.get(name) is future:
+            del self.filling[name]
+        if not future.done():
+            future.set_result(done)
+
+    def remove(self, name: str):
+        entry = self.entries.pop(name, None)
+        if entry:
+            self.total -= entry.size
+            self.remove_files(entry.path)
+
+    def remove_files(self, path: str):
+        for p in (path, path + ".json"):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logging.exception(f"Could not remove {p} from the content cache")
+
+    def evict(self):
+        while self.total > self.max_bytes and self.entries:
+            name, entry = self.entries.popitem(last=False)
+            self.total -= entry.size
+            self.remove_files(entry.path)
@@ -0,0 +1,158 @@
+import logging
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Per model: the tiktoken encoding and the context window in tokens, shared by the prompt and the completion
+MODELS = {
+    "text-davinci-002": ("p50k_base", 4097),
+    "text-davinci-003": ("p50k_base", 4097),
+    "gpt-35-turbo": ("cl100k_base", 4096),
+    "gpt-4": ("cl100k_base", 8192),
+    "gpt-4-32k": ("cl100k_base", 32768),
+}
+DEFAULT_MODEL = "gpt-35-turbo"
+
+# A source cut down to fewer tokens than this isn't worth including
+MIN_SOURCE_TOKENS = 32
+
+# Overlaps shorter than this between two sources are taken to be coincidences rather than the overlap prepdocs.py
+# leaves between consecutive sections
+MIN_OVERLAP_CHARS = 50
+
+_PIECE = re.compile(r"\w+|[^\w\s]|\s+")
+
+# Without the tiktoken files (they are downloaded on first use, so offline machines may not have them) tokens are
+# estimated from words and punctuation, erring on the side of too many tokens rather than too few
+class _EstimatingEncoding:
+    def count(self, text: str) -> int:
+        return sum(math.ceil(len(p) / 3) if p[0].isalnum() or p[0] == "_" else 1 for p in _PIECE.findall(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = 0
+        for m in _PIECE.finditer(text):
+            p = m.group()
+            tokens += math.ceil(len(p) / 3) if p[0].isalnum() or p[0] == "_" else 1
+            if tokens > max_tokens:
+                return text[:m.start()]
+        return text
+
+class _TiktokenEncoding:
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[:max_tokens], errors="ignore")
+
+_encodings = {}
+
+def _load_encoding(name: str):
+    if name not in _encodings:
+        try:
+            import tiktoken
+            _encodings[name] = _TiktokenEncoding(tiktoken.get_encoding(name))
+        except Exception as e:
+            logging.warning(f"Could not load the {name} tokenizer, prompt sizes will be estimated: {e}")
+            _encodings[name] = _EstimatingEncoding()
+    return _encodings[name]
+
+def overlap_length(a: str, b: str, min_overlap: int = MIN_OVERLAP_CHARS) -> int:
+    # Length of the longest end of a that b starts with, if at least min_overlap characters
+    if len(a) < min_overlap or len(b) < min_overlap:
+        return 0
+    probe = b[:min_overlap]
+    i = a.find(probe, max(0, len(a) - len(b)))
+    while i != -1:
+        if b.startswith(a[i:]):
+            return len(a) - i
+        i = a.find(probe, i + 1)
+    return 0
+
+def remove_overlaps(text: str, included: List[str], min_overlap: int = MIN_OVERLAP_CHARS) -> str:
+    # What's left of text once the parts it shares with the included texts (one contains the other, or the end of one
+    # is the start of the other, like consecutive sections of a document) are taken out
+    for other in included:
+        if len(text) >= min_overlap and text in other:
+            return ""
+        text = text[overlap_length(other, text, min_overlap):]
+        k = overlap_length(text, other, min_overlap)
+        if k:
+            text = text[:-k]
+    return text.strip()
+
+# Builds prompts that fit the context window of a deployment's model, leaving room for the completion. Tokens are
+# counted with the model's own tokenizer. Sources are added in rank order until the budget runs out (the last one
+# possibly cut short), without repeating text already included from an overlapping section, and chat history keeps
+# the most recent turns that fit.
+class ContextBuilder:
+    def __init__(self, model: str = DEFAULT_MODEL, context_tokens: Optional[int] = None):
+        encoding_name, model_context_tokens = MODELS.get(model, MODELS[DEFAULT_MODEL])
+        self.model = model
+        self.context_tokens = context_tokens or model_context_tokens
+        self.encoding = _load_encoding(encoding_name)
+
+    def count(self, text: str) -> int:
+        return self.encoding.count(text)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        return self.encoding.truncate(text, max(0, max_tokens))
+
+    def budget(self, fixed_prompt: str, completion_tokens: int) -> int:
+        # Tokens left for sources and history once the rest of the prompt and the completion are accounted for
+        return max(0, self.context_tokens - completion_tokens - self.count(fixed_prompt))
+
+    def fit_sources(self, sources: List[Tuple[str, str]], max_tokens: int, name_separator: str = ": ", separator: str = "\n") -> List[str]:
+        results = []
+        included = []
+        remaining = max_tokens
+        for name, text in sources:
+            text = remove_overlaps(text, included)
+            if not text:
+                continue
+            prefix = name + name_separator
+            cost = self.count(prefix + text) + (self.count(separator) if results else 0)
+            if cost <= remaining:
+                results.append(prefix + text)
+                included.append(text)
+                remaining -= cost
+                continue
+            room = remaining - self.count(prefix) - (self.count(separator) if results else 0)
+            if room >= MIN_SOURCE_TOKENS:
+                results.append(prefix + self.truncate(text, room))
+            break
+        return results
+
+    def fit_history(self, turns: List[str], max_tokens: int, keep_last: bool = True, counts: Optional[List[Optional[int]]] = None) -> List[str]:
+        # Drops turns oldest first. With keep_last, the newest turn (the question being answered) is kept even if it
+        # doesn't fit by itself, so the caller should have reserved room for it. counts can hold the token counts of
+        # turns that were already counted, missing (None) counts of the turns looked at are filled in
+        kept = []
+        remaining = max_tokens
+        for i, turn in enumerate(reversed(turns)):
+            j = len(turns) - 1 - i
+            cost = counts[j] if counts is not None and counts[j] is not None else self.count(turn)
+            if counts is not None:
+                counts[j] = cost
+            if cost > remaining and not (keep_last and i == 0):
+                break
+            kept.append(turn)
+            remaining -= cost
+        return list(reversed(kept))
+
+_deployments: Dict[str, ContextBuilder] = {}
+
+# Called once at startup for each deployment, with the model it runs and optionally a smaller context window to use
+def configure_deployment(deployment: str, model: str, context_tokens: Optional[int] = None):
+    _deployments[deployment] = ContextBuilder(model, context_tokens)
+
+def for_deployment(deployment: str) -> ContextBuilder:
+    if deployment not in _deployments:
+        # Deployments named after their model need no configuration
+        _deployments[deployment] = ContextBuilder(deployment if deployment in MODELS else DEFAULT_MODEL)
+    return _deployments[deployment]
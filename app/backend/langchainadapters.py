@@ -1,13 +1,20 @@
+import threading
+import time
+from collections import OrderedDict
 from typing import Any, Dict, List, Optional
-from langchain.callbacks.base import BaseCallbackHandler
+import openai
+from langchain.callbacks.base import BaseCallbackHandler, CallbackManager
+from langchain.llms.openai import AzureOpenAI
 from langchain.schema import AgentAction, AgentFinish, LLMResult
+import metrics
 
 def ch(text: str) -> str:
     s = text if isinstance(text, str) else str(text)
     return s.replace("<", "&lt;").replace(">", "&gt;").replace("\r", "").replace("\n", "<br>")
 
 class HtmlCallbackHandler (BaseCallbackHandler):
-    html: str = ""
+    def __init__(self):
+        self.html = ""
 
     def get_and_reset_log(self) -> str:
         result = self.html
@@ -80,3 +87,82 @@ class HtmlCallbackHandler (BaseCallbackHandler):
     ) -> None:
         """Run on agent end."""
         self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+
+# Times the completions an agent makes and counts their tokens, see metrics.py. LLMs are shared between requests, but
+# each agent runs on its own thread, so the start of the completion in progress is kept per thread
+class MetricsCallbackHandler (BaseCallbackHandler):
+    def __init__(self, deployment: str):
+        self.deployment = deployment
+        self.local = threading.local()
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> None:
+        self.local.started = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        started = getattr(self.local, "started", None)
+        if started is not None:
+            metrics.record_stage("completion", time.perf_counter() - started)
+            self.local.started = None
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        metrics.count_tokens(self.deployment, usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0)
+
+    def on_llm_error(self, error: Exception, **kwargs: Any) -> None:
+        self.local.started = None
+
+    def on_chain_start(
+        self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
+        pass
+
+    def on_chain_error(self, error: Exception, **kwargs: Any) -> None:
+        pass
+
+    def on_tool_start(
+        self, serialized: Dict[str, Any], action: AgentAction, **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_tool_end(self, output: str, **kwargs: Any) -> None:
+        pass
+
+    def on_tool_error(self, error: Exception, **kwargs: Any) -> None:
+        pass
+
+    def on_text(self, text: str, **kwargs: Any) -> None:
+        pass
+
+    def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> None:
+        pass
+
+_llms = OrderedDict()
+_api_key_lock = threading.Lock()
+
+def set_api_key(key: str):
+    # Creating an LLM writes the key it was given back to openai.api_key, so a new key must not be set in between
+    with _api_key_lock:
+        openai.api_key = key
+
+# LLMs only depend on the deployment and temperature, so they are created once and shared by all requests, and the
+# least recently used are dropped past max_llms. The OpenAI SDK reads the current key (kept fresh in the background by
+# app.py with set_api_key) when it sends each completion
+def shared_llm(deployment: str, temperature: float, max_llms: int = 32) -> AzureOpenAI:
+    key = (deployment, temperature)
+    with _api_key_lock:
+        llm = _llms.get(key)
+        if llm is not None:
+            _llms.move_to_end(key)
+            return llm
+        llm = _llms[key] = AzureOpenAI(deployment_name=deployment, temperature=temperature, openai_api_key=openai.api_key,
+                                       callback_manager=CallbackManager(handlers=[MetricsCallbackHandler(deployment)]))
+        while len(_llms) > max_llms:
+            _llms.popitem(last=False)
+    return llm
@@ -0,0 +1,415 @@
+import asyncio
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+# Local, in-process stand-in for the parts of the Azure Cognitive Search index the backend uses, so load tests,
+# offline development and small tenants don't need a search service. Keyword search is BM25 over an inverted index,
+# vector search is a brute-force cosine similarity scan over a NumPy array, and a query with both is merged with
+# reciprocal rank fusion like the service does. Only "field eq 'value'" / "field ne 'value'" filters joined with "and"
+# are supported. The semantic ranker isn't emulated: semantic queries are ranked with BM25, and captions and answers
+# are the sentences sharing the most words with the query.
+#
+# An index is a directory holding generations of the index files plus a CURRENT file naming the live one.
+# LocalIndexWriter (used by scripts/prepdocs.py --localindex) writes a whole new generation and then switches CURRENT,
+# so readers never see a half written index and pick up the new generation on their next query. The postings, document
+# lengths and vectors are .npy files that readers memory-map rather than load.
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+
+_TAG = re.compile(r"<[^>]+>")
+_WORD = re.compile(r"\w+")
+_SENTENCE = re.compile(r"[^.!?\n]+[.!?]?")
+_FILTER_CLAUSE = re.compile(r"\s*\(?\s*(\w+)\s+(eq|ne)\s+(?:'((?:[^']|'')*)'|null)\s*\)?\s*")
+_FILTER_AND = re.compile(r"and\b", re.IGNORECASE)
+
+def tokenize(text: str) -> List[str]:
+    # Tags from the table HTML prepdocs.py inlines are markup, not content
+    return _WORD.findall(_TAG.sub(" ", text or "").lower())
+
+def parse_filter(filter: Optional[str]) -> List[Tuple[str, str, Optional[str]]]:
+    clauses = []
+    pos = 0
+    while filter and pos < len(filter):
+        m = _FILTER_CLAUSE.match(filter, pos)
+        if not m:
+            raise ValueError(f"Unsupported filter for the local search index: {filter}")
+        value = m.group(3)
+        clauses.append((m.group(1), m.group(2), None if value is None else value.replace("''", "'")))
+        pos = m.end()
+        if pos < len(filter):
+            m = _FILTER_AND.match(filter, pos)
+            if not m:
+                raise ValueError(f"Unsupported filter for the local search index: {filter}")
+            pos = m.end()
+    return clauses
+
+def _load_array(path: str) -> np.ndarray:
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # Empty arrays can't be memory-mapped
+        return np.load(path)
+
+# Shaped like the caption and answer objects of the search SDK, which the Retriever reads .text from
+class LocalCaption:
+    def __init__(self, text: str, highlights: Optional[str] = None, key: Optional[str] = None, score: float = 0.0):
+        self.text = text
+        self.highlights = highlights
+        self.key = key
+        self.score = score
+
+    def __str__(self):
+        return self.text
+
+class LocalSearchResults:
+    def __init__(self, docs: List[dict], answers: Optional[List[LocalCaption]], count: int):
+        self.docs = docs
+        self.answers = answers
+        self.count = count
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for doc in self.docs:
+            yield doc
+
+    async def get_answers(self) -> Optional[List[LocalCaption]]:
+        return self.answers
+
+    async def get_count(self) -> int:
+        return self.count
+
+# One generation of an index, read-only
+class LocalIndex:
+    def __init__(self, directory: Optional[str]):
+        self.directory = directory
+        self.documents: List[dict] = []
+        self.vocabulary: Dict[str, int] = {}
+        self.vectors: Dict[str, np.ndarray] = {}
+        self.has_vector: Dict[str, np.ndarray] = {}
+        self.columns: Dict[str, np.ndarray] = {}
+        self.key_field = "id"
+        self.text_field = "content"
+        if directory is None:
+            self.term_offsets = np.zeros(1, dtype=np.int64)
+            self.posting_docs = np.zeros(0, dtype=np.int32)
+            self.posting_freqs = np.zeros(0, dtype=np.float32)
+            self.length_norms = np.zeros(0, dtype=np.float32)
+            return
+
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.key_field = meta["key_field"]
+        self.text_field = meta["text_field"]
+        with open(os.path.join(directory, "documents.jsonl"), encoding="utf-8") as f:
+            self.documents = [json.loads(line) for line in f]
+        with open(os.path.join(directory, "vocabulary.json"), encoding="utf-8") as f:
+            self.vocabulary = {term: i for i, term in enumerate(json.load(f))}
+        self.term_offsets = _load_array(os.path.join(directory, "term_offsets.npy"))
+        self.posting_docs = _load_array(os.path.join(directory, "posting_docs.npy"))
+        self.posting_freqs = _load_array(os.path.join(directory, "posting_freqs.npy"))
+        doc_lengths = np.asarray(_load_array(os.path.join(directory, "doc_lengths.npy")), dtype=np.float32)
+        average_length = float(doc_lengths.mean()) if len(doc_lengths) else 1.0
+        self.length_norms = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / max(average_length, 1.0))
+        for field in meta["vector_fields"]:
+            self.vectors[field] = _load_array(os.path.join(directory, f"vectors-{field}.npy"))
+            self.has_vector[field] = _load_array(os.path.join(directory, f"has-{field}.npy"))
+
+    def column(self, field: str) -> np.ndarray:
+        # Filters compare whole columns at once, built the first time a field is filtered on
+        if field not in self.columns:
+            column = np.empty(len(self.documents), dtype=object)
+            column[:] = [d.get(field) for d in self.documents]
+            self.columns[field] = column
+        return self.columns[field]
+
+    def filter_mask(self, filter: Optional[str]) -> Optional[np.ndarray]:
+        mask = None
+        for field, op, value in parse_filter(filter):
+            matches = self.column(field) == value
+            clause = matches if op == "eq" else ~matches
+            mask = clause if mask is None else mask & clause
+        return mask
+
+    def text_scores(self, terms: List[str]) -> np.ndarray:
+        n = len(self.documents)
+        scores = np.zeros(n, dtype=np.float32)
+        for term, query_freq in Counter(terms).items():
+            i = self.vocabulary.get(term)
+            if i is None:
+                continue
+            start, end = int(self.term_offsets[i]), int(self.term_offsets[i + 1])
+            docs = self.posting_docs[start:end]
+            freqs = self.posting_freqs[start:end]
+            idf = self.idf(term)
+            scores[docs] += query_freq * idf * freqs * (BM25_K1 + 1) / (freqs + self.length_norms[docs])
+        return scores
+
+    def idf(self, term: str) -> float:
+        i = self.vocabulary.get(term)
+        if i is None:
+            return 0.0
+        df = int(self.term_offsets[i + 1] - self.term_offsets[i])
+        return math.log(1 + (len(self.documents) - df + 0.5) / (df + 0.5))
+
+    def vector_scores(self, vector: List[float], field: str) -> Tuple[np.ndarray, np.ndarray]:
+        if field not in self.vectors:
+            raise ValueError(f"The local search index has no vector field '{field}'")
+        q = np.asarray(vector, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1.0)
+        return np.asarray(self.vectors[field] @ q), np.asarray(self.has_vector[field])
+
+    def search(self, search_text: Optional[str], filter: Optional[str] = None, top: Optional[int] = None,
+               vector: Optional[List[float]] = None, top_k: Optional[int] = None, vector_fields: Optional[str] = None,
+               captions: bool = False, answers: int = 0) -> LocalSearchResults:
+        top = top or 50
+        if not self.documents:
+            return LocalSearchResults([], [] if answers else None, 0)
+        mask = self.filter_mask(filter)
+        terms = tokenize(search_text) if search_text and search_text != "*" else []
+
+        rankings = []
+        if terms:
+            scores = self.text_scores(terms)
+            matched = scores > 0
+            rankings.append(self.rank(scores, matched if mask is None else matched & mask, top))
+        if vector is not None:
+            scores, has_vector = self.vector_scores(vector, (vector_fields or "embedding").split(",")[0].strip())
+            rankings.append(self.rank(scores, has_vector if mask is None else has_vector & mask, min(top, top_k or top)))
+        if not rankings:
+            # Empty queries match every document that passes the filter, in index order
+            rows = np.arange(len(self.documents)) if mask is None else np.flatnonzero(mask)
+            rankings.append([(int(i), 1.0) for i in rows[:top]])
+
+        ranked = rankings[0] if len(rankings) == 1 else self.fuse(rankings)[:top]
+        docs = []
+        for i, score in ranked:
+            doc = dict(self.documents[i])
+            doc["@search.score"] = score
+            doc["@search.captions"] = [self.best_sentence(doc, terms)] if captions and terms else None
+            docs.append(doc)
+        return LocalSearchResults(docs, self.answers(docs, terms, answers) if answers else None, len(docs))
+
+    def rank(self, scores: np.ndarray, candidates: np.ndarray, top: int) -> List[Tuple[int, float]]:
+        rows = np.flatnonzero(candidates)
+        if top <= 0:
+            return []
+        if len(rows) > top:
+            rows = rows[np.argpartition(-scores[rows], top - 1)[:top]]
+        # Ties keep index order so results are stable between runs
+        rows = rows[np.lexsort((rows, -scores[rows]))]
+        return [(int(i), float(scores[i])) for i in rows]
+
+    def fuse(self, rankings: List[List[Tuple[int, float]]]) -> List[Tuple[int, float]]:
+        fused = {}
+        for ranking in rankings:
+            for rank, (i, _) in enumerate(ranking):
+                fused[i] = fused.get(i, 0.0) + 1 / (RRF_K + rank + 1)
+        return sorted(fused.items(), key=lambda item: (-item[1], item[0]))
+
+    def best_sentence(self, doc: dict, terms: List[str]) -> LocalCaption:
+        # The sentence whose query words weigh the most, rare words counting for more than common ones
+        weights = {term: self.idf(term) for term in set(terms)}
+        best, best_score = "", -1.0
+        for m in _SENTENCE.finditer(_TAG.sub(" ", doc.get(self.text_field) or "")):
+            sentence = m.group().strip()
+            score = sum(weights.get(term, 0.0) for term in set(tokenize(sentence)))
+            if sentence and score > best_score:
+                best, best_score = sentence, score
+        return LocalCaption(best, key=doc.get(self.key_field), score=max(best_score, 0.0))
+
+    def answers(self, docs: List[dict], terms: List[str], count: int) -> List[LocalCaption]:
+        # Only sentences holding at least half of the weight of the query words count as answers
+        needed = sum(self.idf(term) for term in set(terms)) / 2
+        found = [caption for caption in (self.best_sentence(doc, terms) for doc in docs) if caption.score > 0 and caption.score >= needed]
+        found.sort(key=lambda caption: -caption.score)
+        return found[:count]
+
+def _current_generation(path: str) -> Optional[str]:
+    try:
+        with open(os.path.join(path, "CURRENT"), encoding="utf-8") as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return name or None
+
+# Async drop-in for the subset of azure.search.documents.aio.SearchClient the backend uses. Queries run on a worker
+# thread so a large index doesn't block the event loop, and a new generation written by prepdocs.py is picked up at
+# most reload_interval seconds after it's published.
+class LocalSearchClient:
+    def __init__(self, path: str, reload_interval: float = 1.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.generation = None
+        self.index = LocalIndex(None)
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def current(self) -> LocalIndex:
+        with self.lock:
+            if time.monotonic() - self.checked > self.reload_interval:
+                generation = _current_generation(self.path)
+                if generation != self.generation:
+                    self.index = LocalIndex(os.path.join(self.path, generation) if generation else None)
+                    self.generation = generation
+                self.checked = time.monotonic()
+            return self.index
+
+    async def get_version(self) -> str:
+        return await asyncio.to_thread(lambda: _current_generation(self.path) or "")
+
+    async def search(self, search_text: Optional[str], filter: Optional[str] = None, top: Optional[int] = None,
+                     query_caption: Optional[str] = None, query_answer: Optional[str] = None,
+                     vector: Optional[List[float]] = None, top_k: Optional[int] = None, vector_fields: Optional[str] = None,
+                     **kwargs) -> LocalSearchResults:
+        # query_type, query_language, query_speller, semantic_configuration_name and select are accepted and ignored
+        answers = 0
+        if query_answer:
+            m = re.search(r"count-(\d+)", query_answer)
+            answers = int(m.group(1)) if m else 1
+        return await asyncio.to_thread(lambda: self.current().search(search_text, filter=filter, top=top, vector=vector, top_k=top_k,
+                                                                      vector_fields=vector_fields, captions=bool(query_caption), answers=answers))
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+# Builds local indexes. Documents are kept in memory, keyed like the search index, and save() writes them all out as
+# a new generation. upload() and throughput() match prepdocslib's IndexWriter so prepdocs.py can use either.
+class LocalIndexWriter:
+    def __init__(self, path: str, key_field: str = "id", text_field: str = "content", vector_fields: Iterable[str] = ("embedding",),
+                 keep_generations: int = 2, verbose: bool = False):
+        self.path = path
+        self.key_field = key_field
+        self.text_field = text_field
+        self.vector_fields = list(vector_fields)
+        self.keep_generations = max(2, keep_generations)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.documents: Dict[str, dict] = {}
+        self.count = 0
+        self.started = None
+        self.finished = None
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    def load(self):
+        generation = _current_generation(self.path)
+        if generation is None:
+            return
+        index = LocalIndex(os.path.join(self.path, generation))
+        for i, doc in enumerate(index.documents):
+            doc = dict(doc)
+            for field, vectors in index.vectors.items():
+                if index.has_vector[field][i]:
+                    doc[field] = np.array(vectors[i])
+            self.documents[doc[self.key_field]] = doc
+
+    def upload(self, documents: Iterable[dict]) -> List[str]:
+        with self.lock:
+            self.started = self.started or time.time()
+            for doc in documents:
+                doc = dict(doc)
+                for field in self.vector_fields:
+                    if doc.get(field) is not None:
+                        doc[field] = np.asarray(doc[field], dtype=np.float32)
+                self.documents[doc[self.key_field]] = doc
+                self.count += 1
+            self.finished = time.time()
+        return []
+
+    def delete(self, keys: Iterable[str]) -> int:
+        with self.lock:
+            return sum(1 for key in keys if self.documents.pop(key, None) is not None)
+
+    def delete_where(self, field: Optional[str] = None, value: Optional[str] = None) -> int:
+        # Deletes the documents whose field equals value, or all documents when no field is given
+        with self.lock:
+            keys = [key for key, doc in self.documents.items() if field is None or doc.get(field) == value]
+            for key in keys:
+                del self.documents[key]
+            return len(keys)
+
+    def throughput(self) -> str:
+        elapsed = max((self.finished or 0) - (self.started or 0), 1e-6)
+        return f"{self.count} sections in {elapsed:.1f}s ({self.count / elapsed:.1f} sections/s) into local index '{self.path}'"
+
+    def save(self) -> str:
+        with self.lock:
+            docs = [self.documents[key] for key in sorted(self.documents)]
+            generation = f"gen-{time.time_ns()}"
+            directory = os.path.join(self.path, generation)
+            os.makedirs(directory)
+
+            vocabulary = {}
+            term_ids, doc_ids, freqs = [], [], []
+            doc_lengths = np.zeros(len(docs), dtype=np.float32)
+            with open(os.path.join(directory, "documents.jsonl"), "w", encoding="utf-8") as f:
+                for i, doc in enumerate(docs):
+                    f.write(json.dumps({k: v for k, v in doc.items() if k not in self.vector_fields}) + "\n")
+                    counts = Counter(tokenize(doc.get(self.text_field)))
+                    doc_lengths[i] = sum(counts.values())
+                    for term, freq in counts.items():
+                        term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                        doc_ids.append(i)
+                        freqs.append(freq)
+
+            # Postings grouped by term (documents in index order within a term), with term_offsets[t]:term_offsets[t + 1]
+            # the slice holding term t
+            term_ids = np.asarray(term_ids, dtype=np.int64)
+            order = np.argsort(term_ids, kind="stable")
+            term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(term_ids, minlength=len(vocabulary)), out=term_offsets[1:])
+            np.save(os.path.join(directory, "term_offsets.npy"), term_offsets)
+            np.save(os.path.join(directory, "posting_docs.npy"), np.asarray(doc_ids, dtype=np.int32)[order])
+            np.save(os.path.join(directory, "posting_freqs.npy"), np.asarray(freqs, dtype=np.float32)[order])
+            np.save(os.path.join(directory, "doc_lengths.npy"), doc_lengths)
+            with open(os.path.join(directory, "vocabulary.json"), "w", encoding="utf-8") as f:
+                json.dump(list(vocabulary), f)
+
+            vector_fields = []
+            for field in self.vector_fields:
+                dimensions = {len(doc[field]) for doc in docs if doc.get(field) is not None}
+                if not dimensions:
+                    continue
+                if len(dimensions) > 1:
+                    raise ValueError(f"Vectors in field '{field}' have different sizes: {sorted(dimensions)}")
+                # Stored normalized, so cosine similarity is a dot product
+                vectors = np.zeros((len(docs), dimensions.pop()), dtype=np.float32)
+                has_vector = np.zeros(len(docs), dtype=bool)
+                for i, doc in enumerate(docs):
+                    if doc.get(field) is not None:
+                        vectors[i] = doc[field] / (np.linalg.norm(doc[field]) or 1.0)
+                        has_vector[i] = True
+                np.save(os.path.join(directory, f"vectors-{field}.npy"), vectors)
+                np.save(os.path.join(directory, f"has-{field}.npy"), has_vector)
+                vector_fields.append(field)
+
+            with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"count": len(docs), "key_field": self.key_field, "text_field": self.text_field, "vector_fields": vector_fields}, f)
+            with open(os.path.join(self.path, "CURRENT.tmp"), "w", encoding="utf-8") as f:
+                f.write(generation)
+            os.replace(os.path.join(self.path, "CURRENT.tmp"), os.path.join(self.path, "CURRENT"))
+            if self.verbose: print(f"Saved {len(docs)} sections, {len(vocabulary)} terms to local index '{self.path}' ({generation})")
+
+            # The previous generation is kept for readers that haven't switched yet
+            generations = sorted(name for name in os.listdir(self.path) if name.startswith("gen-"))
+            for name in generations[:-self.keep_generations]:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            return generation
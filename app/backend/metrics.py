@@ -0,0 +1,193 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# Latency, token and cache metrics for the backend, exposed in the Prometheus text format on /metrics. Each /ask and
+# /chat request also gets a RequestTimings with the time it spent in each stage (query rewrite, search, prompt, completion,
+# ...), its token counts and cache lookups, which is returned to the client in the response's "timings" block. Stages
+# that run concurrently (e.g. the speculative search and the query rewrite) are timed separately, so they can add up to
+# more than the total. Spans can also be exported with OpenTelemetry, see enable_opentelemetry.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds, from cache hits to long completions
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + ([extra] if extra else [])
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+# Stages also finish on the worker threads that run LangChain agents, hence the locks
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                # One count per bucket, then the sum and the count of all observations
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for values, series in self.series.items():
+                for bound, count in zip(self.buckets + ("+Inf",), series[:-2] + series[-1:]):
+                    le = 'le="{}"'.format(bound)
+                    lines.append(f"{self.name}_bucket{_labels(self.labels, values, le)} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, values)} {series[-2]}")
+                lines.append(f"{self.name}_count{_labels(self.labels, values)} {series[-1]}")
+        return lines
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float, *label_values: str):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            lines += [f"{self.name}{_labels(self.labels, values)} {value}" for values, value in self.series.items()]
+        return lines
+
+REQUEST_SECONDS = Histogram("gptkb_request_duration_seconds", "Time to answer a request, until the last frame of streamed answers.", ("route", "approach", "status"))
+STAGE_SECONDS = Histogram("gptkb_stage_duration_seconds", "Time spent in each stage of answering a request.", ("stage",))
+TOKENS = Counter("gptkb_tokens_total", "Tokens sent to (prompt) and generated by (completion) each OpenAI deployment.", ("deployment", "kind"))
+CACHE_LOOKUPS = Counter("gptkb_cache_lookups_total", "Cache lookups by result: hit, miss, or shared with an identical request in flight.", ("cache", "result"))
+
+METRICS = [REQUEST_SECONDS, STAGE_SECONDS, TOKENS, CACHE_LOOKUPS]
+
+def render() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+_tracer = None
+_trace = None
+
+# Exports a span per request with a child span per stage, to the OTLP endpoint configured with the standard
+# OTEL_EXPORTER_OTLP_* environment variables
+def enable_opentelemetry(service_name: str = "gptkb-backend"):
+    global _tracer, _trace
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        raise RuntimeError("The opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http packages are required to export traces, install them with 'pip install opentelemetry-sdk opentelemetry-exporter-otlp-proto-http'")
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _trace = trace
+    _tracer = trace.get_tracer("gptkb")
+
+class RequestTimings:
+    def __init__(self, route: str, approach: str):
+        self.route = route
+        self.approach = approach
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.tokens = {}
+        self.cache = {}
+        self.finished = None
+        self.span = _tracer.start_span(route, attributes={"approach": approach}) if _tracer else None
+
+    def start_span(self, name: str):
+        if self.span is None:
+            return None
+        return _tracer.start_span(name, context=_trace.set_span_in_context(self.span))
+
+    def finish(self, status: int = 200) -> dict:
+        # Returns the timings block for the response, only the first call is recorded
+        if self.finished is None:
+            self.finished = time.perf_counter()
+            REQUEST_SECONDS.observe(self.finished - self.started, self.route, self.approach, str(status))
+            if self.span is not None:
+                self.span.set_attribute("http.status_code", status)
+                self.span.end()
+        return self.to_dict()
+
+    def to_dict(self) -> dict:
+        return {
+            "total_ms": round(((self.finished or time.perf_counter()) - self.started) * 1000, 1),
+            "stages": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            "tokens": dict(self.tokens),
+            "cache": {name: dict(results) for name, results in self.cache.items()},
+        }
+
+# Tasks started while handling a request (and the threads running agents) copy the context, so they see the same timings
+_current: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar("request_timings", default=None)
+
+def start_request(route: str, approach: str) -> RequestTimings:
+    timings = RequestTimings(route, approach)
+    _current.set(timings)
+    return timings
+
+def bind(timings: RequestTimings):
+    # For streamed responses, whose frames may be produced outside the context of the request handler
+    _current.set(timings)
+
+def current() -> Optional[RequestTimings]:
+    return _current.get()
+
+@contextmanager
+def stage(name: str):
+    timings = _current.get()
+    span = timings.start_span(name) if timings else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start, timings)
+        if span is not None:
+            span.end()
+
+def record_stage(name: str, seconds: float, timings: Optional[RequestTimings] = None):
+    STAGE_SECONDS.observe(seconds, name)
+    timings = timings or _current.get()
+    if timings:
+        timings.stages[name] = timings.stages.get(name, 0) + seconds
+
+def count_tokens(deployment: str, prompt: int = 0, completion: int = 0):
+    timings = _current.get()
+    for kind, n in (("prompt", prompt), ("completion", completion)):
+        if n:
+            TOKENS.inc(n, deployment, kind)
+            if timings:
+                timings.tokens[kind] = timings.tokens.get(kind, 0) + n
+
+def count_usage(deployment: str, completion):
+    # Token counts reported with a (not streamed) completion
+    usage = completion.get("usage") if completion else None
+    if usage:
+        count_tokens(deployment, usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0)
+
+def cache_lookup(cache: str, result: str):
+    CACHE_LOOKUPS.inc(1, cache, result)
+    timings = _current.get()
+    if timings:
+        results = timings.cache.setdefault(cache, {})
+        results[result] = results.get(result, 0) + 1
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import re
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+import openai
+from retrieval import IndexVersion
+import metrics
+
+# Overrides that change the answer for a given question, so they need to be part of the cache key
+KEY_OVERRIDES = ["top", "retrieval_mode", "semantic_ranker", "semantic_captions", "exclude_category", "temperature", "prompt_template"]
+
+def normalize_question(q: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", "", q.lower()).split())
+
+# Caches complete answers so repeated questions skip both search and the completion. Lookups first try an exact match
+# on the normalized question and the relevant overrides. If an embedding deployment is configured, they then fall back
+# to the most similar previously answered question with the same overrides, as long as it's above similarity_threshold.
+# The embeddings used for similarity lookups are kept in this process even when the answers are in a shared cache.
+class ResponseCache:
+    def __init__(self, cache, embedding_deployment: Optional[str] = None, similarity_threshold: float = 0.95, max_similar_entries: int = 1000, index_version: Optional[IndexVersion] = None):
+        self.cache = cache
+        self.index_version = index_version
+        self.embedding_deployment = embedding_deployment
+        self.similarity_threshold = similarity_threshold
+        self.max_similar_entries = max_similar_entries
+        self.similar_entries = OrderedDict()
+        self.recent_embeddings = OrderedDict()
+
+    def overrides_key(self, overrides: dict) -> str:
+        return json.dumps({k: overrides.get(k) for k in KEY_OVERRIDES}, sort_keys=True)
+
+    async def version(self) -> str:
+        return await self.index_version.get() if self.index_version else ""
+
+    async def key(self, q: str, overrides: dict) -> str:
+        # Answers given before the index last changed are not reused
+        version = await self.version()
+        return "answer:" + hashlib.sha256((version + "\n" + normalize_question(q) + "\n" + self.overrides_key(overrides)).encode()).hexdigest()
+
+    async def get(self, q: str, overrides: dict) -> Optional[dict]:
+        r = await self.cache.get(await self.key(q, overrides))
+        if r is None and self.embedding_deployment:
+            similar_key = await self.find_similar(q, overrides)
+            if similar_key:
+                r = await self.cache.get(similar_key)
+        metrics.cache_lookup("response", "miss" if r is None else "hit")
+        return r
+
+    async def set(self, q: str, overrides: dict, response: dict) -> None:
+        key = await self.key(q, overrides)
+        await self.cache.set(key, response)
+        if self.embedding_deployment:
+            self.similar_entries[key] = (await self.version(), self.overrides_key(overrides), await self.embed(q))
+            while len(self.similar_entries) > self.max_similar_entries:
+                self.similar_entries.popitem(last=False)
+
+    async def find_similar(self, q: str, overrides: dict) -> Optional[str]:
+        # Only answers given since the index last changed, like exact lookups
+        version = await self.version()
+        overrides_key = self.overrides_key(overrides)
+        candidates = [(k, v) for k, (ver, o, v) in self.similar_entries.items() if ver == version and o == overrides_key]
+        if not candidates:
+            return None
+        similarities = np.array([v for _, v in candidates]) @ await self.embed(q)
+        best = int(np.argmax(similarities))
+        return candidates[best][0] if similarities[best] >= self.similarity_threshold else None
+
+    async def embed(self, q: str) -> np.ndarray:
+        # A miss embeds the question during the lookup and again when the answer is stored, remember recent ones
+        normalized = normalize_question(q)
+        v = self.recent_embeddings.get(normalized)
+        if v is None:
+            with metrics.stage("embed"):
+                r = await openai.Embedding.acreate(engine=self.embedding_deployment, input=normalized)
+            v = np.array(r["data"][0]["embedding"], dtype=np.float32)
+            v = v / np.linalg.norm(v)
+            self.recent_embeddings[normalized] = v
+            while len(self.recent_embeddings) > 100:
+                self.recent_embeddings.popitem(last=False)
+        return v
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from typing import Awaitable, Callable, Optional
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import QueryType
+from contextbuilder import overlap_length
+import metrics
+
+RETRIEVAL_MODES = ["text", "vector", "hybrid"]
+
+# Reciprocal rank fusion constant, the usual value from the original paper. Each list contributes 1 / (k + rank)
+RRF_K = 60
+
+# Sections are indexed with ids ending in their position in the source file (see create_sections in prepdocs.py)
+_SECTION_NUMBER = re.compile(r"-(\d+)$")
+
+def build_filter(overrides: dict) -> Optional[str]:
+    exclude_category = overrides.get("exclude_category") or None
+    return "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+
+# The indexing pipeline (prepdocs.py, DocIndexer, RemoveDoc) stamps the content container's metadata with a new
+# "indexversion" every time it writes to the index. Cache keys include the current version, so once a change is
+# noticed (at most check_interval seconds later) all previously cached results stop being used.
+class IndexVersion:
+    def __init__(self, source: Callable[[], Awaitable[str]], check_interval: float = 30):
+        self.source = source
+        self.check_interval = check_interval
+        self.version = ""
+        self.checked = 0
+        self.lock = asyncio.Lock()
+
+    async def get(self) -> str:
+        if time.monotonic() - self.checked > self.check_interval:
+            async with self.lock:
+                if time.monotonic() - self.checked > self.check_interval:
+                    try:
+                        self.version = await self.source()
+                    except Exception:
+                        logging.exception("Could not check the index version, cached results may be stale")
+                    self.checked = time.monotonic()
+        return self.version
+
+# Shared search front end for all the approaches. Results are converted to plain dicts (captions and answers as
+# text) so they can be cached, and identical searches share one request while it's in flight, whether they come
+# from the same agent run or from different users.
+#
+# Consecutive sections of a file overlap (prepdocs.py repeats the end of each section at the start of the next one), so
+# retrieve() merges sections that are next to each other in the same file into one span, placed at the rank of its
+# best section. To still return `top` results when sections were merged, it asks the search for twice as many.
+#
+# retrieval_mode picks between keyword search (text, optionally with the semantic ranker), vector search over the
+# embedding field (vector), or both merged with reciprocal rank fusion (hybrid). For hybrid, the query embedding and
+# the vector search run concurrently with the keyword search. Without an embed function, all modes fall back to text.
+class Retriever:
+    def __init__(self, search_client: SearchClient, cache = None, index_version: Optional[IndexVersion] = None,
+                 embed: Optional[Callable[[str], Awaitable[list[float]]]] = None, vector_field: str = "embedding", key_field: str = "id",
+                 content_field: str = "content", sourcepage_field: str = "sourcepage", sourcefile_field: str = "sourcefile", merge_sections: bool = True):
+        self.search_client = search_client
+        self.cache = cache
+        self.index_version = index_version
+        self.embed = embed
+        self.vector_field = vector_field
+        self.key_field = key_field
+        self.content_field = content_field
+        self.sourcepage_field = sourcepage_field
+        self.sourcefile_field = sourcefile_field
+        self.merge_sections = merge_sections
+        self.in_flight = {}
+
+    async def retrieve(self, q: str, overrides: dict, top: Optional[int] = None) -> list[dict]:
+        top = top or overrides.get("top") or 3
+        r = await self.search(q,
+                              filter=build_filter(overrides),
+                              top=top * 2 if self.merge_sections else top,
+                              semantic_ranker=bool(overrides.get("semantic_ranker")),
+                              semantic_captions=bool(overrides.get("semantic_captions")),
+                              retrieval_mode=overrides.get("retrieval_mode") or "text")
+        return self.merge(r["docs"])[:top] if self.merge_sections else r["docs"][:top]
+
+    async def search(self, q: str, filter: Optional[str] = None, top: int = 3, semantic_ranker: bool = False, semantic_captions: bool = False, answers: bool = False, retrieval_mode: str = "text") -> dict:
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval_mode '{retrieval_mode}', use one of {', '.join(RETRIEVAL_MODES)}")
+        if not self.embed:
+            retrieval_mode = "text"
+        options = {"filter": filter, "top": top, "semantic_ranker": semantic_ranker, "semantic_captions": semantic_captions and semantic_ranker, "answers": answers and semantic_ranker, "retrieval_mode": retrieval_mode}
+        with metrics.stage("search"):
+            key = await self.key(q, options)
+            if self.cache:
+                r = await self.cache.get(key)
+                if r is not None:
+                    metrics.cache_lookup("search", "hit")
+                    return r
+
+            task = self.in_flight.get(key)
+            if task is None:
+                metrics.cache_lookup("search", "miss")
+                task = asyncio.ensure_future(self.search_and_cache(key, q, options))
+                self.in_flight[key] = task
+                task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+            else:
+                metrics.cache_lookup("search", "shared")
+            # Shielded so a cancelled caller doesn't cancel the search for everyone else waiting on it
+            return await asyncio.shield(task)
+
+    async def key(self, q: str, options: dict) -> str:
+        version = await self.index_version.get() if self.index_version else ""
+        return "search:" + hashlib.sha256(json.dumps([version, q, options], sort_keys=True).encode()).hexdigest()
+
+    async def search_and_cache(self, key: str, q: str, options: dict) -> dict:
+        mode = options["retrieval_mode"]
+        if mode == "text":
+            result = await self.text_search(q, options, options["top"])
+        elif mode == "vector":
+            result = {"docs": await self.vector_search(q, options, options["top"]), "answers": []}
+        else:
+            # Each list is fetched deeper than top so documents ranked a little lower by one of them can still make it
+            candidates = options["top"] * 2
+            text_result, vector_docs = await asyncio.gather(self.text_search(q, options, candidates), self.vector_search(q, options, candidates))
+            result = {"docs": self.fuse([text_result["docs"], vector_docs])[:options["top"]], "answers": text_result["answers"]}
+
+        if self.cache:
+            await self.cache.set(key, result)
+        return result
+
+    async def text_search(self, q: str, options: dict, top: int) -> dict:
+        if options["semantic_ranker"]:
+            r = await self.search_client.search(q,
+                                                filter=options["filter"],
+                                                query_type=QueryType.SEMANTIC,
+                                                query_language="en-us",
+                                                query_speller="lexicon",
+                                                semantic_configuration_name="default",
+                                                top=top,
+                                                query_caption="extractive|highlight-false" if options["semantic_captions"] else None,
+                                                query_answer="extractive|count-1" if options["answers"] else None)
+        else:
+            r = await self.search_client.search(q, filter=options["filter"], top=top)
+
+        docs = [self.to_dict(doc) async for doc in r]
+        answers = await r.get_answers() if options["answers"] else None
+        return {"docs": docs, "answers": [a.text for a in answers or []]}
+
+    async def vector_search(self, q: str, options: dict, top: int) -> list[dict]:
+        with metrics.stage("embed"):
+            vector = await self.embed(q)
+        r = await self.search_client.search(None, filter=options["filter"], top=top, vector=vector, top_k=top, vector_fields=self.vector_field)
+        return [self.to_dict(doc) async for doc in r]
+
+    def to_dict(self, doc) -> dict:
+        doc = dict(doc)
+        doc["@search.captions"] = [c.text for c in doc.get("@search.captions") or []]
+        return doc
+
+    def merge(self, docs: list[dict]) -> list[dict]:
+        # Groups of sections from the same file with consecutive numbers, in the order of their best ranked section
+        groups = []
+        for doc in docs:
+            m = _SECTION_NUMBER.search(str(doc.get(self.key_field) or ""))
+            if not m or not doc.get(self.sourcefile_field):
+                groups.append({None: doc})
+                continue
+            n = int(m.group(1))
+            neighbors = [g for g in groups if None not in g and next(iter(g.values()))[self.sourcefile_field] == doc[self.sourcefile_field] and (n - 1 in g or n + 1 in g)]
+            if not neighbors:
+                groups.append({n: doc})
+                continue
+            # A section between two groups joins them, the earlier ranked group absorbs the later one
+            neighbors[0][n] = doc
+            for g in neighbors[1:]:
+                neighbors[0].update(g)
+                groups.remove(g)
+        return [self.merge_group(g) for g in groups]
+
+    def merge_group(self, group: dict) -> dict:
+        if len(group) == 1:
+            return next(iter(group.values()))
+        # Cached results are shared, so the merged section is a new dict. It keeps the id and score of the best ranked
+        # section, and the page of the first one
+        ranked = list(group.values())
+        sections = [group[n] for n in sorted(group)]
+        merged = dict(ranked[0])
+        content = sections[0].get(self.content_field) or ""
+        for section in sections[1:]:
+            text = section.get(self.content_field) or ""
+            k = overlap_length(content, text)
+            content += text[k:] if k else " " + text
+        merged[self.content_field] = content
+        merged[self.sourcepage_field] = sections[0].get(self.sourcepage_field)
+        merged["@search.captions"] = [c for section in ranked for c in section.get("@search.captions") or []]
+        return merged
+
+    def fuse(self, rankings: list[list[dict]]) -> list[dict]:
+        scores = {}
+        docs = {}
+        for ranking in rankings:
+            for rank, doc in enumerate(ranking):
+                key = doc.get(self.key_field)
+                scores[key] = scores.get(key, 0) + 1 / (RRF_K + rank + 1)
+                # Keep the copy from the keyword search, it's the one with captions
+                docs.setdefault(key, doc)
+        return [docs[key] for key in sorted(scores, key=lambda k: scores[k], reverse=True)]
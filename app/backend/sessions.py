@@ -0,0 +1,26 @@
+import secrets
+from typing import Optional
+
+# Chat conversations kept on the server, so the client only sends a session id and its new message instead of the whole
+# history. Sessions are stored in one of the caches from cache.py (in this process, or shared between instances through
+# Redis) and expire ttl seconds after their last turn. Turns are stored as the chat approach left them, which includes
+# their rendered ChatML and token counts, so earlier turns aren't rendered and counted again on every request.
+class ChatSessions:
+    def __init__(self, cache, max_turns: int = 50):
+        self.cache = cache
+        self.max_turns = max_turns
+
+    def new_id(self) -> str:
+        return secrets.token_urlsafe(16)
+
+    async def get(self, session_id: str) -> Optional[list[dict]]:
+        turns = await self.cache.get("session:" + session_id)
+        # Copies, the approach adds to the turns and the in-process cache holds the stored objects themselves
+        return None if turns is None else [dict(turn) for turn in turns]
+
+    async def save(self, session_id: str, turns: list[dict]) -> None:
+        # Turns older than max_turns would never fit in a prompt's history anyway
+        await self.cache.set("session:" + session_id, turns[-self.max_turns:])
+
+    async def delete(self, session_id: str) -> None:
+        await self.cache.delete("session:" + session_id)
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+from azure.core.credentials import AccessToken
+
+# Keeps an Azure AD token fresh in the background, so requests don't wait for one. The first token is fetched by
+# start(), after that the token is replaced refresh_margin seconds before it expires. A failed refresh is retried every
+# retry_interval seconds while the current token is still good, and only if it runs out does get() fetch a new one in
+# the request path. on_token receives each new token, e.g. to hand it to the OpenAI SDK.
+class TokenRefresher:
+    def __init__(self, credential, scope: str, on_token: Callable[[str], None] = lambda token: None, refresh_margin: float = 300, retry_interval: float = 10):
+        self.credential = credential
+        self.scope = scope
+        self.on_token = on_token
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.token: Optional[AccessToken] = None
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    async def start(self):
+        await self.refresh()
+        self.task = asyncio.create_task(self.refresh_forever())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def expired(self) -> bool:
+        return self.token is None or self.token.expires_on - 30 < time.time()
+
+    async def get(self) -> str:
+        if self.expired():
+            async with self.lock:
+                if self.expired():
+                    await self.refresh()
+        return self.token.token
+
+    async def refresh(self):
+        self.token = await self.credential.get_token(self.scope)
+        self.on_token(self.token.token)
+
+    async def refresh_forever(self):
+        while True:
+            await asyncio.sleep(max(self.retry_interval, self.token.expires_on - self.refresh_margin - time.time()))
+            try:
+                async with self.lock:
+                    await self.refresh()
+            except Exception:
+                logging.exception(f"Could not refresh the token for {self.scope}, retrying in {self.retry_interval} seconds")
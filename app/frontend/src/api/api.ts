@@ -1,25 +1,53 @@
 import { AskRequest, AskResponse, ChatRequest } from "./models";
 
+function askRequestBody(options: AskRequest, stream: boolean): string {
+    return JSON.stringify({
+        question: options.question,
+        approach: options.approach,
+        stream,
+        overrides: {
+            retrieval_mode: options.overrides?.retrievalMode,
+            semantic_ranker: options.overrides?.semanticRanker,
+            semantic_captions: options.overrides?.semanticCaptions,
+            top: options.overrides?.top,
+            temperature: options.overrides?.temperature,
+            prompt_template: options.overrides?.promptTemplate,
+            prompt_template_prefix: options.overrides?.promptTemplatePrefix,
+            prompt_template_suffix: options.overrides?.promptTemplateSuffix,
+            exclude_category: options.overrides?.excludeCategory
+        }
+    });
+}
+
+function chatRequestBody(options: ChatRequest, stream: boolean): string {
+    return JSON.stringify({
+        history: options.history,
+        message: options.message,
+        session_id: options.sessionId,
+        approach: options.approach,
+        stream,
+        overrides: {
+            retrieval_mode: options.overrides?.retrievalMode,
+            semantic_ranker: options.overrides?.semanticRanker,
+            semantic_captions: options.overrides?.semanticCaptions,
+            top: options.overrides?.top,
+            temperature: options.overrides?.temperature,
+            prompt_template: options.overrides?.promptTemplate,
+            prompt_template_prefix: options.overrides?.promptTemplatePrefix,
+            prompt_template_suffix: options.overrides?.promptTemplateSuffix,
+            exclude_category: options.overrides?.excludeCategory,
+            suggest_followup_questions: options.overrides?.suggestFollowupQuestions
+        }
+    });
+}
+
 export async function askApi(options: AskRequest): Promise<AskResponse> {
     const response = await fetch("/ask", {
         method: "POST",
         headers: {
             "Content-Type": "application/json"
         },
-        body: JSON.stringify({
-            question: options.question,
-            approach: options.approach,
-            overrides: {
-                semantic_ranker: options.overrides?.semanticRanker,
-                semantic_captions: options.overrides?.semanticCaptions,
-                top: options.overrides?.top,
-                temperature: options.overrides?.temperature,
-                prompt_template: options.overrides?.promptTemplate,
-                prompt_template_prefix: options.overrides?.promptTemplatePrefix,
-                prompt_template_suffix: options.overrides?.promptTemplateSuffix,
-                exclude_category: options.overrides?.excludeCategory
-            }
-        })
+        body: askRequestBody(options, false)
     });
 
     const parsedResponse: AskResponse = await response.json();
@@ -36,21 +64,7 @@ export async function chatApi(options: ChatRequest): Promise<AskResponse> {
         headers: {
             "Content-Type": "application/json"
         },
-        body: JSON.stringify({
-            history: options.history,
-            approach: options.approach,
-            overrides: {
-                semantic_ranker: options.overrides?.semanticRanker,
-                semantic_captions: options.overrides?.semanticCaptions,
-                top: options.overrides?.top,
-                temperature: options.overrides?.temperature,
-                prompt_template: options.overrides?.promptTemplate,
-                prompt_template_prefix: options.overrides?.promptTemplatePrefix,
-                prompt_template_suffix: options.overrides?.promptTemplateSuffix,
-                exclude_category: options.overrides?.excludeCategory,
-                suggest_followup_questions: options.overrides?.suggestFollowupQuestions
-            }
-        })
+        body: chatRequestBody(options, false)
     });
 
     const parsedResponse: AskResponse = await response.json();
@@ -61,6 +75,82 @@ export async function chatApi(options: ChatRequest): Promise<AskResponse> {
     return parsedResponse;
 }
 
+export async function askStreamApi(options: AskRequest, onUpdate: (partial: AskResponse) => void): Promise<AskResponse> {
+    const response = await fetch("/ask", {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json"
+        },
+        body: askRequestBody(options, true)
+    });
+
+    return readStreamedResponse(response, onUpdate);
+}
+
+export async function chatStreamApi(options: ChatRequest, onUpdate: (partial: AskResponse) => void): Promise<AskResponse> {
+    const response = await fetch("/chat", {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json"
+        },
+        body: chatRequestBody(options, true)
+    });
+
+    return readStreamedResponse(response, onUpdate);
+}
+
+// The backend streams newline-delimited JSON frames: the data points first, then the answer in pieces, then the thoughts
+// and the timings
+async function readStreamedResponse(response: Response, onUpdate: (partial: AskResponse) => void): Promise<AskResponse> {
+    if (response.status > 299 || !response.ok || !response.body) {
+        const parsedResponse: AskResponse = await response.json();
+        throw Error(parsedResponse.error || "Unknown error");
+    }
+
+    const result: AskResponse = { answer: "", thoughts: null, data_points: [] };
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+            break;
+        }
+
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split("\n");
+        buffer = lines.pop() || "";
+        for (const line of lines.filter(l => l.trim().length > 0)) {
+            const frame: Partial<AskResponse> = JSON.parse(line);
+            if (frame.error) {
+                throw Error(frame.error);
+            }
+            if (frame.session_id) {
+                result.session_id = frame.session_id;
+            }
+            if (frame.data_points) {
+                result.data_points = frame.data_points;
+            }
+            if (frame.answer) {
+                result.answer += frame.answer;
+            }
+            if (frame.thoughts) {
+                result.thoughts = frame.thoughts;
+            }
+            if (frame.timings) {
+                result.timings = frame.timings;
+            }
+            onUpdate({ ...result });
+        }
+    }
+
+    return result;
+}
+
+export async function deleteChatSessionApi(sessionId: string): Promise<void> {
+    await fetch(`/chat/${encodeURIComponent(sessionId)}`, { method: "DELETE" });
+}
+
 export function getCitationFilePath(citation: string): string {
     return `/content/${citation}`;
 }
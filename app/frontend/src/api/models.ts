@@ -4,7 +4,14 @@ export const enum Approaches {
     ReadDecomposeAsk = "rda"
 }
 
+export const enum RetrievalMode {
+    Text = "text",
+    Vectors = "vector",
+    Hybrid = "hybrid"
+}
+
 export type AskRequestOverrides = {
+    retrievalMode?: RetrievalMode;
     semanticRanker?: boolean;
     semanticCaptions?: boolean;
     excludeCategory?: string;
@@ -22,10 +29,20 @@ export type AskRequest = {
     overrides?: AskRequestOverrides;
 };
 
+// Time spent answering, in milliseconds per stage, with the tokens used and the cache lookups made
+export type Timings = {
+    total_ms: number;
+    stages: Record<string, number>;
+    tokens: Record<string, number>;
+    cache: Record<string, Record<string, number>>;
+};
+
 export type AskResponse = {
     answer: string;
     thoughts: string | null;
     data_points: string[];
+    session_id?: string;
+    timings?: Timings;
     error?: string;
 };
 
@@ -34,8 +51,11 @@ export type ChatTurn = {
     bot?: string;
 };
 
+// Either the whole history, or the new message and (after the first answer) the id of the server side chat session
 export type ChatRequest = {
-    history: ChatTurn[];
+    history?: ChatTurn[];
+    message?: string;
+    sessionId?: string;
     approach: Approaches;
     overrides?: AskRequestOverrides;
 };
@@ -1,10 +1,10 @@
 import { useRef, useState, useEffect } from "react";
-import { Checkbox, Panel, DefaultButton, TextField, SpinButton } from "@fluentui/react";
+import { Checkbox, Panel, DefaultButton, TextField, SpinButton, Dropdown, IDropdownOption } from "@fluentui/react";
 import { SparkleFilled } from "@fluentui/react-icons";
 
 import styles from "./Chat.module.css";
 
-import { chatApi, Approaches, AskResponse, ChatRequest, ChatTurn } from "../../api";
+import { chatApi, chatStreamApi, deleteChatSessionApi, Approaches, AskResponse, ChatRequest, RetrievalMode } from "../../api";
 import { Answer, AnswerError, AnswerLoading } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { ExampleList } from "../../components/Example";
@@ -17,12 +17,15 @@ const Chat = () => {
     const [isConfigPanelOpen, setIsConfigPanelOpen] = useState(false);
     const [promptTemplate, setPromptTemplate] = useState<string>("");
     const [retrieveCount, setRetrieveCount] = useState<number>(3);
+    const [retrievalMode, setRetrievalMode] = useState<RetrievalMode>(RetrievalMode.Text);
     const [useSemanticRanker, setUseSemanticRanker] = useState<boolean>(true);
     const [useSemanticCaptions, setUseSemanticCaptions] = useState<boolean>(false);
     const [excludeCategory, setExcludeCategory] = useState<string>("");
     const [useSuggestFollowupQuestions, setUseSuggestFollowupQuestions] = useState<boolean>(false);
+    const [shouldStream, setShouldStream] = useState<boolean>(true);
 
     const lastQuestionRef = useRef<string>("");
+    const sessionIdRef = useRef<string | undefined>(undefined);
     const chatMessageStreamEnd = useRef<HTMLDivElement | null>(null);
 
     const [isLoading, setIsLoading] = useState<boolean>(false);
@@ -34,6 +37,7 @@ const Chat = () => {
 
     const [selectedAnswer, setSelectedAnswer] = useState<number>(0);
     const [answers, setAnswers] = useState<[user: string, response: AskResponse][]>([]);
+    const [streamedAnswer, setStreamedAnswer] = useState<AskResponse>();
 
     const makeApiRequest = async (question: string) => {
         lastQuestionRef.current = question;
@@ -45,30 +49,36 @@ const Chat = () => {
         setActiveAnalysisPanelTab(undefined);
 
         try {
-            const history: ChatTurn[] = answers.map(a => ({ user: a[0], bot: a[1].answer }));
+            // The server keeps the history, only the new question is sent
             const request: ChatRequest = {
-                history: [...history, { user: question, bot: undefined }],
+                message: question,
+                sessionId: sessionIdRef.current,
                 approach: Approaches.ReadRetrieveRead,
                 overrides: {
                     promptTemplate: promptTemplate.length === 0 ? undefined : promptTemplate,
                     excludeCategory: excludeCategory.length === 0 ? undefined : excludeCategory,
                     top: retrieveCount,
+                    retrievalMode: retrievalMode,
                     semanticRanker: useSemanticRanker,
                     semanticCaptions: useSemanticCaptions,
                     suggestFollowupQuestions: useSuggestFollowupQuestions
                 }
             };
-            const result = await chatApi(request);
+            const result = shouldStream ? await chatStreamApi(request, setStreamedAnswer) : await chatApi(request);
+            sessionIdRef.current = result.session_id || sessionIdRef.current;
             setAnswers([...answers, [question, result]]);
         } catch (e) {
             setError(e);
         } finally {
             setIsLoading(false);
+            setStreamedAnswer(undefined);
         }
     };
 
     const clearChat = () => {
         lastQuestionRef.current = "";
+        sessionIdRef.current && deleteChatSessionApi(sessionIdRef.current);
+        sessionIdRef.current = undefined;
         error && setError(undefined);
         setActiveCitation(undefined);
         setActiveCitationPage(undefined);
@@ -76,7 +86,7 @@ const Chat = () => {
         setAnswers([]);
     };
 
-    useEffect(() => chatMessageStreamEnd.current?.scrollIntoView({ behavior: "smooth" }), [isLoading]);
+    useEffect(() => chatMessageStreamEnd.current?.scrollIntoView({ behavior: "smooth" }), [isLoading, streamedAnswer?.answer]);
 
     const onPromptTemplateChange = (_ev?: React.FormEvent<HTMLInputElement | HTMLTextAreaElement>, newValue?: string) => {
         setPromptTemplate(newValue || "");
@@ -86,6 +96,10 @@ const Chat = () => {
         setRetrieveCount(parseInt(newValue || "3"));
     };
 
+    const onRetrievalModeChange = (_ev: React.FormEvent<HTMLDivElement>, option?: IDropdownOption<RetrievalMode>) => {
+        setRetrievalMode(option?.data || RetrievalMode.Text);
+    };
+
     const onUseSemanticRankerChange = (_ev?: React.FormEvent<HTMLElement | HTMLInputElement>, checked?: boolean) => {
         setUseSemanticRanker(!!checked);
     };
@@ -102,6 +116,10 @@ const Chat = () => {
         setUseSuggestFollowupQuestions(!!checked);
     };
 
+    const onShouldStreamChange = (_ev?: React.FormEvent<HTMLElement | HTMLInputElement>, checked?: boolean) => {
+        setShouldStream(!!checked);
+    };
+
     const onExampleClicked = (example: string) => {
         makeApiRequest(example);
     };
@@ -169,7 +187,16 @@ const Chat = () => {
                                 <>
                                     <UserChatMessage message={lastQuestionRef.current} />
                                     <div className={styles.chatMessageGptMinWidth}>
-                                        <AnswerLoading />
+                                        {streamedAnswer?.answer ? (
+                                            <Answer
+                                                answer={streamedAnswer}
+                                                onCitationClicked={() => {}}
+                                                onThoughtProcessClicked={() => {}}
+                                                onSupportingContentClicked={() => {}}
+                                            />
+                                        ) : (
+                                            <AnswerLoading />
+                                        )}
                                     </div>
                                 </>
                             )}
@@ -233,6 +260,17 @@ const Chat = () => {
                         defaultValue={retrieveCount.toString()}
                         onChange={onRetrieveCountChange}
                     />
+                    <Dropdown
+                        className={styles.chatSettingsSeparator}
+                        label="Retrieval mode"
+                        options={[
+                            { key: "text", text: "Text", selected: retrievalMode === RetrievalMode.Text, data: RetrievalMode.Text },
+                            { key: "vector", text: "Vectors", selected: retrievalMode === RetrievalMode.Vectors, data: RetrievalMode.Vectors },
+                            { key: "hybrid", text: "Vectors + Text (Hybrid)", selected: retrievalMode === RetrievalMode.Hybrid, data: RetrievalMode.Hybrid }
+                        ]}
+                        required
+                        onChange={onRetrievalModeChange}
+                    />
                     <TextField className={styles.chatSettingsSeparator} label="Exclude category" onChange={onExcludeCategoryChanged} />
                     <Checkbox
                         className={styles.chatSettingsSeparator}
@@ -253,6 +291,12 @@ const Chat = () => {
                         label="Suggest follow-up questions"
                         onChange={onUseSuggestFollowupQuestionsChange}
                     />
+                    <Checkbox
+                        className={styles.chatSettingsSeparator}
+                        checked={shouldStream}
+                        label="Stream the answer as it is generated"
+                        onChange={onShouldStreamChange}
+                    />
                 </Panel>
             </div>
         </div>
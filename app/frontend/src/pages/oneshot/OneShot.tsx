@@ -1,9 +1,9 @@
 import { useRef, useState } from "react";
-import { Checkbox, ChoiceGroup, IChoiceGroupOption, Panel, DefaultButton, Spinner, TextField, SpinButton } from "@fluentui/react";
+import { Checkbox, ChoiceGroup, IChoiceGroupOption, Panel, DefaultButton, Spinner, TextField, SpinButton, Dropdown, IDropdownOption } from "@fluentui/react";
 
 import styles from "./OneShot.module.css";
 
-import { askApi, Approaches, AskResponse, AskRequest } from "../../api";
+import { askApi, askStreamApi, Approaches, AskResponse, AskRequest, RetrievalMode } from "../../api";
 import { Answer, AnswerError } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { ExampleList } from "../../components/Example";
@@ -17,15 +17,18 @@ const OneShot = () => {
     const [promptTemplatePrefix, setPromptTemplatePrefix] = useState<string>("");
     const [promptTemplateSuffix, setPromptTemplateSuffix] = useState<string>("");
     const [retrieveCount, setRetrieveCount] = useState<number>(3);
+    const [retrievalMode, setRetrievalMode] = useState<RetrievalMode>(RetrievalMode.Text);
     const [useSemanticRanker, setUseSemanticRanker] = useState<boolean>(true);
     const [useSemanticCaptions, setUseSemanticCaptions] = useState<boolean>(false);
     const [excludeCategory, setExcludeCategory] = useState<string>("");
+    const [shouldStream, setShouldStream] = useState<boolean>(true);
 
     const lastQuestionRef = useRef<string>("");
 
     const [isLoading, setIsLoading] = useState<boolean>(false);
     const [error, setError] = useState<unknown>();
     const [answer, setAnswer] = useState<AskResponse>();
+    const [streamedAnswer, setStreamedAnswer] = useState<AskResponse>();
 
     const [activeCitation, setActiveCitation] = useState<string>();
     const [activeCitationPage, setActiveCitationPage] = useState<number>();
@@ -50,16 +53,18 @@ const OneShot = () => {
                     promptTemplateSuffix: promptTemplateSuffix.length === 0 ? undefined : promptTemplateSuffix,
                     excludeCategory: excludeCategory.length === 0 ? undefined : excludeCategory,
                     top: retrieveCount,
+                    retrievalMode: retrievalMode,
                     semanticRanker: useSemanticRanker,
                     semanticCaptions: useSemanticCaptions
                 }
             };
-            const result = await askApi(request);
+            const result = shouldStream ? await askStreamApi(request, setStreamedAnswer) : await askApi(request);
             setAnswer(result);
         } catch (e) {
             setError(e);
         } finally {
             setIsLoading(false);
+            setStreamedAnswer(undefined);
         }
     };
 
@@ -83,6 +88,10 @@ const OneShot = () => {
         setApproach((option?.key as Approaches) || Approaches.RetrieveThenRead);
     };
 
+    const onRetrievalModeChange = (_ev: React.FormEvent<HTMLDivElement>, option?: IDropdownOption<RetrievalMode>) => {
+        setRetrievalMode(option?.data || RetrievalMode.Text);
+    };
+
     const onUseSemanticRankerChange = (_ev?: React.FormEvent<HTMLElement | HTMLInputElement>, checked?: boolean) => {
         setUseSemanticRanker(!!checked);
     };
@@ -95,6 +104,10 @@ const OneShot = () => {
         setExcludeCategory(newValue || "");
     };
 
+    const onShouldStreamChange = (_ev?: React.FormEvent<HTMLElement | HTMLInputElement>, checked?: boolean) => {
+        setShouldStream(!!checked);
+    };
+
     const onExampleClicked = (example: string) => {
         makeApiRequest(example);
     };
@@ -149,7 +162,17 @@ const OneShot = () => {
                 </div>
             </div>
             <div className={styles.oneshotBottomSection}>
-                {isLoading && <Spinner label="Generating answer" />}
+                {isLoading && !streamedAnswer?.answer && <Spinner label="Generating answer" />}
+                {isLoading && streamedAnswer?.answer && (
+                    <div className={styles.oneshotAnswerContainer}>
+                        <Answer
+                            answer={streamedAnswer}
+                            onCitationClicked={() => {}}
+                            onThoughtProcessClicked={() => {}}
+                            onSupportingContentClicked={() => {}}
+                        />
+                    </div>
+                )}
                 {!lastQuestionRef.current && <ExampleList onExampleClicked={onExampleClicked} />}
                 {!isLoading && answer && !error && (
                     <div className={styles.oneshotAnswerContainer}>
@@ -236,6 +259,17 @@ const OneShot = () => {
                     defaultValue={retrieveCount.toString()}
                     onChange={onRetrieveCountChange}
                 />
+                <Dropdown
+                    className={styles.oneshotSettingsSeparator}
+                    label="Retrieval mode"
+                    options={[
+                        { key: "text", text: "Text", selected: retrievalMode === RetrievalMode.Text, data: RetrievalMode.Text },
+                        { key: "vector", text: "Vectors", selected: retrievalMode === RetrievalMode.Vectors, data: RetrievalMode.Vectors },
+                        { key: "hybrid", text: "Vectors + Text (Hybrid)", selected: retrievalMode === RetrievalMode.Hybrid, data: RetrievalMode.Hybrid }
+                    ]}
+                    required
+                    onChange={onRetrievalModeChange}
+                />
                 <TextField className={styles.oneshotSettingsSeparator} label="Exclude category" onChange={onExcludeCategoryChanged} />
                 <Checkbox
                     className={styles.oneshotSettingsSeparator}
@@ -250,6 +284,12 @@ const OneShot = () => {
                     onChange={onUseSemanticCaptionsChange}
                     disabled={!useSemanticRanker}
                 />
+                <Checkbox
+                    className={styles.oneshotSettingsSeparator}
+                    checked={shouldStream}
+                    label="Stream the answer as it is generated"
+                    onChange={onShouldStreamChange}
+                />
             </Panel>
         </div>
     );
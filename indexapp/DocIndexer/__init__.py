@@ -1,3 +1,4 @@
+import bisect
 import logging
 import re
 
@@ -6,14 +7,21 @@ import azure.functions as func
 
 import os
 import io
+import time
 import html
-from io import BytesIO
+import json
+import random
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pypdf import PdfReader, PdfWriter
 from azure.identity import DefaultAzureCredential
 from azure.core.credentials import AzureKeyCredential
 from azure.storage.blob import BlobServiceClient
 from azure.search.documents.indexes.models import *
 from azure.search.documents import SearchClient
+from azure.core.exceptions import HttpResponseError
 
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
@@ -26,6 +34,10 @@ CONTAINER = os.getenv("AZURE_STORAGE_CONTAINER")
 STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
 FORM_RECOGNIZER_SERVICE = os.getenv("FORM_RECOGNIZER_SERVICE")
 FORM_RECOGNIZER_KEY = os.getenv("FORM_RECOGNIZER_KEY")
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+INDEX_CONCURRENCY = int(os.getenv("INDEX_CONCURRENCY", "4"))
+# Per section status codes worth trying again, anything else fails for good
+RETRYABLE_STATUS_CODES = (409, 422, 429, 500, 503)
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
 default_creds = DefaultAzureCredential()
@@ -47,14 +59,16 @@ def main(myblob: func.InputStream):
     )
 
     filename = myblob.name
-    blob = BytesIO()
-    blob.write(myblob.read())
-    blob.seek(0)
-    page_map = get_document_text(blob)
-    sections = create_sections(os.path.basename(filename), page_map)
-    index_sections(os.path.basename(filename), sections)
-    blob.seek(0)
-    upload_blobs(filename, blob)
+    # Spool the input to a temp file instead of memory, both Form Recognizer and the page splitting read it from there
+    with tempfile.TemporaryFile() as blob:
+        shutil.copyfileobj(myblob, blob, 1024 * 1024)
+        blob.seek(0)
+        page_map = get_document_text(blob)
+        sections = create_sections(os.path.basename(filename), page_map)
+        index_sections(os.path.basename(filename), sections)
+        blob.seek(0)
+        upload_blobs(filename, blob)
+    mark_index_updated()
 
 
 def blob_name_from_file_page(filename, page=0):
@@ -92,6 +106,55 @@ def table_to_html(table):
     return table_html
 
 
+def tables_by_page(tables):
+    pages = {}
+    for table in tables:
+        pages.setdefault(table.bounding_regions[0].page_number, []).append(table)
+    return pages
+
+
+# Same as scripts/prepdocslib/pagetext.py: slices content between the table spans instead of walking the page
+# one character at a time. Where spans of different tables overlap, the later table wins.
+def assemble_page_text(content, page_offset, page_length, tables):
+    page_end = page_offset + page_length
+    intervals = []
+    for table_id, table in enumerate(tables):
+        for span in table.spans:
+            start = max(span.offset, page_offset)
+            end = min(span.offset + span.length, page_end)
+            if start < end:
+                intervals.append((start, end, table_id))
+
+    if not intervals:
+        return content[page_offset:page_end]
+
+    # cut the page at every span boundary, each piece is plain text or belongs to the last table covering it
+    boundaries = sorted(
+        {page_offset, page_end}.union(*[(start, end) for start, end, _ in intervals])
+    )
+    intervals.sort()
+    parts = []
+    added_tables = set()
+    active = {}
+    next_interval = 0
+    for start, end in zip(boundaries, boundaries[1:]):
+        while next_interval < len(intervals) and intervals[next_interval][0] <= start:
+            _, interval_end, table_id = intervals[next_interval]
+            active[table_id] = max(active.get(table_id, 0), interval_end)
+            next_interval += 1
+        for table_id in [t for t, interval_end in active.items() if interval_end <= start]:
+            del active[table_id]
+
+        if not active:
+            parts.append(content[start:end])
+        else:
+            table_id = max(active)
+            if table_id not in added_tables:
+                parts.append(table_to_html(tables[table_id]))
+                added_tables.add(table_id)
+    return "".join(parts)
+
+
 def get_document_text(filename):
     offset = 0
     page_map = []
@@ -105,35 +168,15 @@ def get_document_text(filename):
     )
     form_recognizer_results = poller.result()
 
+    tables = tables_by_page(form_recognizer_results.tables)
     for page_num, page in enumerate(form_recognizer_results.pages):
-        tables_on_page = [
-            table
-            for table in form_recognizer_results.tables
-            if table.bounding_regions[0].page_number == page_num + 1
-        ]
-
-        # mark all positions of the table spans in the page
-        page_offset = page.spans[0].offset
-        page_length = page.spans[0].length
-        table_chars = [-1] * page_length
-        for table_id, table in enumerate(tables_on_page):
-            for span in table.spans:
-                # replace all table spans with "table_id" in table_chars array
-                for i in range(span.length):
-                    idx = span.offset - page_offset + i
-                    if idx >= 0 and idx < page_length:
-                        table_chars[idx] = table_id
-
-        # build page text by replacing charcters in table spans with table html
-        page_text = ""
-        added_tables = set()
-        for idx, table_id in enumerate(table_chars):
-            if table_id == -1:
-                page_text += form_recognizer_results.content[page_offset + idx]
-            elif not table_id in added_tables:
-                page_text += table_to_html(tables_on_page[table_id])
-                added_tables.add(table_id)
-
+        # build page text by replacing the table spans with table html
+        page_text = assemble_page_text(
+            form_recognizer_results.content,
+            page.spans[0].offset,
+            page.spans[0].length,
+            tables.get(page_num + 1, []),
+        )
         page_text += " "
         page_map.append((page_num, offset, page_text))
         offset += len(page_text)
@@ -141,54 +184,58 @@ def get_document_text(filename):
     return page_map
 
 
+SENTENCE_ENDING = re.compile(r"[.!?]")
+WORDS_BREAK = re.compile(r"[,;: ()\[\]{}\t\n]")
+# greedy, so a match ends right after the last sentence ending or word break in the searched range
+LAST_SENTENCE_ENDING = re.compile(r"(?s).*[.!?]")
+LAST_WORDS_BREAK = re.compile(r"(?s).*[,;: ()\[\]{}\t\n]")
+
+
+# Same sections as walking the text one character at a time, but the boundary searches are regex searches bounded
+# to the window being looked at and pages are found with a bisect, see scripts/prepdocslib/splitter.py
 def split_text(page_map):
-    SENTENCE_ENDINGS = [".", "!", "?"]
-    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+    page_offsets = [p[1] for p in page_map]
 
     def find_page(offset):
-        l = len(page_map)
-        for i in range(l - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return l - 1
+        i = bisect.bisect_right(page_offsets, offset) - 1
+        return i if 0 <= i < len(page_map) - 1 else len(page_map) - 1
 
     all_text = "".join(p[2] for p in page_map)
     length = len(all_text)
     start = 0
     end = length
     while start + SECTION_OVERLAP < length:
-        last_word = -1
         end = start + MAX_SECTION_LENGTH
-
         if end > length:
             end = length
         else:
             # Try to find the end of the sentence
-            while (
-                end < length
-                and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT
-                and all_text[end] not in SENTENCE_ENDINGS
-            ):
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word  # Fall back to at least keeping a whole word
+            limit = end + SENTENCE_SEARCH_LIMIT
+            m = SENTENCE_ENDING.search(all_text, end, limit + 1)
+            if m:
+                end = m.start()
+            elif limit >= length:
+                end = length
+            else:
+                end = limit
+                # Fall back to at least keeping a whole word
+                m = LAST_WORDS_BREAK.match(all_text, start + MAX_SECTION_LENGTH, limit)
+                if m and m.end() > 1:
+                    end = m.end() - 1
         if end < length:
             end += 1
 
         # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while (
-            start > 0
-            and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT
-            and all_text[start] not in SENTENCE_ENDINGS
-        ):
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
+        lowest = max(0, end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT)
+        if start > lowest:
+            m = LAST_SENTENCE_ENDING.match(all_text, lowest + 1, start + 1)
+            if m:
+                start = m.end() - 1
+            else:
+                m = WORDS_BREAK.search(all_text, lowest + 1, start + 1)
+                start = lowest
+                if all_text[start] not in ".!?" and m:
+                    start = m.start()
         if start > 0:
             start += 1
 
@@ -225,19 +272,68 @@ def index_sections(filename, sections):
         index_name=SEARCH_INDEX,
         credential=search_creds,
     )
-    i = 0
+    # Same as IndexWriter in scripts/prepdocslib/searchindex.py: batches are capped by count and size, a few are in
+    # flight at once and failed sections are retried with backoff
+    slots = threading.BoundedSemaphore(INDEX_CONCURRENCY)
+
+    def send(batch):
+        try:
+            return index_batch(search_client, batch)
+        finally:
+            slots.release()
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=INDEX_CONCURRENCY) as executor:
+        for batch in index_batches(sections):
+            slots.acquire()
+            futures.append(executor.submit(send, batch))
+    failed = [key for future in futures for key in future.result()]
+    if failed:
+        raise Exception(
+            f"{len(failed)} sections from {filename} could not be indexed, first one is {failed[0]}"
+        )
+
+
+def index_batches(sections, max_count=1000, max_bytes=12 * 1024 * 1024):
     batch = []
+    size = 0
     for s in sections:
-        batch.append(s)
-        i += 1
-        if i % 1000 == 0:
-            results = search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
+        s_size = len(json.dumps(s).encode("utf-8")) + 32
+        if batch and (len(batch) >= max_count or size + s_size > max_bytes):
+            yield batch
             batch = []
-
-    if len(batch) > 0:
-        results = search_client.upload_documents(documents=batch)
-        succeeded = sum([1 for r in results if r.succeeded])
+            size = 0
+        batch.append(s)
+        size += s_size
+    if batch:
+        yield batch
+
+
+def index_batch(search_client, batch, max_retries=5):
+    pending = batch
+    failed = []
+    for attempt in range(max_retries + 1):
+        try:
+            results = search_client.upload_documents(documents=pending)
+            retry = set()
+            for r in results:
+                if r.succeeded:
+                    continue
+                if r.status_code in RETRYABLE_STATUS_CODES:
+                    retry.add(r.key)
+                else:
+                    logging.error(f"Could not index section {r.key}: {r.error_message}")
+                    failed.append(r.key)
+        except HttpResponseError as e:
+            if e.status_code not in RETRYABLE_STATUS_CODES:
+                raise
+            retry = set(d["id"] for d in pending)
+        if not retry:
+            return failed
+        pending = [d for d in pending if d["id"] in retry]
+        if attempt < max_retries:
+            time.sleep(min(60, 2**attempt) * random.uniform(0.5, 1))
+    return failed + [d["id"] for d in pending]
 
 
 def upload_blobs(filename, data):
@@ -249,16 +345,66 @@ def upload_blobs(filename, data):
     if not blob_container.exists():
         blob_container.create_container()
     if os.path.splitext(filename)[1].lower() == ".pdf":
-        reader = PdfReader(data)
-        pages = reader.pages
-        for i in range(len(pages)):
-            blob_name = blob_name_from_file_page(filename, i)
-            f = io.BytesIO()
-            writer = PdfWriter()
-            writer.add_page(pages[i])
-            writer.write(f)
-            f.seek(0)
-            blob_container.upload_blob(blob_name, f, overwrite=True)
+
+        def upload_page(i, page):
+            blob_container.upload_blob(
+                blob_name_from_file_page(filename, i), page, overwrite=True
+            )
+
+        upload_pages(iter_pdf_pages(data), upload_page, UPLOAD_CONCURRENCY)
     else:
         blob_name = blob_name_from_file_page(filename)
         blob_container.upload_blob(blob_name, data, overwrite=True)
+
+
+# Writes out one page at a time and drops what the reader parsed for it afterwards, so memory follows the size of
+# a page rather than of the document. Same as scripts/prepdocslib/pdfpages.py
+def iter_pdf_pages(stream):
+    reader = PdfReader(stream)
+    for i in range(len(reader.pages)):
+        f = io.BytesIO()
+        writer = PdfWriter()
+        writer.add_page(reader.pages[i])
+        writer.write(f)
+        f.seek(0)
+        del writer
+        reader.resolved_objects.clear()
+        yield i, f
+
+
+# Uploads on up to max_concurrency threads, only producing the next page once a slot is free
+def upload_pages(pages, upload, max_concurrency=4):
+    max_concurrency = max(1, max_concurrency)
+    slots = threading.BoundedSemaphore(max_concurrency)
+
+    def upload_page(page_num, data):
+        try:
+            upload(page_num, data)
+        finally:
+            data.close()
+            slots.release()
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while True:
+            slots.acquire()
+            page = next(pages, None)
+            if page is None:
+                slots.release()
+                break
+            futures.append(executor.submit(upload_page, *page))
+    for future in futures:
+        future.result()
+    return len(futures)
+
+
+def mark_index_updated():
+    # Running backends cache search results until they see a new "indexversion" on the container
+    blob_service = BlobServiceClient(
+        account_url=f"https://{STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=default_creds,
+    )
+    blob_container = blob_service.get_container_client(CONTAINER)
+    metadata = blob_container.get_container_properties().metadata
+    metadata["indexversion"] = str(time.time())
+    blob_container.set_container_metadata(metadata)
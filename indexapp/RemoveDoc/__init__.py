@@ -2,11 +2,14 @@ import logging
 import os
 import time
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import azure.functions as func
 from azure.identity import DefaultAzureCredential
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from azure.search.documents import SearchClient, SearchIndexingBufferedSender
+from azure.search.documents.indexes import SearchIndexClient
 from azure.storage.blob import BlobServiceClient
 
 SEARCH_KEY = os.getenv("SEARCH_KEY")
@@ -14,6 +17,7 @@ SEARCH_SERVICE = os.getenv("SEARCH_SERVICE")
 SEARCH_INDEX = os.getenv("SEARCH_INDEX")
 CONTAINER = os.getenv("AZURE_STORAGE_CONTAINER")
 STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
+DELETE_CONCURRENCY = int(os.getenv("DELETE_CONCURRENCY", "4"))
 
 default_cred = DefaultAzureCredential()
 search_creds = AzureKeyCredential(SEARCH_KEY)
@@ -31,12 +35,14 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             if filename == "ALL":
                 failure_msg += " of all files."
                 remove_blobs(None)
-                remove_from_index(None)
+                remove_from_index(None, recreate=req.params.get("recreate") == "true")
+                mark_index_updated()
                 success_msg = f"All file successfully removed from index."
             else:
                 failure_msg += " of all file {filename}."
                 remove_blobs(filename)
                 remove_from_index(filename)
+                mark_index_updated()
                 success_msg = f"File {filename} successfully removed from index."
             return func.HttpResponse(success_msg, status_code=200)
         else:
@@ -48,19 +54,39 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(failure_msg, status_code=500)
 
 
-def remove_from_index(filename):
+def remove_from_index(filename, recreate=False):
+    endpoint = f"https://{SEARCH_SERVICE}.search.windows.net/"
+    index_client = SearchIndexClient(endpoint=endpoint, credential=search_creds)
+    if filename == None and recreate:
+        # Fastest way to empty the index: delete it and create it again from its own definition
+        index = index_client.get_index(SEARCH_INDEX)
+        index_client.delete_index(SEARCH_INDEX)
+        index.e_tag = None
+        index_client.create_index(index)
+        return
+
     search_client = SearchClient(
-        endpoint=f"https://{SEARCH_SERVICE}.search.windows.net/",
+        endpoint=endpoint,
         index_name=SEARCH_INDEX,
         credential=search_creds,
     )
+    filter = (
+        None
+        if filename == None
+        else "sourcefile eq '{}'".format(os.path.basename(filename).replace("'", "''"))
+    )
+    id_field = next(f for f in index_client.get_index(SEARCH_INDEX).fields if f.key)
+    if id_field.filterable and id_field.sortable:
+        failed = delete_keys(iter_keys(search_client, filter))
+        if failed:
+            raise Exception(f"Could not remove {len(failed)} sections from index")
+        return
+
+    # Older indexes can't be paged by id, keep deleting the first page of matches until there are none left
     while True:
-        filter = (
-            None
-            if filename == None
-            else f"sourcefile eq '{os.path.basename(filename)}'"
+        r = search_client.search(
+            "", filter=filter, select=["id"], top=1000, include_total_count=True
         )
-        r = search_client.search("", filter=filter, top=1000, include_total_count=True)
         if r.get_count() == 0:
             break
         r = search_client.delete_documents(documents=[{"id": d["id"]} for d in r])
@@ -68,6 +94,69 @@ def remove_from_index(filename):
         time.sleep(2)
 
 
+# Pages through the ids of the matching sections in id order, each page starting after the last id of the previous
+# one, so it doesn't have to wait for deletes to show up in search results. Same as scripts/prepdocslib/searchindex.py
+def iter_keys(search_client, filter, page_size=1000):
+    last = None
+    while True:
+        after = None if last is None else "id gt '{}'".format(last.replace("'", "''"))
+        page_filter = " and ".join(f"({f})" for f in [filter, after] if f) or None
+        r = search_client.search(
+            "", filter=page_filter, order_by=["id asc"], select=["id"], top=page_size
+        )
+        keys = [d["id"] for d in r]
+        if keys:
+            yield keys
+        if len(keys) < page_size:
+            break
+        last = keys[-1]
+
+
+# Deletes batches of ids on a few threads, each with its own buffered sender (which splits batches that are too
+# large and retries failed keys), with at most DELETE_CONCURRENCY batches waiting or in flight. Returns failed ids
+def delete_keys(batches):
+    slots = threading.BoundedSemaphore(DELETE_CONCURRENCY)
+    local = threading.local()
+    senders = []
+    failed = []
+    lock = threading.Lock()
+
+    def on_error(action):
+        with lock:
+            failed.append(action.additional_properties.get("id"))
+
+    def delete_batch(keys):
+        try:
+            sender = getattr(local, "sender", None)
+            if sender is None:
+                sender = local.sender = SearchIndexingBufferedSender(
+                    f"https://{SEARCH_SERVICE}.search.windows.net/",
+                    SEARCH_INDEX,
+                    search_creds,
+                    auto_flush=False,
+                    on_error=on_error,
+                )
+                with lock:
+                    senders.append(sender)
+            sender.delete_documents(documents=[{"id": k} for k in keys])
+            sender.flush()
+        finally:
+            slots.release()
+
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=DELETE_CONCURRENCY) as executor:
+            for keys in batches:
+                slots.acquire()
+                futures.append(executor.submit(delete_batch, keys))
+        for future in futures:
+            future.result()
+    finally:
+        for sender in senders:
+            sender.close()
+    return failed
+
+
 def remove_blobs(filename):
     blob_service = BlobServiceClient(
         account_url=f"https://{STORAGE_ACCOUNT}.blob.core.windows.net",
@@ -87,3 +176,16 @@ def remove_blobs(filename):
             )
         for b in blobs:
             blob_container.delete_blob(b)
+
+
+def mark_index_updated():
+    # Running backends cache search results until they see a new "indexversion" on the container
+    blob_service = BlobServiceClient(
+        account_url=f"https://{STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=default_cred,
+    )
+    blob_container = blob_service.get_container_client(CONTAINER)
+    if blob_container.exists():
+        metadata = blob_container.get_container_properties().metadata
+        metadata["indexversion"] = str(time.time())
+        blob_container.set_container_metadata(metadata)
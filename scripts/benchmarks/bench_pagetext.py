@@ -0,0 +1,96 @@
+# Compares the original character-by-character page assembly in get_document_text with
+# prepdocslib.pagetext.assemble_page_text on a synthetic Form Recognizer layout result, checks that both produce
+# the same text, and prints pages/sec for each.
+#
+#   python scripts/benchmarks/bench_pagetext.py --pages 200 --tables-per-page 3
+import argparse
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from prepdocslib.pagetext import assemble_page_text, tables_by_page
+
+def table_to_html(table):
+    return f"<table><tr><td>{table.id}</td></tr></table>"
+
+def original_page_text(content, page_num, page, tables):
+    tables_on_page = [table for table in tables if table.bounding_regions[0].page_number == page_num + 1]
+    page_offset = page.spans[0].offset
+    page_length = page.spans[0].length
+    table_chars = [-1]*page_length
+    for table_id, table in enumerate(tables_on_page):
+        for span in table.spans:
+            for i in range(span.length):
+                idx = span.offset - page_offset + i
+                if idx >=0 and idx < page_length:
+                    table_chars[idx] = table_id
+    page_text = ""
+    added_tables = set()
+    for idx, table_id in enumerate(table_chars):
+        if table_id == -1:
+            page_text += content[page_offset + idx]
+        elif not table_id in added_tables:
+            page_text += table_to_html(tables_on_page[table_id])
+            added_tables.add(table_id)
+    return page_text
+
+def synthetic_result(num_pages, page_length, tables_per_page, seed):
+    rnd = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "benefits", "plan", "deductible", "coverage", "network"]
+    content_parts, pages, tables = [], [], []
+    offset = 0
+    for page_num in range(num_pages):
+        text = []
+        length = 0
+        while length < page_length:
+            w = rnd.choice(words) + rnd.choice([" ", " ", " ", ". ", ", ", "\n"])
+            text.append(w)
+            length += len(w)
+        text = "".join(text)[:page_length]
+        content_parts.append(text)
+        pages.append(SimpleNamespace(spans=[SimpleNamespace(offset=offset, length=page_length)]))
+        for t in range(tables_per_page):
+            start = offset + rnd.randrange(0, page_length - 200)
+            # Most tables are one span, some are split in two, a few overlap their neighbour or run off the page
+            spans = [SimpleNamespace(offset=start, length=rnd.randrange(50, 150))]
+            if rnd.random() < 0.3:
+                spans.append(SimpleNamespace(offset=start + 160, length=rnd.randrange(20, page_length)))
+            tables.append(SimpleNamespace(id=f"{page_num}-{t}", spans=spans, bounding_regions=[SimpleNamespace(page_number=page_num + 1)]))
+        offset += page_length
+    return SimpleNamespace(content="".join(content_parts), pages=pages, tables=tables)
+
+def run(name, func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return name, best, result
+
+parser = argparse.ArgumentParser(description="Benchmark page text assembly from Form Recognizer results")
+parser.add_argument("--pages", type=int, default=200)
+parser.add_argument("--page-length", type=int, default=4000)
+parser.add_argument("--tables-per-page", type=int, default=2)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+r = synthetic_result(args.pages, args.page_length, args.tables_per_page, args.seed)
+
+def before():
+    return [original_page_text(r.content, page_num, page, r.tables) for page_num, page in enumerate(r.pages)]
+
+def after():
+    tables = tables_by_page(r.tables)
+    return [assemble_page_text(r.content, page.spans[0].offset, page.spans[0].length, tables.get(page_num + 1, []), table_to_html) for page_num, page in enumerate(r.pages)]
+
+results = [run("before (per character)", before, args.repeat), run("after (span slices)", after, args.repeat)]
+if results[0][2] != results[1][2]:
+    print("Page text differs between implementations")
+    exit(1)
+for name, elapsed, _ in results:
+    print(f"{name:24} {args.pages / elapsed:12.1f} pages/sec  ({elapsed * 1000:.1f} ms)")
+print(f"speedup: {results[0][1] / results[1][1]:.1f}x")
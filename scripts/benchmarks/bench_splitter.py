@@ -0,0 +1,147 @@
+# Compares the original character walking split_text from prepdocs.py with prepdocslib.splitter.TextSplitter.
+# Every input is split with both, the sections must be identical, and the time and sections/sec of each is
+# printed. Inputs are the PDFs in --data (text extracted locally with pypdf, like --localpdfparser) plus synthetic
+# documents of --synthetic-pages pages, with and without tables.
+#
+#   python scripts/benchmarks/bench_splitter.py --data ./data --synthetic-pages 500
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from prepdocslib.splitter import TextSplitter
+
+MAX_SECTION_LENGTH = 1000
+SENTENCE_SEARCH_LIMIT = 100
+SECTION_OVERLAP = 100
+
+def original_split_text(page_map):
+    SENTENCE_ENDINGS = [".", "!", "?"]
+    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+    def find_page(offset):
+        l = len(page_map)
+        for i in range(l - 1):
+            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
+                return i
+        return l - 1
+
+    all_text = "".join(p[2] for p in page_map)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+
+        if end > length:
+            end = length
+        else:
+            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
+                if all_text[end] in WORDS_BREAKS:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word
+        if end < length:
+            end += 1
+
+        last_word = -1
+        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
+            if all_text[start] in WORDS_BREAKS:
+                last_word = start
+            start -= 1
+        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
+
+def page_map_from_texts(texts):
+    page_map = []
+    offset = 0
+    for page_num, text in enumerate(texts):
+        page_map.append((page_num, offset, text))
+        offset += len(text)
+    return page_map
+
+def pdf_page_map(filename):
+    from pypdf import PdfReader
+    return page_map_from_texts([p.extract_text() for p in PdfReader(filename).pages])
+
+def synthetic_page_map(pages, tables, seed):
+    rnd = random.Random(seed)
+    words = ["the", "plan", "covers", "in-network", "deductible", "(see", "section", "4)", "employees;", "benefits:", "[a]", "{b}", "\t", "\n"]
+    texts = []
+    for _ in range(pages):
+        parts = []
+        length = 0
+        target = rnd.randrange(0, 4000) if rnd.random() < 0.05 else rnd.randrange(1500, 4000)
+        while length < target:
+            r = rnd.random()
+            if tables and r < 0.01:
+                rows = "".join(f"<tr><td>{rnd.choice(words)}</td><td>{rnd.randrange(1000)}</td></tr>" for _ in range(rnd.randrange(1, 60)))
+                w = f"<table>{rows}</table>"
+            elif r < 0.002:
+                w = "x" * rnd.randrange(100, 400)
+            else:
+                w = rnd.choice(words) + rnd.choice([" ", " ", " ", ". ", "! ", "? ", ", ", ""])
+            parts.append(w)
+            length += len(w)
+        texts.append("".join(parts) + " ")
+    return page_map_from_texts(texts)
+
+def timed(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = list(func())
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+parser = argparse.ArgumentParser(description="Benchmark and check the section splitter used by prepdocs.py")
+parser.add_argument("--data", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data"), help="Folder of PDFs to split")
+parser.add_argument("--synthetic-pages", type=int, default=300, help="Pages in each synthetic document")
+parser.add_argument("--synthetic-docs", type=int, default=4, help="Number of synthetic documents")
+parser.add_argument("--repeat", type=int, default=3)
+args = parser.parse_args()
+
+inputs = []
+for filename in sorted(glob.glob(os.path.join(args.data, "*.pdf"))):
+    try:
+        inputs.append((os.path.basename(filename), pdf_page_map(filename)))
+    except Exception as e:
+        print(f"Skipping '{filename}': {e}")
+for seed in range(args.synthetic_docs):
+    inputs.append((f"synthetic-{seed}{'-tables' if seed % 2 else ''}", synthetic_page_map(args.synthetic_pages, seed % 2 == 1, seed)))
+
+splitter = TextSplitter(MAX_SECTION_LENGTH, SENTENCE_SEARCH_LIMIT, SECTION_OVERLAP)
+mismatches = 0
+total_before = total_after = 0.0
+print(f"{'input':40} {'pages':>6} {'sections':>9} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+for name, page_map in inputs:
+    before, expected = timed(lambda: original_split_text(page_map), args.repeat)
+    after, actual = timed(lambda: splitter.split(page_map), args.repeat)
+    total_before += before
+    total_after += after
+    if actual != expected:
+        mismatches += 1
+        print(f"Sections differ for '{name}'")
+    print(f"{name[:40]:40} {len(page_map):6} {len(expected):9} {before * 1000:10.1f} {after * 1000:10.1f} {before / max(after, 1e-9):7.1f}x")
+
+print(f"total: {total_before * 1000:.1f} ms before, {total_after * 1000:.1f} ms after, {total_before / max(total_after, 1e-9):.1f}x")
+exit(1 if mismatches else 0)
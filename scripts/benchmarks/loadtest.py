@@ -0,0 +1,328 @@
+# Replays recorded /ask and /chat requests against the backend at a target rate and reports latency percentiles and
+# errors for each approach. Requests are sent on a fixed schedule (open loop), whether or not earlier ones have
+# finished, so a backend that can't keep up shows it in its latencies rather than in a lower request rate.
+#
+# Payloads are JSON lines of {"route": "/ask" or "/chat", "body": <request body>}, with bodies shaped like the ones
+# app/frontend/src/api/api.ts sends (copy them from the browser's network tab to record real traffic). For streamed
+# requests the time to the first answer frame is reported as well. When responses carry a "timings" block, the
+# backend's own stage timings are summarized too.
+#
+# With --leakage N, N requests per approach are sent all at once instead, each asking about a word of its own. The
+# sources and answer of each response must mention its word and no other request's, otherwise answers are leaking
+# between concurrent requests (this relies on the answers of mock_services.py, so use it with --serve).
+#
+# With --serve, mock_services.py and the backend are started on local ports first, so the whole run is offline.
+# Arguments this script doesn't know are passed on to mock_services.py. --max-p95-ms and --max-error-rate make
+# the exit code non-zero when they're exceeded, to gate releases on a run.
+#
+#   python scripts/benchmarks/loadtest.py --serve --rps 5 --duration 60 --openai-latency lognormal:400:0.3
+#   python scripts/benchmarks/loadtest.py --url http://127.0.0.1:50505 --rps 2 --duration 120 --payloads recorded.jsonl
+#   python scripts/benchmarks/loadtest.py --serve --leakage 50
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(HERE, "..", "..", "app", "backend")
+
+# Requests sent by --leakage
+LEAKAGE_APPROACHES = [("/ask", "rtr", False, {}), ("/ask", "rtr", True, {}), ("/ask", "rrr", False, {}), ("/ask", "rda", False, {}),
+                      ("/ask", "rda", False, {"planner": False}), ("/chat", "rrr", False, {}), ("/chat", "rrr", True, {})]
+MARKER = re.compile(r"leak[0-9a-f]{12}")
+
+class Result:
+    def __init__(self, name: str, started: float, marker: str = None):
+        self.name = name
+        self.started = started
+        self.marker = marker
+        self.latency = None
+        self.first_answer = None
+        self.error = None
+        self.timings = None
+        self.response = None
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+def payload_name(route: str, body: dict) -> str:
+    name = f"{route.strip('/')} {body['approach']}" + (" (stream)" if body.get("stream") else "")
+    return name + (" (iterative)" if (body.get("overrides") or {}).get("planner") is False else "")
+
+def load_payloads(path: str, only: list) -> list:
+    payloads = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                p = json.loads(line)
+                p["name"] = payload_name(p["route"], p["body"])
+                if not only or f"{p['route'].strip('/')}:{p['body']['approach']}" in only:
+                    payloads.append(p)
+    if not payloads:
+        raise SystemExit(f"No payloads to send from {path}")
+    return payloads
+
+def leakage_payloads(n: int) -> list:
+    payloads = []
+    for route, approach, stream, overrides in LEAKAGE_APPROACHES:
+        for _ in range(n):
+            marker = "leak" + uuid.uuid4().hex[:12]
+            question = f"What does the plan say about {marker}?"
+            body = {"approach": approach, "stream": stream, "overrides": dict(overrides, top=3)}
+            body["question" if route == "/ask" else "message"] = question
+            payloads.append({"route": route, "body": body, "marker": marker, "name": payload_name(route, body)})
+    random.shuffle(payloads)
+    return payloads
+
+async def send(session: aiohttp.ClientSession, url: str, payload: dict, result: Result, timeout: float):
+    try:
+        async with session.post(url + payload["route"], json=payload["body"], timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if payload["body"].get("stream") and response.status == 200:
+                r = {"answer": ""}
+                async for line in response.content:
+                    if not line.strip():
+                        continue
+                    frame = json.loads(line)
+                    if "answer" in frame and result.first_answer is None:
+                        result.first_answer = time.perf_counter() - result.started
+                    if "error" in frame:
+                        result.error = frame["error"][:200]
+                    if "timings" in frame:
+                        result.timings = frame["timings"]
+                    if result.marker:
+                        r["answer"] += frame.pop("answer", "")
+                        r.update(frame)
+                result.response = r if result.marker else None
+            else:
+                body = await response.read()
+                if response.status != 200:
+                    result.error = f"HTTP {response.status}: {body[:200].decode(errors='replace')}"
+                else:
+                    r = json.loads(body)
+                    result.timings = r.get("timings")
+                    result.response = r if result.marker else None
+    except asyncio.TimeoutError:
+        result.error = "timeout"
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.latency = time.perf_counter() - result.started
+
+async def run_burst(args, payloads: list) -> tuple:
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        start = time.perf_counter()
+        results = [Result(p["name"], start, p.get("marker")) for p in payloads]
+        await asyncio.gather(*(send(session, args.url, p, r, args.timeout) for p, r in zip(payloads, results)))
+        return results, time.perf_counter() - start
+
+def check_leakage(results: list) -> dict:
+    # A response leaks if it mentions another request's word, and is missing its own if its answer or sources don't
+    # mention it (e.g. because they were replaced by another request's)
+    summary = {}
+    for r in results:
+        s = summary.setdefault(r.name, {"requests": 0, "errors": 0, "leaks": 0, "missing": 0})
+        s["requests"] += 1
+        if r.error:
+            s["errors"] += 1
+            continue
+        if set(MARKER.findall(json.dumps(r.response))) - {r.marker}:
+            s["leaks"] += 1
+        if r.marker not in r.response.get("answer", "") or r.marker not in "\n".join(r.response.get("data_points") or []):
+            s["missing"] += 1
+    return dict(sorted(summary.items()))
+
+async def run(args, payloads: list) -> tuple:
+    results = []
+    tasks = []
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        next_at = 0.0
+        i = 0
+        while next_at < args.duration:
+            await asyncio.sleep(max(0, start + next_at - time.perf_counter()))
+            payload = payloads[i % len(payloads)]
+            result = Result(payload["name"], time.perf_counter())
+            if next_at >= args.warmup:
+                results.append(result)
+            tasks.append(asyncio.ensure_future(send(session, args.url, payload, result, args.timeout)))
+            i += 1
+            next_at += random.expovariate(args.rps) if args.arrivals == "poisson" else 1 / args.rps
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+def summarize(results: list, elapsed: float) -> dict:
+    summary = {}
+    for name in sorted({r.name for r in results}):
+        group = [r for r in results if r.name == name]
+        latencies = [r.latency for r in group if not r.error]
+        first_answers = [r.first_answer for r in group if not r.error and r.first_answer is not None]
+        stages = {}
+        for r in group:
+            for stage, value in ((r.timings or {}).get("stages") or {}).items():
+                stages.setdefault(stage, []).append(value)
+        errors = [r.error for r in group if r.error]
+        summary[name] = {
+            "requests": len(group),
+            "errors": len(errors),
+            "error_rate": round(len(errors) / len(group), 4),
+            "rps": round(len(group) / elapsed, 2),
+            "p50_ms": ms(percentile(latencies, 50)),
+            "p95_ms": ms(percentile(latencies, 95)),
+            "p99_ms": ms(percentile(latencies, 99)),
+            "max_ms": ms(max(latencies)) if latencies else None,
+            "first_answer_p50_ms": ms(percentile(first_answers, 50)),
+            "first_answer_p95_ms": ms(percentile(first_answers, 95)),
+            "stages_p50_ms": {stage: percentile(values, 50) for stage, values in sorted(stages.items())},
+            "stages_p95_ms": {stage: percentile(values, 95) for stage, values in sorted(stages.items())},
+            "sample_errors": sorted(set(errors))[:3],
+        }
+    return summary
+
+def print_summary(summary: dict):
+    columns = {"requests": "requests", "errors": "errors", "rps": "rps", "p50_ms": "p50 ms", "p95_ms": "p95 ms", "p99_ms": "p99 ms", "max_ms": "max ms",
+               "first_answer_p50_ms": "1st answer p50", "first_answer_p95_ms": "1st answer p95"}
+    width = max(len(name) for name in summary) + 2
+    print("\n" + "".ljust(width) + "".join(label.rjust(16) for label in columns.values()))
+    for name, s in summary.items():
+        print(name.ljust(width) + "".join(("-" if s[c] is None else str(s[c])).rjust(16) for c in columns))
+    for name, s in summary.items():
+        if s["stages_p50_ms"]:
+            print(f"\n{name} backend stages, p50 / p95 ms:")
+            for stage in s["stages_p50_ms"]:
+                print(f"  {stage.ljust(24)} {s['stages_p50_ms'][stage]} / {s['stages_p95_ms'][stage]}")
+        for error in s["sample_errors"]:
+            print(f"{name} error: {error}")
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def wait_until_up(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as r:
+                    if r.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise SystemExit(f"{url} didn't come up within {timeout} seconds")
+            await asyncio.sleep(0.25)
+
+def start_services(args, mock_args: list) -> list:
+    mock_port = free_port()
+    backend_port = free_port()
+    # Only their errors are shown, the agents print their reasoning to stdout
+    mock = subprocess.Popen([sys.executable, os.path.join(HERE, "mock_services.py"), "--port", str(mock_port)] + mock_args, stdout=subprocess.DEVNULL)
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    env = dict(os.environ,
+               AZURE_SEARCH_ENDPOINT=mock_url,
+               AZURE_SEARCH_KEY="mock",
+               AZURE_OPENAI_ENDPOINT=mock_url,
+               AZURE_OPENAI_KEY="mock",
+               AZURE_STORAGE_ACCOUNT="mockaccount",
+               AZURE_STORAGE_ENDPOINT=f"{mock_url}/mockaccount",
+               AZURE_STORAGE_KEY="bW9ja2tleQ==",
+               CONTENT_CACHE_DIR=tempfile.mkdtemp(prefix="gptkb-loadtest-"))
+    backend = subprocess.Popen([sys.executable, "-m", "hypercorn", "--bind", f"127.0.0.1:{backend_port}", "--workers", str(args.backend_workers), "app:app"],
+                               cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL)
+    args.url = f"http://127.0.0.1:{backend_port}"
+    args.mock_url = mock_url
+    asyncio.run(wait_until_up(mock_url + "/stats"))
+    asyncio.run(wait_until_up(args.url + "/metrics"))
+    return [backend, mock]
+
+async def mock_stats(url: str) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url + "/stats") as r:
+            return await r.json()
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay /ask and /chat requests at a target rate and report latency percentiles and errors per approach.",
+                                     epilog="Unknown arguments are passed on to mock_services.py when using --serve.")
+    parser.add_argument("--url", default="http://127.0.0.1:50505", help="Backend to test, ignored with --serve")
+    parser.add_argument("--serve", action="store_true", help="Start mock_services.py and the backend (with hypercorn) on free local ports")
+    parser.add_argument("--backend-workers", type=int, default=1, help="Hypercorn workers for the backend started with --serve")
+    parser.add_argument("--payloads", default=os.path.join(HERE, "payloads.jsonl"), help="Recorded requests, one JSON object per line")
+    parser.add_argument("--only", default="", help="Comma separated route:approach pairs to send, e.g. ask:rtr,chat:rrr")
+    parser.add_argument("--rps", type=float, default=2, help="Requests per second to send")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to send requests for")
+    parser.add_argument("--warmup", type=float, default=0, help="Seconds at the start whose requests aren't counted")
+    parser.add_argument("--arrivals", choices=["uniform", "poisson"], default="uniform", help="Evenly spaced requests, or random ones at the same average rate")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds before a request counts as failed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the summary to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="Fail if the p95 latency of any approach is higher")
+    parser.add_argument("--max-error-rate", type=float, help="Fail if the error rate of any approach is higher")
+    parser.add_argument("--leakage", type=int, help="Instead of replaying payloads, send this many concurrent requests per approach and check that no response has another's content")
+    args, mock_args = parser.parse_known_args()
+    if mock_args and not args.serve:
+        parser.error(f"unrecognized arguments: {' '.join(mock_args)}")
+    random.seed(args.seed)
+
+    payloads = leakage_payloads(args.leakage) if args.leakage else load_payloads(args.payloads, [o.strip() for o in args.only.split(",") if o.strip()])
+    processes = start_services(args, mock_args) if args.serve else []
+    try:
+        if args.leakage:
+            print(f"Sending {len(payloads)} concurrent requests to {args.url}")
+            results, elapsed = asyncio.run(run_burst(args, payloads))
+        else:
+            print(f"Sending {args.rps} requests/s for {args.duration}s to {args.url}, {len(payloads)} payloads")
+            results, elapsed = asyncio.run(run(args, payloads))
+        if args.serve:
+            print(f"Mock service requests: {asyncio.run(mock_stats(args.mock_url))}")
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.wait()
+
+    if args.leakage:
+        leakage = check_leakage(results)
+        print("\n" + "".ljust(20) + "".join(c.rjust(10) for c in ["requests", "errors", "leaks", "missing"]))
+        for name, s in leakage.items():
+            print(name.ljust(20) + "".join(str(v).rjust(10) for v in s.values()))
+        for r in results:
+            if r.error:
+                print(f"{r.name} error: {r.error}")
+                break
+        if any(s["errors"] or s["leaks"] or s["missing"] for s in leakage.values()):
+            print("\nFAILED: responses had errors or content from other requests")
+            sys.exit(1)
+        print("\nNo leaks")
+        return
+
+    summary = summarize(results, elapsed)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"rps": args.rps, "duration": args.duration, "approaches": summary}, f, indent=2)
+
+    failed = [f"{name}: p95 {s['p95_ms']} ms" for name, s in summary.items() if args.max_p95_ms is not None and (s["p95_ms"] is None or s["p95_ms"] > args.max_p95_ms)]
+    failed += [f"{name}: error rate {s['error_rate']}" for name, s in summary.items() if args.max_error_rate is not None and s["error_rate"] > args.max_error_rate]
+    if failed:
+        print("\nFAILED: " + "; ".join(failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# Local stand-ins for the services the backend calls, so app/backend/app.py can be load tested offline. One HTTP
+# server answers like:
+#   - Azure Cognitive Search: document searches (text, semantic and vector), with made up sections that contain
+#     the words of the query, captions and answers
+#   - Azure OpenAI: completions (streamed or not) and embeddings. Completions that an agent asks for (rrr and rda
+#     approaches) follow the agent's format, searching once and then answering. rda's plans have two searches
+#   - Azure Blob Storage: the content container's properties, which the backend reads to find the index version
+# Each kind of request waits for a delay drawn from its latency distribution, see parse_latency. Point the backend at
+# it with AZURE_SEARCH_ENDPOINT, AZURE_OPENAI_ENDPOINT and AZURE_STORAGE_ENDPOINT (any keys will do), or let
+# loadtest.py --serve start everything.
+#
+#   python scripts/benchmarks/mock_services.py --port 8765 --openai-latency lognormal:400:0.3 --openai-token-latency 20
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from typing import Callable
+
+from aiohttp import web
+
+WORDS = ("plan coverage deductible employee benefits network provider claim premium dental vision copay hospital "
+         "prescription eligible enrollment dependents handbook policy leave vacation manager review training").split()
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    # Delay in seconds from a spec in milliseconds: "80" (always 80), "uniform:50:150", "normal:100:20" (mean and
+    # standard deviation) or "lognormal:80:0.5" (median and sigma, a long tail like real services have)
+    kind, _, params = spec.partition(":") if ":" in spec else ("const", "", spec)
+    values = [float(v) for v in params.split(":")] if params else []
+    if kind == "const" and len(values) == 1:
+        return lambda: values[0] / 1000
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == "normal" and len(values) == 2:
+        return lambda: max(0, random.gauss(values[0], values[1])) / 1000
+    if kind == "lognormal" and len(values) == 2:
+        return lambda: values[0] * random.lognormvariate(0, values[1]) / 1000
+    raise argparse.ArgumentTypeError(f"Unknown latency '{spec}', use e.g. 80, uniform:50:150, normal:100:20 or lognormal:80:0.5")
+
+class MockServices:
+    def __init__(self, args):
+        self.args = args
+        self.requests = {"search": 0, "completions": 0, "embeddings": 0, "storage": 0, "errors": 0}
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post(r"/indexes{index:.*}/docs/search.post.search", self.search)
+        app.router.add_post("/openai/deployments/{deployment}/completions", self.completions)
+        app.router.add_post("/openai/deployments/{deployment}/embeddings", self.embeddings)
+        app.router.add_get("/stats", self.stats)
+        app.router.add_get("/{path:.*}", self.container_properties)
+        return app
+
+    async def delay(self, latency: Callable[[], float]):
+        await asyncio.sleep(latency())
+
+    def failing(self) -> bool:
+        if self.args.error_rate and random.random() < self.args.error_rate:
+            self.requests["errors"] += 1
+            return True
+        return False
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.requests)
+
+    async def search(self, request: web.Request) -> web.Response:
+        self.requests["search"] += 1
+        body = await request.json()
+        await self.delay(self.args.search_latency)
+        if self.failing():
+            return web.json_response({"error": {"code": "ServiceUnavailable", "message": "Injected failure"}}, status=503)
+        q = body.get("search") or ""
+        top = int(body.get("top") or 3)
+        terms = re.findall(r"\w+", q.lower()) or WORDS[:3]
+        # The same query always finds the same sections, so the backend's caches behave as they would for real
+        rng = random.Random(hashlib.sha256(q.encode()).hexdigest())
+        docs = []
+        for i in range(top):
+            f = rng.randrange(self.args.files)
+            n = rng.randrange(50)
+            content = self.section_text(rng, terms)
+            docs.append({
+                "@search.score": round(10 - i * 0.5, 3),
+                "@search.rerankerScore": round(3 - i * 0.1, 3) if body.get("queryType") == "semantic" else None,
+                "@search.captions": [{"text": content[:200], "highlights": None}] if body.get("captions") else None,
+                "id": f"file{f}-pdf-{n}",
+                "content": content,
+                "category": None,
+                "sourcepage": f"file{f}-{n // 2 + 1}.pdf",
+                "sourcefile": f"file{f}.pdf",
+            })
+        answers = [{"key": docs[0]["id"], "text": docs[0]["content"][:150], "highlights": None, "score": 0.9}] if docs and body.get("answers") else None
+        return web.json_response({"value": docs, "@search.answers": answers})
+
+    def section_text(self, rng: random.Random, terms: list[str]) -> str:
+        # Every section has all the words of the query, loadtest.py --leakage relies on it
+        words = terms[:-1] + [terms[-1] + "."]
+        while sum(len(w) + 1 for w in words) < self.args.section_chars:
+            sentence = [rng.choice(terms if rng.random() < 0.3 else WORDS) for _ in range(rng.randint(6, 14))]
+            words += sentence[:-1] + [sentence[-1] + "."]
+        return " ".join(words).capitalize()
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests["completions"] += 1
+        body = await request.json()
+        await self.delay(self.args.openai_latency)
+        if self.failing():
+            return web.json_response({"error": {"code": "429", "message": "Injected failure"}}, status=429)
+        prompt = body.get("prompt") or ""
+        prompt = prompt[0] if isinstance(prompt, list) else prompt
+        text = self.completion_text(prompt, body.get("stop") or [], int(body.get("max_tokens") or 16))
+        tokens = re.findall(r"\S+\s*", text)
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(tokens), "total_tokens": len(prompt) // 4 + len(tokens)}
+        if not body.get("stream"):
+            await asyncio.sleep(self.args.openai_token_latency() * len(tokens))
+            return web.json_response(self.completion(request, [{"text": text, "index": 0, "finish_reason": "stop", "logprobs": None}], usage))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for token in tokens:
+            chunk = self.completion(request, [{"text": token, "index": 0, "finish_reason": None, "logprobs": None}])
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.args.openai_token_latency())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def completion(self, request: web.Request, choices: list, usage: dict = None) -> dict:
+        r = {"id": "cmpl-mock", "object": "text_completion", "created": int(time.time()), "model": request.match_info["deployment"], "choices": choices}
+        if usage:
+            r["usage"] = usage
+        return r
+
+    def completion_text(self, prompt: str, stop: list, max_tokens: int) -> str:
+        questions = re.findall(r"Question: *\n?(.*)", prompt) or re.findall(r"<\|im_start\|>user\n(.*)", prompt)
+        question = questions[-1].strip(" '?") if questions else "benefits"
+        sources = re.findall(r"^([\w.-]+\.pdf):", prompt, re.MULTILINE)
+        # Answers start with the question they answer, loadtest.py --leakage relies on it
+        answer = f"About {question}: " + " ".join(WORDS[i % len(WORDS)] for i in range(self.args.completion_tokens)) + "."
+        citation = sources[-1] if sources else "none"
+        if prompt.rstrip().endswith("Searches:"):
+            # The rda approach planning its searches
+            return f"Search: {question}\nSearch: {question} eligible"
+        react_step = next((re.match(r"\nObservation (\d+):", s) for s in stop if re.match(r"\nObservation (\d+):", s)), None)
+        if react_step:
+            # ReAct (rda): search, then finish
+            i = int(react_step.group(1))
+            if i == 1:
+                return f" I need to search {question}.\nAction 1: Search[{question}]"
+            return f" I can answer now.\nAction {i}: Finish[{answer} ({citation})]"
+        if any(s.startswith("\nObservation") for s in stop):
+            # MRKL (rrr): search, then give the final answer
+            if "\nObservation:" in prompt.split("Begin!")[-1]:
+                return f" I now know the final answer\nFinal Answer: {answer} [{citation}]"
+            return f" I need to search for {question}\nAction: CognitiveSearch\nAction Input: {question}"
+        if max_tokens <= 32:
+            # The chat approach rewriting the question into a search query
+            return question
+        return f"{answer} [{citation}]"
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        self.requests["embeddings"] += 1
+        body = await request.json()
+        await self.delay(self.args.embedding_latency)
+        if self.failing():
+            return web.json_response({"error": {"code": "429", "message": "Injected failure"}}, status=429)
+        inputs = body.get("input")
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        data = []
+        for i, text in enumerate(inputs):
+            rng = random.Random(hashlib.sha256(str(text).encode()).hexdigest())
+            data.append({"object": "embedding", "index": i, "embedding": [rng.gauss(0, 1) for _ in range(self.args.embedding_dimensions)]})
+        return web.json_response({"object": "list", "data": data, "model": "mock", "usage": {"prompt_tokens": 8, "total_tokens": 8}})
+
+    async def container_properties(self, request: web.Request) -> web.Response:
+        self.requests["storage"] += 1
+        if request.query.get("restype") != "container":
+            return web.Response(status=404, headers={"x-ms-error-code": "BlobNotFound"})
+        await self.delay(self.args.storage_latency)
+        return web.Response(status=200, headers={
+            "ETag": '"0x8DB0000000000001"',
+            "Last-Modified": "Mon, 01 May 2023 00:00:00 GMT",
+            "x-ms-meta-indexversion": "benchmark",
+            "x-ms-lease-status": "unlocked",
+            "x-ms-lease-state": "available",
+            "x-ms-has-immutability-policy": "false",
+            "x-ms-has-legal-hold": "false",
+        })
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--search-latency", type=parse_latency, default="lognormal:80:0.4", help="Search latency in ms, e.g. 80, uniform:50:150, normal:100:20 or lognormal:80:0.5")
+    parser.add_argument("--openai-latency", type=parse_latency, default="lognormal:500:0.4", help="Time before a completion starts, in ms")
+    parser.add_argument("--openai-token-latency", type=parse_latency, default="15", help="Time per generated token, in ms")
+    parser.add_argument("--embedding-latency", type=parse_latency, default="lognormal:40:0.3", help="Embedding latency in ms")
+    parser.add_argument("--storage-latency", type=parse_latency, default="10", help="Storage latency in ms")
+    parser.add_argument("--completion-tokens", type=int, default=60, help="Tokens in each answer")
+    parser.add_argument("--section-chars", type=int, default=1000, help="Length of each section found by a search")
+    parser.add_argument("--files", type=int, default=20, help="Number of distinct files sections come from")
+    parser.add_argument("--embedding-dimensions", type=int, default=1536)
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests that fail (503 from search, 429 from OpenAI)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Azure Cognitive Search, Azure OpenAI and Blob Storage for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(MockServices(args).app(), host=args.host, port=args.port, access_log=None)
@@ -50,6 +50,12 @@ parser.add_argument(
     required=False,
     help="Optional. Use this Azure Cognitive Search account key instead of the current user identity to login (use az login to set current user for Azure)",
 )
+parser.add_argument(
+    "--embeddingdimensions",
+    type=int,
+    default=1536,
+    help="Optional. Size of the vectors in the embedding field, must match the embeddings model",
+)
 args = parser.parse_args()
 
 # Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
@@ -66,7 +72,13 @@ def create_search_index():
         index = SearchIndex(
             name=args.index,
             fields=[
-                SimpleField(name="id", type="Edm.String", key=True),
+                SimpleField(
+                    name="id",
+                    type="Edm.String",
+                    key=True,
+                    filterable=True,
+                    sortable=True,
+                ),
                 SearchableField(
                     name="content", type="Edm.String", analyzer_name="en.microsoft"
                 ),
@@ -85,7 +97,24 @@ def create_search_index():
                     filterable=True,
                     facetable=True,
                 ),
+                SearchField(
+                    name="embedding",
+                    type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+                    searchable=True,
+                    hidden=True,
+                    vector_search_dimensions=args.embeddingdimensions,
+                    vector_search_configuration="default",
+                ),
             ],
+            vector_search=VectorSearch(
+                algorithm_configurations=[
+                    VectorSearchAlgorithmConfiguration(
+                        name="default",
+                        kind="hnsw",
+                        hnsw_parameters=HnswParameters(metric="cosine"),
+                    )
+                ]
+            ),
             semantic_settings=SemanticSettings(
                 configurations=[
                     SemanticConfiguration(
@@ -1,14 +1,14 @@
 import os
+import sys
 import argparse
 import glob
 import html
-import io
+import json
 import re
 import time
-from pypdf import PdfReader, PdfWriter
+from pypdf import PdfReader
 from azure.identity import AzureDeveloperCliCredential
 from azure.core.credentials import AzureKeyCredential
-from azure.storage.blob import BlobServiceClient
 from azure.search.documents.indexes import SearchIndexClient, SearchIndexerClient
 from azure.search.documents.indexes.models import *
 from azure.search.documents import SearchClient
@@ -19,6 +19,14 @@ from azure.search.documents.indexes.models import (
     OcrSkill, WebApiSkill
 )
 from azure.ai.formrecognizer import DocumentAnalysisClient
+from prepdocslib.pipeline import Pipeline, Stage
+from prepdocslib.manifest import Manifest, hash_file, hash_section
+from prepdocslib.pagetext import assemble_page_text, tables_by_page
+from prepdocslib.splitter import TextSplitter
+from prepdocslib.pdfpages import iter_pdf_pages
+from prepdocslib.blobs import BlobManager
+from prepdocslib.embeddings import Embedder, EmbeddingCache, load_embeddings
+from prepdocslib.searchindex import IndexWriter, delete_keys, iter_keys, key_field_can_page, recreate_index
 
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
@@ -44,6 +52,21 @@ parser.add_argument("--removeall", action="store_true", help="Remove all blobs f
 parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents")
 parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure Form Recognizer service which will be used to extract text, tables and layout from the documents (must exist already)")
 parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)")
+parser.add_argument("--manifest", required=False, help="Optional. Path of a local SQLite manifest of indexed files and sections. When set, unchanged files are skipped and only changed sections of changed files are re-indexed")
+parser.add_argument("--workers", type=int, default=1, help="Optional. Number of files to process concurrently in each stage (blob upload, document analysis, splitting, indexing)")
+parser.add_argument("--uploadconcurrency", type=int, default=4, help="Optional. Number of blobs to upload or batches of blobs to delete at the same time per file. Also the most PDF pages kept in memory per file")
+parser.add_argument("--indexconcurrency", type=int, default=4, help="Optional. Number of batches of sections to upload to the search index at the same time")
+parser.add_argument("--deleteconcurrency", type=int, default=4, help="Optional. Number of batches of sections to delete from the search index at the same time")
+parser.add_argument("--recreateindex", action="store_true", help="Optional. With --removeall, delete and recreate the search index instead of deleting its sections, which is much faster for large indexes")
+parser.add_argument("--embeddings", required=False, help="Optional. Compute a vector for every section with 'azure' (Azure OpenAI, the default when --openaideployment is set), 'hashing' (local stand-in for offline use) or package.module:ClassName")
+parser.add_argument("--openaiservice", required=False, help="Optional. Name of the Azure OpenAI service used to compute embeddings")
+parser.add_argument("--openaideployment", required=False, help="Optional. Name of the Azure OpenAI embeddings model deployment (e.g. text-embedding-ada-002)")
+parser.add_argument("--openaikey", required=False, help="Optional. Use this Azure OpenAI account key instead of the current user identity to login (use az login to set current user for Azure)")
+parser.add_argument("--embeddingdimensions", type=int, default=1536, help="Optional. Size of the vectors, must match the embeddings model and is used for the vector field of new indexes")
+parser.add_argument("--embeddingbatchsize", type=int, default=16, help="Optional. Number of sections to embed in each request to the embeddings service")
+parser.add_argument("--embeddingconcurrency", type=int, default=4, help="Optional. Number of requests to the embeddings service in flight at the same time")
+parser.add_argument("--embeddingcache", required=False, help="Optional. Path of a local SQLite cache of embeddings by content hash, so unchanged sections are never embedded twice")
+parser.add_argument("--localindex", required=False, help="Optional. Path of a local search index directory (see app/backend/localsearch.py) to write sections to instead of an Azure Cognitive Search index")
 parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
 args = parser.parse_args()
 
@@ -59,6 +82,32 @@ if not args.localpdfparser:
         print("Error: Azure Form Recognizer service is not provided. Please provide formrecognizerservice or use --localpdfparser for local pypdf parser.")
         exit(1)
     formrecognizer_creds = default_creds if args.formrecognizerkey == None else AzureKeyCredential(args.formrecognizerkey)
+# A local index doesn't need --index, its entries in the manifest are named after its path instead
+manifest = Manifest(args.manifest, args.index or ("local:" + os.path.abspath(args.localindex) if args.localindex else None)) if args.manifest else None
+embedder = None
+if args.embeddings or args.openaideployment:
+    embeddings_kwargs = {"service": args.openaiservice, "deployment": args.openaideployment, "credential": azd_credential, "key": args.openaikey} if (args.embeddings or "azure") == "azure" else {}
+    embedder = Embedder(load_embeddings(args.embeddings or "azure", args.embeddingdimensions, **embeddings_kwargs), EmbeddingCache(args.embeddingcache),
+                        batch_size=args.embeddingbatchsize, concurrency=args.embeddingconcurrency, verbose=args.verbose)
+# The arguments that change the sections made from a file: with different ones (e.g. another category, parser or
+# embeddings model, or vectors for sections indexed without them), files and sections count as changed in the manifest
+manifest_identity = json.dumps({
+    "category": args.category,
+    "parser": "pypdf" if args.localpdfparser else "formrecognizer",
+    "embeddings": f"{embedder.embeddings.model}:{embedder.embeddings.dimensions}" if embedder else None,
+}, sort_keys=True)
+if args.localindex:
+    # The local index lives with the backend, which reads it with LocalSearchClient
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+    from localsearch import LocalIndexWriter
+    index_writer = LocalIndexWriter(args.localindex, verbose=args.verbose)
+else:
+    index_writer = IndexWriter(SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/", index_name=args.index, credential=search_creds),
+                               concurrency=args.indexconcurrency, verbose=args.verbose)
+blob_manager = None
+if not args.skipblobs:
+    blob_manager = BlobManager(f"https://{args.storageaccount}.blob.core.windows.net", args.container, storage_creds,
+                               max_concurrency=args.uploadconcurrency, pool_size=args.workers * args.uploadconcurrency, verbose=args.verbose)
 
 def blob_name_from_file_page(filename, page = 0):
     if os.path.splitext(filename)[1].lower() == ".pdf":
@@ -67,42 +116,26 @@ def blob_name_from_file_page(filename, page = 0):
         return os.path.basename(filename)
 
 def upload_blobs(filename):
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
-    if not blob_container.exists():
-        blob_container.create_container()
-
     # if file is PDF split into pages and upload each page as a separate blob
     if os.path.splitext(filename)[1].lower() == ".pdf":
-        reader = PdfReader(filename)
-        pages = reader.pages
-        for i in range(len(pages)):
-            blob_name = blob_name_from_file_page(filename, i)
-            if args.verbose: print(f"\tUploading blob for page {i} -> {blob_name}")
-            f = io.BytesIO()
-            writer = PdfWriter()
-            writer.add_page(pages[i])
-            writer.write(f)
-            f.seek(0)
-            blob_container.upload_blob(blob_name, f, overwrite=True)
+        with open(filename, "rb") as f:
+            blob_manager.upload_pages(iter_pdf_pages(f), lambda i: blob_name_from_file_page(filename, i))
     else:
-        blob_name = blob_name_from_file_page(filename)
         with open(filename,"rb") as data:
-            blob_container.upload_blob(blob_name, data, overwrite=True)
+            blob_manager.upload(blob_name_from_file_page(filename), data)
 
 def remove_blobs(filename):
+    if args.skipblobs:
+        return
     if args.verbose: print(f"Removing blobs for '{filename or '<all>'}'")
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
-    if blob_container.exists():
-        if filename == None:
-            blobs = blob_container.list_blob_names()
-        else:
-            prefix = os.path.splitext(os.path.basename(filename))[0]
-            blobs = filter(lambda b: re.match(f"{prefix}-\d+\.pdf", b), blob_container.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0]))
-        for b in blobs:
-            if args.verbose: print(f"\tRemoving blob {b}")
-            blob_container.delete_blob(b)
+    if filename == None:
+        blobs = blob_manager.list_names()
+    else:
+        prefix = os.path.splitext(os.path.basename(filename))[0]
+        blobs = filter(lambda b: re.match(f"{prefix}-\d+\.pdf", b), blob_manager.list_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0]))
+    failed = blob_manager.delete(blobs)
+    if failed:
+        raise Exception(f"Could not remove {len(failed)} blobs for '{filename or '<all>'}', first one is {failed[0]}")
 
 def table_to_html(table):
     table_html = "<table>"
@@ -123,12 +156,13 @@ def get_document_text(filename):
     offset = 0
     page_map = []
     if args.localpdfparser:
-        reader = PdfReader(filename)
-        pages = reader.pages
-        for page_num, p in enumerate(pages):
-            page_text = p.extract_text()
-            page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
+        with open(filename, "rb") as f:
+            reader = PdfReader(f)
+            pages = reader.pages
+            for page_num, p in enumerate(pages):
+                page_text = p.extract_text()
+                page_map.append((page_num, offset, page_text))
+                offset += len(page_text)
     else:
         if args.verbose: print(f"Extracting text from '{filename}' using Azure Form Recognizer")
         form_recognizer_client = DocumentAnalysisClient(endpoint=f"https://{args.formrecognizerservice}.cognitiveservices.azure.com/", credential=formrecognizer_creds, headers={"x-ms-useragent": "azure-search-chat-demo/1.0.0"})
@@ -136,99 +170,22 @@ def get_document_text(filename):
             poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document = f)
         form_recognizer_results = poller.result()
 
+        tables = tables_by_page(form_recognizer_results.tables)
         for page_num, page in enumerate(form_recognizer_results.pages):
-            tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-            # mark all positions of the table spans in the page
-            page_offset = page.spans[0].offset
-            page_length = page.spans[0].length
-            table_chars = [-1]*page_length
-            for table_id, table in enumerate(tables_on_page):
-                for span in table.spans:
-                    # replace all table spans with "table_id" in table_chars array
-                    for i in range(span.length):
-                        idx = span.offset - page_offset + i
-                        if idx >=0 and idx < page_length:
-                            table_chars[idx] = table_id
-
-            # build page text by replacing charcters in table spans with table html
-            page_text = ""
-            added_tables = set()
-            for idx, table_id in enumerate(table_chars):
-                if table_id == -1:
-                    page_text += form_recognizer_results.content[page_offset + idx]
-                elif not table_id in added_tables:
-                    page_text += table_to_html(tables_on_page[table_id])
-                    added_tables.add(table_id)
-
+            # build page text by replacing the table spans with table html
+            page_text = assemble_page_text(form_recognizer_results.content, page.spans[0].offset, page.spans[0].length, tables.get(page_num + 1, []), table_to_html)
             page_text += " "
             page_map.append((page_num, offset, page_text))
             offset += len(page_text)
 
     return page_map
 
-def split_text(page_map):
-    SENTENCE_ENDINGS = [".", "!", "?"]
-    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+def split_text(page_map, filename):
     if args.verbose: print(f"Splitting '{filename}' into sections")
-
-    def find_page(offset):
-        l = len(page_map)
-        for i in range(l - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return l - 1
-
-    all_text = "".join(p[2] for p in page_map)
-    length = len(all_text)
-    start = 0
-    end = length
-    while start + SECTION_OVERLAP < length:
-        last_word = -1
-        end = start + MAX_SECTION_LENGTH
-
-        if end > length:
-            end = length
-        else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word # Fall back to at least keeping a whole word
-        if end < length:
-            end += 1
-
-        # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
-        if start > 0:
-            start += 1
-
-        section_text = all_text[start:end]
-        yield (section_text, find_page(start))
-
-        last_table_start = section_text.rfind("<table")
-        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
-            # If the section ends with an unclosed table, we need to start the next section with the table.
-            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
-            # If last table starts inside SECTION_OVERLAP, keep overlapping
-            if args.verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
-            start = min(end - SECTION_OVERLAP, start + last_table_start)
-        else:
-            start = end - SECTION_OVERLAP
-        
-    if start + SECTION_OVERLAP < end:
-        yield (all_text[start:end], find_page(start))
+    return TextSplitter(MAX_SECTION_LENGTH, SENTENCE_SEARCH_LIMIT, SECTION_OVERLAP, verbose=args.verbose).split(page_map)
 
 def create_sections(filename, page_map):
-    for i, (section, pagenum) in enumerate(split_text(page_map)):
+    for i, (section, pagenum) in enumerate(split_text(page_map, filename)):
         yield {
             "id": re.sub("[^0-9a-zA-Z_-]","_",f"{filename}-{i}"),
             "content": section,
@@ -238,6 +195,8 @@ def create_sections(filename, page_map):
         }
 
 def create_search_index():
+    if args.localindex:
+        return
     if args.verbose: print(f"Ensuring search index {args.index} exists")
     endpoint = f"https://{args.searchservice}.search.windows.net/"
     index_client = SearchIndexClient(endpoint=endpoint,
@@ -246,12 +205,17 @@ def create_search_index():
         index = SearchIndex(
             name=args.index,
             fields=[
-                SimpleField(name="id", type="Edm.String", key=True),
+                SimpleField(name="id", type="Edm.String", key=True, filterable=True, sortable=True),
                 SearchableField(name="content", type="Edm.String", analyzer_name="en.microsoft"),
                 SimpleField(name="category", type="Edm.String", filterable=True, facetable=True),
                 SimpleField(name="sourcepage", type="Edm.String", filterable=True, facetable=True),
-                SimpleField(name="sourcefile", type="Edm.String", filterable=True, facetable=True)
+                SimpleField(name="sourcefile", type="Edm.String", filterable=True, facetable=True),
+                SearchField(name="embedding", type=SearchFieldDataType.Collection(SearchFieldDataType.Single), searchable=True, hidden=True,
+                            vector_search_dimensions=args.embeddingdimensions, vector_search_configuration="default")
             ],
+            vector_search=VectorSearch(
+                algorithm_configurations=[VectorSearchAlgorithmConfiguration(
+                    name="default", kind="hnsw", hnsw_parameters=HnswParameters(metric="cosine"))]),
             semantic_settings=SemanticSettings(
                 configurations=[SemanticConfiguration(
                     name='default',
@@ -312,34 +276,49 @@ def create_search_index():
         if args.verbose: print(f"Search index {args.index} already exists")
 
 def index_sections(filename, sections):
-    if args.verbose: print(f"Indexing sections from '{filename}' into search index '{args.index}'")
-    search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
-                                    index_name=args.index,
-                                    credential=search_creds)
-    i = 0
-    batch = []
-    for s in sections:
-        batch.append(s)
-        i += 1
-        if i % 1000 == 0:
-            results = search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
-            batch = []
-
-    if len(batch) > 0:
-        results = search_client.upload_documents(documents=batch)
-        succeeded = sum([1 for r in results if r.succeeded])
-        if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+    if args.verbose: print(f"Indexing sections from '{filename}' into search index '{args.localindex or args.index}'")
+    return index_writer.upload(sections)
+
+def remove_sections(filename, ids):
+    if args.verbose: print(f"Removing {len(ids)} sections no longer in '{filename}' from search index '{args.localindex or args.index}'")
+    if args.localindex:
+        index_writer.delete(ids)
+        return
+    delete_section_keys([ids[i:i + 1000] for i in range(0, len(ids), 1000)])
+
+def delete_section_keys(batches):
+    count, failed = delete_keys(f"https://{args.searchservice}.search.windows.net/", args.index, search_creds, batches, concurrency=args.deleteconcurrency, verbose=args.verbose)
+    if failed:
+        raise Exception(f"Could not remove {len(failed)} of {count} sections from search index '{args.index}', first one is {failed[0]}")
+    return count
 
 def remove_from_index(filename):
-    if args.verbose: print(f"Removing sections from '{filename or '<all>'}' from search index '{args.index}'")
-    search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
+    if args.verbose: print(f"Removing sections from '{filename or '<all>'}' from search index '{args.localindex or args.index}'")
+    if args.localindex:
+        count = index_writer.delete_where(None if filename == None else "sourcefile", None if filename == None else os.path.basename(filename))
+        if args.verbose: print(f"\tRemoved {count} sections from index")
+        return
+    endpoint = f"https://{args.searchservice}.search.windows.net/"
+    index_client = SearchIndexClient(endpoint=endpoint, credential=search_creds)
+    if filename == None and args.recreateindex:
+        if args.verbose: print(f"\tDeleting and recreating search index '{args.index}'")
+        recreate_index(index_client, args.index)
+        return
+
+    search_client = SearchClient(endpoint=endpoint,
                                     index_name=args.index,
                                     credential=search_creds)
+    filter = None if filename == None else "sourcefile eq '{}'".format(os.path.basename(filename).replace("'", "''"))
+    if key_field_can_page(index_client, args.index):
+        count = delete_section_keys(iter_keys(search_client, filter=filter))
+        if args.verbose: print(f"\tRemoved {count} sections from index")
+        return
+
+    # The id field of indexes created by older versions of this script isn't sortable, so keep deleting the first
+    # page of matches until there are none left
+    if args.verbose: print(f"\tThe id field of search index '{args.index}' is not filterable and sortable, recreate the index to remove sections faster")
     while True:
-        filter = None if filename == None else f"sourcefile eq '{os.path.basename(filename)}'"
-        r = search_client.search("", filter=filter, top=1000, include_total_count=True)
+        r = search_client.search("", filter=filter, select=["id"], top=1000, include_total_count=True)
         if r.get_count() == 0:
             break
         r = search_client.delete_documents(documents=[{ "id": d["id"] } for d in r])
@@ -347,25 +326,103 @@ def remove_from_index(filename):
         # It can take a few seconds for search results to reflect changes, so wait a bit
         time.sleep(2)
 
+def mark_index_updated():
+    if args.localindex:
+        # Backends reading the local index switch to the new generation (and stop using cached results) on their own
+        index_writer.save()
+        return
+    # Running backends cache search results until they see a new "indexversion" on the container (see app/backend/retrieval.py)
+    if args.skipblobs:
+        if args.verbose: print("Not updating the index version since blobs are skipped, backends will serve cached search results until they expire")
+        return
+    blob_manager.update_metadata(indexversion=str(time.time()))
+
 if args.removeall:
     remove_blobs(None)
     remove_from_index(None)
+    if manifest: manifest.remove(None)
+    mark_index_updated()
 else:
     if not args.remove:
         create_search_index()
     
     print(f"Processing files...")
-    for filename in glob.glob(args.files):
-        if args.verbose: print(f"Processing '{filename}'")
-        if args.remove:
+    failures = []
+    if args.remove:
+        for filename in glob.glob(args.files):
+            if args.verbose: print(f"Processing '{filename}'")
             remove_blobs(filename)
             remove_from_index(filename)
-        elif args.removeall:
-            remove_blobs(None)
-            remove_from_index(None)
-        else:
+            if manifest: manifest.remove(os.path.basename(filename))
+    else:
+        # Each file goes through the stages below in order, with up to args.workers files in each stage at a time
+        def upload_stage(filename):
+            file_hash = hash_file(filename, manifest_identity) if manifest else None
+            if manifest and manifest.file_hash(os.path.basename(filename)) == file_hash:
+                if args.verbose: print(f"Skipping '{filename}', unchanged since it was last indexed")
+                return None
+            if args.verbose: print(f"Processing '{filename}'")
             if not args.skipblobs:
                 upload_blobs(filename)
-            page_map = get_document_text(filename)
-            sections = create_sections(os.path.basename(filename), page_map)
-            index_sections(os.path.basename(filename), sections)
+            return {"filename": filename, "hash": file_hash}
+
+        def analyze_stage(item):
+            item["page_map"] = get_document_text(item["filename"])
+            return item
+
+        def split_stage(item):
+            filename = os.path.basename(item["filename"])
+            sections = list(create_sections(filename, item.pop("page_map")))
+            if not manifest:
+                item["changed"] = sections
+                return item
+            # Only the sections that changed since the last run are embedded and sent, and the ones that are gone deleted
+            item["hashes"] = {s["id"]: hash_section(s, manifest_identity) for s in sections}
+            previous = manifest.section_hashes(filename)
+            item["changed"] = [s for s in sections if previous.get(s["id"]) != item["hashes"][s["id"]]]
+            item["removed"] = [id for id in previous if id not in item["hashes"]]
+            if args.verbose: print(f"'{filename}' has {len(item['changed'])} new or changed sections and {len(item['removed'])} removed sections")
+            return item
+
+        def embed_stage(item):
+            sections = item["changed"]
+            if args.verbose: print(f"Computing embeddings for '{item['filename']}'")
+            for section, vector in zip(sections, embedder.embed([s["content"] for s in sections])):
+                section["embedding"] = vector
+            return item
+
+        def index_stage(item):
+            filename = os.path.basename(item["filename"])
+            changed = item.pop("changed")
+            if not manifest:
+                failed = index_sections(filename, changed)
+                if failed:
+                    raise Exception(f"{len(failed)} sections could not be indexed, first one is {failed[0]}")
+                return
+            hashes, removed = item["hashes"], item["removed"]
+            failed = index_sections(filename, changed)
+            if removed:
+                remove_sections(filename, removed)
+            # Sections that didn't make it into the index are left out of the manifest so the next run retries them
+            for id in failed:
+                hashes.pop(id, None)
+            manifest.update(filename, None if failed else item["hash"], hashes)
+            if failed:
+                raise Exception(f"{len(failed)} sections could not be indexed and will be retried on the next run, first one is {failed[0]}")
+
+        stages = [
+            Stage("upload blobs", upload_stage, args.workers),
+            Stage("analyze", analyze_stage, args.workers),
+            Stage("split", split_stage, min(args.workers, os.cpu_count() or 1)),
+            Stage("index", index_stage, args.workers)
+        ]
+        if embedder:
+            stages.insert(3, Stage("embed", embed_stage, args.workers))
+        pipeline = Pipeline(stages, verbose=args.verbose)
+        failures = pipeline.run(glob.glob(args.files))
+        if args.verbose: print(f"Indexed {index_writer.throughput()}")
+        for stage, item, e in failures:
+            print(f"Failed to process '{item if isinstance(item, str) else item['filename']}' in stage '{stage}': {e}")
+    mark_index_updated()
+    if failures:
+        exit(1)
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Callable, Iterable, Iterator, List, Optional, Tuple
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient
+from prepdocslib.pdfpages import upload_pages
+
+# Blob Batch requests can hold at most 256 sub-requests
+DELETE_BATCH_SIZE = 256
+
+# All the blob storage calls made by one prepdocs.py run go through one of these. The container client (and its
+# connection pool, sized for the number of concurrent requests we make) is created once, the container is checked or
+# created once, uploads of PDF pages run up to max_concurrency at a time and deletes use the batch API.
+class BlobManager:
+    def __init__(self, account_url: str, container: str, credential, max_concurrency: int = 4, pool_size: Optional[int] = None, verbose: bool = False):
+        self.max_concurrency = max(1, max_concurrency)
+        self.verbose = verbose
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size or 0, self.max_concurrency, 10))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self.blob_service = BlobServiceClient(account_url=account_url, credential=credential, transport=RequestsTransport(session=session, session_owner=False))
+        self.container = self.blob_service.get_container_client(container)
+        self.lock = threading.Lock()
+        self.container_exists: Optional[bool] = None
+
+    def exists(self) -> bool:
+        with self.lock:
+            if self.container_exists is None:
+                self.container_exists = self.container.exists()
+            return self.container_exists
+
+    def ensure_container(self):
+        with self.lock:
+            if not self.container_exists:
+                if not self.container.exists():
+                    self.container.create_container()
+                self.container_exists = True
+
+    def upload(self, blob_name: str, data: IO[bytes]):
+        self.ensure_container()
+        if self.verbose: print(f"\tUploading blob {blob_name}")
+        self.container.upload_blob(blob_name, data, overwrite=True)
+
+    def upload_pages(self, pages: Iterator[Tuple[int, IO[bytes]]], blob_name: Callable[[int], str]) -> int:
+        self.ensure_container()
+        def upload_page(i, data):
+            if self.verbose: print(f"\tUploading blob for page {i} -> {blob_name(i)}")
+            self.container.upload_blob(blob_name(i), data, overwrite=True)
+        return upload_pages(pages, upload_page, self.max_concurrency)
+
+    def list_names(self, name_starts_with: Optional[str] = None) -> Iterable[str]:
+        if not self.exists():
+            return []
+        return self.container.list_blob_names(name_starts_with=name_starts_with)
+
+    def delete(self, blob_names: Iterable[str]) -> List[str]:
+        # Returns the names of the blobs that could not be deleted. Blobs that are already gone don't count as failures
+        batches = []
+        batch = []
+        for name in blob_names:
+            batch.append(name)
+            if len(batch) == DELETE_BATCH_SIZE:
+                batches.append(batch)
+                batch = []
+        if batch:
+            batches.append(batch)
+        if not batches:
+            return []
+
+        def delete_batch(names):
+            if self.verbose: print(f"\tRemoving {len(names)} blobs, from {names[0]} to {names[-1]}")
+            responses = self.container.delete_blobs(*names, raise_on_any_failure=False)
+            return [name for name, r in zip(names, responses) if r.status_code not in (202, 404)]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            return [name for failed in executor.map(delete_batch, batches) for name in failed]
+
+    def update_metadata(self, **values: str):
+        if not self.exists():
+            return
+        metadata = self.container.get_container_properties().metadata
+        metadata.update(values)
+        self.container.set_container_metadata(metadata)
@@ -0,0 +1,159 @@
+import hashlib
+import importlib
+import random
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+# Something that turns a list of texts into vectors. `model` identifies the vectors in the cache, so two services that
+# produce different vectors must not share a model name. Implementations can be plugged into prepdocs.py with
+# --embeddings package.module:ClassName, the class is created with dimensions=--embeddingdimensions.
+class Embeddings:
+    model = "embeddings"
+    dimensions = 1536
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    def should_retry(self, e: Exception) -> bool:
+        return False
+
+class AzureOpenAIEmbeddings(Embeddings):
+    def __init__(self, service: str, deployment: str, credential = None, key: Optional[str] = None, dimensions: int = 1536):
+        import openai
+        self.openai = openai
+        self.api_base = f"https://{service}.openai.azure.com"
+        self.deployment = deployment
+        self.credential = credential
+        self.key = key
+        self.model = f"azure-openai:{service}/{deployment}"
+        self.dimensions = dimensions
+        self.token = None
+        self.lock = threading.Lock()
+
+    def api_key(self) -> str:
+        if self.key:
+            return self.key
+        with self.lock:
+            if self.token is None or self.token.expires_on < time.time() + 60:
+                self.token = self.credential.get_token("https://cognitiveservices.azure.com/.default")
+            return self.token.token
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        r = self.openai.Embedding.create(engine=self.deployment, input=texts,
+                                         api_type="azure" if self.key else "azure_ad", api_key=self.api_key(),
+                                         api_base=self.api_base, api_version="2022-12-01")
+        return [d["embedding"] for d in sorted(r["data"], key=lambda d: d["index"])]
+
+    def should_retry(self, e: Exception) -> bool:
+        errors = self.openai.error
+        return isinstance(e, (errors.RateLimitError, errors.ServiceUnavailableError, errors.APIConnectionError, errors.Timeout, errors.TryAgain))
+
+# Local stand-in for an embeddings service, for offline development and load tests: hashes the words of a text into a
+# fixed number of buckets. Texts that share words get similar vectors, which is enough to exercise vector and hybrid
+# retrieval end to end, but it's not a language model.
+class HashingEmbeddings(Embeddings):
+    def __init__(self, dimensions: int = 1536):
+        self.dimensions = dimensions
+        self.model = f"hashing:{dimensions}"
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_one(text) for text in texts]
+
+    def embed_one(self, text: str) -> List[float]:
+        v = [0.0] * self.dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            v[h % self.dimensions] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = sum(x * x for x in v) ** 0.5 or 1.0
+        return [x / norm for x in v]
+
+def load_embeddings(name: str, dimensions: int = 1536, **kwargs) -> Embeddings:
+    if name == "azure":
+        return AzureOpenAIEmbeddings(dimensions=dimensions, **kwargs)
+    if name == "hashing":
+        return HashingEmbeddings(dimensions=dimensions)
+    module, _, cls = name.partition(":")
+    if not cls:
+        raise ValueError(f"Unknown embeddings '{name}', use azure, hashing or package.module:ClassName")
+    return getattr(importlib.import_module(module), cls)(dimensions=dimensions)
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# Vectors by model and text hash, so unchanged text is never sent to the embeddings service twice. In memory unless a
+# path is given, then kept in a local SQLite file across runs.
+class EmbeddingCache:
+    def __init__(self, path: Optional[str] = None):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))")
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self.lock:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                rows = self.db.execute(f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})", [model] + chunk).fetchall()
+                for h, blob in rows:
+                    found[h] = array("f", blob).tolist()
+        return found
+
+    def set_many(self, model: str, vectors: Dict[str, List[float]]):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+                                [(model, h, array("f", v).tobytes()) for h, v in vectors.items()])
+
+# Embeds texts for the ingestion pipeline. Cached vectors are reused, the remaining distinct texts are sent batch_size
+# at a time, and at most `concurrency` requests are in flight across all the threads using the embedder. Requests that
+# fail with an error the embeddings class says is transient (throttling, timeouts) are retried with backoff.
+class Embedder:
+    def __init__(self, embeddings: Embeddings, cache: Optional[EmbeddingCache] = None, batch_size: int = 16, concurrency: int = 4,
+                 max_retries: int = 6, verbose: bool = False):
+        self.embeddings = embeddings
+        self.cache = cache or EmbeddingCache()
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.max_retries = max_retries
+        self.verbose = verbose
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(t) for t in texts]
+        vectors = self.cache.get_many(self.embeddings.model, list(set(hashes)))
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in vectors:
+                missing[h] = t
+        if self.verbose: print(f"\tEmbedding {len(missing)} sections, {len(texts) - len(missing)} found in the cache")
+
+        if missing:
+            items = list(missing.items())
+            batches = [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as executor:
+                for batch_vectors in executor.map(self.embed_batch, batches):
+                    self.cache.set_many(self.embeddings.model, batch_vectors)
+                    vectors.update(batch_vectors)
+        return [vectors[h] for h in hashes]
+
+    def embed_batch(self, batch) -> Dict[str, List[float]]:
+        attempt = 0
+        while True:
+            try:
+                with self.slots:
+                    result = self.embeddings.embed([t for _, t in batch])
+                # Rounded to float32 like the cached and indexed vectors, so a vector is the same whether it was just
+                # computed or came from the cache
+                return {h: array("f", v).tolist() for (h, _), v in zip(batch, result)}
+            except Exception as e:
+                if attempt >= self.max_retries or not self.embeddings.should_retry(e):
+                    raise
+                delay = min(60, 2 ** attempt) * random.uniform(0.5, 1)
+                if self.verbose: print(f"\tRetrying embeddings request in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                attempt += 1
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+# `identity` is what else decides how a file is indexed (e.g. the category, PDF parser and embeddings model), so
+# changing it makes every file and section look changed and be processed again
+def hash_file(filename: str, identity: str = "") -> str:
+    h = hashlib.sha256(identity.encode())
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hash_section(section: dict, identity: str = "") -> str:
+    # Hashes the content and fields of a section before it's embedded, the vector is covered by the identity
+    fields = {k: v for k, v in section.items() if k != "embedding"}
+    return hashlib.sha256((identity + "\n" + json.dumps(fields, sort_keys=True)).encode()).hexdigest()
+
+# Local SQLite record of what was last indexed: the content hash of every file, and the hash of every section
+# created from it. Entries are per index, so the same manifest can be used for several indexes.
+class Manifest:
+    def __init__(self, path: str, index_name: str):
+        # SQLite never matches a NULL index name, so nothing would ever be found as indexed
+        if not index_name:
+            raise ValueError("The manifest needs the name of the index it describes")
+        self.index_name = index_name
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS files (index_name TEXT, filename TEXT, hash TEXT, PRIMARY KEY (index_name, filename))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS sections (index_name TEXT, filename TEXT, id TEXT, hash TEXT, PRIMARY KEY (index_name, id))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS sections_by_file ON sections (index_name, filename)")
+
+    def file_hash(self, filename: str) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute("SELECT hash FROM files WHERE index_name = ? AND filename = ?", (self.index_name, filename)).fetchone()
+        return row[0] if row else None
+
+    def section_hashes(self, filename: str) -> Dict[str, str]:
+        with self.lock:
+            rows = self.db.execute("SELECT id, hash FROM sections WHERE index_name = ? AND filename = ?", (self.index_name, filename)).fetchall()
+        return dict(rows)
+
+    def update(self, filename: str, file_hash: str, section_hashes: Dict[str, str]):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM sections WHERE index_name = ? AND filename = ?", (self.index_name, filename))
+            self.db.executemany("INSERT OR REPLACE INTO sections (index_name, filename, id, hash) VALUES (?, ?, ?, ?)",
+                                [(self.index_name, filename, id, h) for id, h in section_hashes.items()])
+            self.db.execute("INSERT OR REPLACE INTO files (index_name, filename, hash) VALUES (?, ?, ?)", (self.index_name, filename, file_hash))
+
+    def remove(self, filename: Optional[str] = None):
+        with self.lock, self.db:
+            if filename is None:
+                self.db.execute("DELETE FROM sections WHERE index_name = ?", (self.index_name,))
+                self.db.execute("DELETE FROM files WHERE index_name = ?", (self.index_name,))
+            else:
+                self.db.execute("DELETE FROM sections WHERE index_name = ? AND filename = ?", (self.index_name, filename))
+                self.db.execute("DELETE FROM files WHERE index_name = ? AND filename = ?", (self.index_name, filename))
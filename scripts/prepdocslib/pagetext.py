@@ -0,0 +1,48 @@
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Builds the text of one page from the Form Recognizer content, replacing the characters covered by each table's
+# spans with the table's html, inserted where the table first appears on the page. Works on span intervals and
+# slices of content instead of single characters, so the cost is in the number of spans rather than the page length.
+# Where spans of different tables overlap, the later table wins, as it always has.
+def assemble_page_text(content: str, page_offset: int, page_length: int, tables: Sequence, table_to_html: Callable) -> str:
+    page_end = page_offset + page_length
+    intervals: List[Tuple[int, int, int]] = []
+    for table_id, table in enumerate(tables):
+        for span in table.spans:
+            start = max(span.offset, page_offset)
+            end = min(span.offset + span.length, page_end)
+            if start < end:
+                intervals.append((start, end, table_id))
+
+    if not intervals:
+        return content[page_offset:page_end]
+
+    # Cut the page at every span boundary. Each piece is either plain text or belongs to the last table covering it
+    boundaries = sorted({page_offset, page_end}.union(*[(start, end) for start, end, _ in intervals]))
+    intervals.sort()
+    parts = []
+    added_tables = set()
+    active: Dict[int, int] = {}
+    next_interval = 0
+    for start, end in zip(boundaries, boundaries[1:]):
+        while next_interval < len(intervals) and intervals[next_interval][0] <= start:
+            _, interval_end, table_id = intervals[next_interval]
+            active[table_id] = max(active.get(table_id, 0), interval_end)
+            next_interval += 1
+        for table_id in [t for t, interval_end in active.items() if interval_end <= start]:
+            del active[table_id]
+
+        if not active:
+            parts.append(content[start:end])
+        else:
+            table_id = max(active)
+            if table_id not in added_tables:
+                parts.append(table_to_html(tables[table_id]))
+                added_tables.add(table_id)
+    return "".join(parts)
+
+def tables_by_page(tables: Sequence) -> Dict[int, list]:
+    pages: Dict[int, list] = {}
+    for table in tables:
+        pages.setdefault(table.bounding_regions[0].page_number, []).append(table)
+    return pages
@@ -0,0 +1,47 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Callable, Iterator, Tuple
+from pypdf import PdfReader, PdfWriter
+
+# Splits a PDF into single page PDFs, one page at a time. The reader gets an open file rather than a path (given a
+# path, pypdf reads the whole file into memory), and the objects parsed for a page are dropped once the page has been
+# written out, so memory follows the size of a page instead of growing with the document.
+def iter_pdf_pages(stream: IO[bytes]) -> Iterator[Tuple[int, io.BytesIO]]:
+    reader = PdfReader(stream)
+    for i in range(len(reader.pages)):
+        f = io.BytesIO()
+        writer = PdfWriter()
+        writer.add_page(reader.pages[i])
+        writer.write(f)
+        f.seek(0)
+        del writer
+        reader.resolved_objects.clear()
+        yield i, f
+
+# Calls upload(page_num, data) for each page on up to max_concurrency threads. The next page is only produced once
+# a slot is free, so at most max_concurrency pages are held in memory at a time. Every page is attempted, and the
+# first error (if any) is raised once they are all done.
+def upload_pages(pages: Iterator[Tuple[int, IO[bytes]]], upload: Callable[[int, IO[bytes]], None], max_concurrency: int = 4) -> int:
+    max_concurrency = max(1, max_concurrency)
+    slots = threading.BoundedSemaphore(max_concurrency)
+
+    def upload_page(page_num, data):
+        try:
+            upload(page_num, data)
+        finally:
+            data.close()
+            slots.release()
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while True:
+            slots.acquire()
+            page = next(pages, None)
+            if page is None:
+                slots.release()
+                break
+            futures.append(executor.submit(upload_page, *page))
+    for future in futures:
+        future.result()
+    return len(futures)
@@ -0,0 +1,82 @@
+import queue
+import threading
+import time
+import traceback
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+_DONE = object()
+
+# One step of a Pipeline. func receives an item and returns the item to pass on, or None to drop it.
+class Stage:
+    def __init__(self, name: str, func: Callable[[Any], Any], workers: int = 1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.busy = 0.0
+        self.count = 0
+
+# Runs items through a sequence of stages, each with its own pool of worker threads. Stages are connected by
+# bounded queues, so a slow stage blocks the ones before it instead of letting work pile up in memory: at most
+# queue_size items wait in front of each stage. An item that fails in a stage is recorded in failures and dropped,
+# the rest of the items keep going.
+class Pipeline:
+    def __init__(self, stages: List[Stage], queue_size: Optional[int] = None, verbose: bool = False):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.verbose = verbose
+        self.failures: List[Tuple[str, Any, Exception]] = []
+        self.lock = threading.Lock()
+
+    def run(self, items: Iterable[Any]) -> List[Tuple[str, Any, Exception]]:
+        queues = [queue.Queue(maxsize=self.queue_size or 2 * stage.workers) for stage in self.stages]
+        queues.append(None)
+        threads = []
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            for _ in range(stage.workers):
+                t = threading.Thread(target=self._work, args=(stage, queues[i], queues[i + 1], remaining, self.stages[i + 1].workers if i + 1 < len(self.stages) else 0), daemon=True)
+                t.start()
+                threads.append(t)
+
+        start = time.time()
+        for item in items:
+            queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_DONE)
+        for t in threads:
+            t.join()
+
+        if self.verbose:
+            elapsed = time.time() - start
+            for stage in self.stages:
+                print(f"\tStage '{stage.name}': {stage.count} items, {stage.busy:.1f}s busy across {stage.workers} workers")
+            print(f"\tPipeline finished in {elapsed:.1f}s with {len(self.failures)} failures")
+        return self.failures
+
+    def _work(self, stage: Stage, inbox: queue.Queue, outbox: Optional[queue.Queue], remaining: List[int], next_workers: int):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            started = time.time()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                with self.lock:
+                    self.failures.append((stage.name, item, e))
+                print(f"Error in stage '{stage.name}' for {item}: {e}")
+                if self.verbose: traceback.print_exc()
+                result = None
+            with self.lock:
+                stage.busy += time.time() - started
+                stage.count += 1
+            if result is not None and outbox is not None:
+                outbox.put(result)
+
+        # The last worker of a stage to finish tells the next stage there's nothing more coming
+        with self.lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and outbox is not None:
+            for _ in range(next_workers):
+                outbox.put(_DONE)
@@ -0,0 +1,190 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents import SearchClient, SearchIndexingBufferedSender
+from azure.search.documents.indexes import SearchIndexClient
+
+def key_field_can_page(index_client: SearchIndexClient, index_name: str, key_field: str = "id") -> bool:
+    # Paging by key needs to filter and sort on it, indexes created before the key was made filterable and sortable
+    # can't be paged this way
+    for field in index_client.get_index(index_name).fields:
+        if field.name == key_field:
+            return bool(field.filterable and field.sortable)
+    return False
+
+# Pages through the keys of the documents matching filter in key order, fetching only the keys. Each page starts after
+# the last key of the previous one instead of re-running the same query, so pages don't depend on deletes having
+# become visible and can be requested while earlier pages are still being deleted.
+def iter_keys(search_client: SearchClient, filter: Optional[str] = None, key_field: str = "id", page_size: int = 1000) -> Iterator[List[str]]:
+    last = None
+    while True:
+        after = None if last is None else "{} gt '{}'".format(key_field, last.replace("'", "''"))
+        page_filter = " and ".join(f"({f})" for f in [filter, after] if f) or None
+        r = search_client.search("", filter=page_filter, order_by=[f"{key_field} asc"], select=[key_field], top=page_size)
+        keys = [d[key_field] for d in r]
+        if keys:
+            yield keys
+        if len(keys) < page_size:
+            break
+        last = keys[-1]
+
+# Deletes batches of keys on up to `concurrency` threads, each with its own SearchIndexingBufferedSender (which splits
+# batches that are too large and retries failed keys). At most `concurrency` batches are waiting or in flight, so a
+# fast key pager doesn't run far ahead of the deletes. Returns the number of keys sent and the keys that failed.
+def delete_keys(endpoint: str, index_name: str, credential, batches: Iterable[List[str]], key_field: str = "id", concurrency: int = 4, verbose: bool = False) -> Tuple[int, List[str]]:
+    concurrency = max(1, concurrency)
+    slots = threading.BoundedSemaphore(concurrency)
+    local = threading.local()
+    senders = []
+    failed = []
+    lock = threading.Lock()
+
+    def on_error(action):
+        with lock:
+            failed.append(action.additional_properties.get(key_field))
+
+    def delete_batch(keys):
+        try:
+            sender = getattr(local, "sender", None)
+            if sender is None:
+                sender = local.sender = SearchIndexingBufferedSender(endpoint, index_name, credential, auto_flush=False, on_error=on_error)
+                with lock:
+                    senders.append(sender)
+            sender.delete_documents(documents=[{ key_field: k } for k in keys])
+            sender.flush()
+            if verbose: print(f"\tRemoved {len(keys)} sections from index")
+        finally:
+            slots.release()
+
+    count = 0
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for keys in batches:
+                slots.acquire()
+                futures.append(executor.submit(delete_batch, keys))
+                count += len(keys)
+        for future in futures:
+            future.result()
+    finally:
+        for sender in senders:
+            sender.close()
+    return count, failed
+
+# Fastest way to empty an index: delete it and create it again from its own definition
+def recreate_index(index_client: SearchIndexClient, index_name: str):
+    index = index_client.get_index(index_name)
+    index_client.delete_index(index_name)
+    index.e_tag = None
+    index_client.create_index(index)
+
+# Per document status codes worth trying again, everything else (such as a 400 for a bad document) fails for good
+RETRYABLE_STATUS_CODES = (409, 422, 429, 500, 503)
+
+# Uploads documents in batches capped both by count and by serialized size (requests are limited to 16 MB), with up to
+# `concurrency` batches in flight. Producing documents blocks while that many batches are already queued, so a fast
+# producer can't build up an unbounded backlog. Documents that fail with a retryable status, and whole batches that
+# are throttled, are retried with exponential backoff, only resending the documents that failed. Keys that still fail
+# after max_retries are returned by upload() instead of being dropped.
+class IndexWriter:
+    def __init__(self, search_client: SearchClient, key_field: str = "id", max_batch_count: int = 1000, max_batch_bytes: int = 12 * 1024 * 1024,
+                 concurrency: int = 4, max_retries: int = 5, initial_backoff: float = 1, max_backoff: float = 60, verbose: bool = False):
+        self.search_client = search_client
+        self.key_field = key_field
+        self.max_batch_count = max_batch_count
+        self.max_batch_bytes = max_batch_bytes
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.documents = 0
+        self.bytes = 0
+        self.retries = 0
+        self.started = None
+        self.finished = None
+
+    def upload(self, documents: Iterable[dict]) -> List[str]:
+        slots = threading.BoundedSemaphore(self.concurrency)
+        failed = []
+        futures = []
+
+        def send(batch, size):
+            try:
+                failed_keys = self.send_with_retries(batch)
+                with self.lock:
+                    failed.extend(failed_keys)
+                    self.documents += len(batch) - len(failed_keys)
+                    self.bytes += size
+                if self.verbose: print(f"\tIndexed {len(batch)} sections, {len(batch) - len(failed_keys)} succeeded")
+            finally:
+                slots.release()
+
+        with self.lock:
+            self.started = self.started or time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for batch, size in self.batches(documents):
+                slots.acquire()
+                futures.append(executor.submit(send, batch, size))
+        for future in futures:
+            future.result()
+        with self.lock:
+            self.finished = time.time()
+        return failed
+
+    def batches(self, documents: Iterable[dict]) -> Iterator[Tuple[List[dict], int]]:
+        batch = []
+        size = 0
+        for document in documents:
+            document_size = len(json.dumps(document).encode("utf-8")) + 32
+            if batch and (len(batch) >= self.max_batch_count or size + document_size > self.max_batch_bytes):
+                yield batch, size
+                batch = []
+                size = 0
+            batch.append(document)
+            size += document_size
+        if batch:
+            yield batch, size
+
+    def send_with_retries(self, batch: List[dict]) -> List[str]:
+        pending = batch
+        failed = []
+        attempt = 0
+        while True:
+            try:
+                results = self.search_client.upload_documents(documents=pending)
+                retry_keys = set()
+                for r in results:
+                    if r.succeeded:
+                        continue
+                    if r.status_code in RETRYABLE_STATUS_CODES:
+                        retry_keys.add(r.key)
+                    else:
+                        print(f"\tCould not index section {r.key}: {r.status_code} {r.error_message}")
+                        failed.append(r.key)
+            except HttpResponseError as e:
+                if e.status_code not in RETRYABLE_STATUS_CODES:
+                    raise
+                retry_keys = set(d[self.key_field] for d in pending)
+            if not retry_keys:
+                return failed
+            if attempt >= self.max_retries:
+                print(f"\tGiving up on {len(retry_keys)} sections after {attempt} retries")
+                return failed + list(retry_keys)
+
+            delay = min(self.max_backoff, self.initial_backoff * 2 ** attempt) * random.uniform(0.5, 1)
+            if self.verbose: print(f"\tRetrying {len(retry_keys)} sections in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+            with self.lock:
+                self.retries += len(retry_keys)
+            pending = [d for d in pending if d[self.key_field] in retry_keys]
+
+    def throughput(self) -> str:
+        elapsed = max((self.finished or 0) - (self.started or 0), 1e-6)
+        return f"{self.documents} sections, {self.bytes / 1024 / 1024:.1f} MB in {elapsed:.1f}s ({self.documents / elapsed:.1f} sections/s, {self.bytes / 1024 / 1024 / elapsed:.2f} MB/s, {self.retries} retried)"
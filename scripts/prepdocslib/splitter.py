@@ -0,0 +1,86 @@
+import re
+from bisect import bisect_right
+from typing import Iterator, List, Tuple
+
+SENTENCE_ENDINGS = [".", "!", "?"]
+WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+_SENTENCE_ENDING = re.compile("[" + re.escape("".join(SENTENCE_ENDINGS)) + "]")
+_WORDS_BREAK = re.compile("[" + re.escape("".join(WORDS_BREAKS)) + "]")
+# Greedy, so a match ends right after the last sentence ending or word break in the searched range
+_LAST_SENTENCE_ENDING = re.compile("(?s).*" + _SENTENCE_ENDING.pattern)
+_LAST_WORDS_BREAK = re.compile("(?s).*" + _WORDS_BREAK.pattern)
+
+# Splits the text of a document into overlapping sections, preferring to cut at sentence endings and otherwise at
+# word breaks. Produces exactly the same sections as the character walking split_text prepdocs.py used to have, but
+# boundary searches are regex searches bounded to the window being looked at, and pages are found with a bisect
+# over the page offsets instead of a scan of the page map.
+class TextSplitter:
+    def __init__(self, max_section_length: int = 1000, sentence_search_limit: int = 100, section_overlap: int = 100, verbose: bool = False):
+        self.max_section_length = max_section_length
+        self.sentence_search_limit = sentence_search_limit
+        self.section_overlap = section_overlap
+        self.verbose = verbose
+
+    def split(self, page_map: List[Tuple[int, int, str]]) -> Iterator[Tuple[str, int]]:
+        all_text = "".join(p[2] for p in page_map)
+        length = len(all_text)
+        page_offsets = [p[1] for p in page_map]
+
+        def find_page(offset: int) -> int:
+            i = bisect_right(page_offsets, offset) - 1
+            return i if 0 <= i < len(page_map) - 1 else len(page_map) - 1
+
+        start = 0
+        end = length
+        while start + self.section_overlap < length:
+            end = self.find_end(all_text, start)
+            start = self.find_start(all_text, start, end)
+
+            section_text = all_text[start:end]
+            yield (section_text, find_page(start))
+
+            last_table_start = section_text.rfind("<table")
+            if (last_table_start > 2 * self.sentence_search_limit and last_table_start > section_text.rfind("</table")):
+                # If the section ends with an unclosed table, we need to start the next section with the table.
+                # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
+                # If last table starts inside SECTION_OVERLAP, keep overlapping
+                if self.verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
+                start = min(end - self.section_overlap, start + last_table_start)
+            else:
+                start = end - self.section_overlap
+
+        if start + self.section_overlap < end:
+            yield (all_text[start:end], find_page(start))
+
+    def find_end(self, all_text: str, start: int) -> int:
+        # Try to find the end of the sentence within sentence_search_limit characters past the maximum length
+        length = len(all_text)
+        end = start + self.max_section_length
+        if end >= length:
+            return length
+        limit = end + self.sentence_search_limit
+        m = _SENTENCE_ENDING.search(all_text, end, limit + 1)
+        if m:
+            return m.start() + 1
+        if limit >= length:
+            return length
+        # Fall back to at least keeping a whole word
+        m = _LAST_WORDS_BREAK.match(all_text, end, limit)
+        if m and m.end() > 1:
+            return m.end()
+        return limit + 1
+
+    def find_start(self, all_text: str, start: int, end: int) -> int:
+        # Try to find the start of the sentence or at least a whole word boundary
+        lowest = max(0, end - self.max_section_length - 2 * self.sentence_search_limit)
+        if start > lowest:
+            m = _LAST_SENTENCE_ENDING.match(all_text, lowest + 1, start + 1)
+            if m:
+                start = m.end() - 1
+            else:
+                m = _WORDS_BREAK.search(all_text, lowest + 1, start + 1)
+                start = lowest
+                if all_text[start] not in SENTENCE_ENDINGS and m:
+                    start = m.start()
+        return start + 1 if start > 0 else start